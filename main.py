@@ -1,11 +1,24 @@
 from pathlib import Path
-from typing import Final, List, Optional
+from typing import Dict, Final, List, Optional, Set
 
 import click
 import os
+import sys
 
-from src.bazelize_deps import bazelize_deps, DetachedModeMetadata
+from src.bazelize_deps import bazelize_deps, resolve_graph, DetachedModeMetadata
+from src.deb_source import LocalDebSource, read_local_deb_source
+from src.groups import parse_input_file
+from src.inventory import collect_garbage, get_referenced_packages
+from src.lockfile import LOCKFILE
+from src.lockfile import refresh_build_files as refresh_detached_build_files
+from src.package import PackageMetadata, RegistryMetadata, ShardMetadata, StripMetadata
+from src.pipeline import StageLimits, parse_stage_limits
+from src.profiler import profiling
+from src.shard import merge_shards, parse_shard
 from src.read_input_files import read_input_files
+from src.resolver import get_closure
+from src.upload import DEFAULT_MAX_CONNECTIONS
+from src.verify import verify_modules
 
 BAZEL_WORKSPACE_DIR: Final = (
     os.environ.get("BUILD_WORKSPACE_DIRECTORY")
@@ -24,12 +37,14 @@ def _get_path(path: Path) -> Path:
 @click.option(
     "--input_file",
     "-i",
-    type=click.Path(path_type=Path, dir_okay=False),
-    required=True,
+    type=str,
     multiple=True,
-    help="""The path to the input file containing the input debian packages.
+    help="""The path to the input file containing the input debian packages, required unless
+--refresh_build_files is set.
 If path is relative, it is assumed to be relative to the workspace dir.
-If there are more than one input file, simply do -i path_to_file for each file.""",
+If there are more than one input file, simply do -i path_to_file for each file.
+Input files can be put in named groups with -i group=path_to_file. The groups are resolved and
+modularized together, and each group gets a view of its modules in <modules_path>/groups/<group>.""",
 )
 @click.option(
     "--modules_path",
@@ -87,8 +102,151 @@ If there are more than one input file, simply do -i path_to_file for each file."
     required=False,
     help="""Path to the build files if in detached mode.""",
 )
+@click.option(
+    "--layered_archives",
+    "-la",
+    is_flag=True,
+    help="""If set, each module is also split into content-stable layer archives: the generated
+module files, the data, the libs and the bins. The archives file stitches them back together
+with a generated layered_archive rule, so that a new version only downloads the layers whose
+content changed. Requires --detached_build_files_mode.""",
+)
+@click.option(
+    "--explicit_file_lists",
+    "-ef",
+    is_flag=True,
+    help="""If set, the BUILD files list the extracted files explicitly instead of using glob, and split them into libs, bins and data filegroups.""",
+)
+@click.option(
+    "--refresh_build_files",
+    "-rb",
+    is_flag=True,
+    help="""If set, only the detached BUILD, name.txt and version.txt files are regenerated, from the
+lockfile and the manifests left in modules_path by a previous run. No input file is taken,
+and neither the archives nor the archives file are touched. Requires --detached_build_files_mode.""",
+)
+@click.option(
+    "--minimal_rpaths",
+    "-mr",
+    is_flag=True,
+    help="""If set, ELF files only get the rpaths of the libs listed in their DT_NEEDED entries, instead of the rpaths of all the deps.""",
+)
+@click.option(
+    "--upload_url",
+    "-uu",
+    type=str,
+    required=False,
+    help="""If set, each module archive is uploaded with an HTTP PUT to <upload_url>/<archive name> as soon as it is written.""",
+)
+@click.option(
+    "--upload_connections",
+    "-uc",
+    type=click.IntRange(min=1),
+    default=DEFAULT_MAX_CONNECTIONS,
+    show_default=True,
+    help="""The maximum number of concurrent uploads.""",
+)
+@click.option(
+    "--deb_source",
+    "-ds",
+    type=click.Path(path_type=Path, file_okay=False),
+    required=False,
+    help="""Path to a local mirror directory containing .deb archives and their Packages index.
+If set, versions, deps and archives are taken from the mirror instead of apt.
+If path is relative, it is assumed to be relative to the workspace dir.""",
+)
+@click.option(
+    "--registry_dir",
+    "-rd",
+    type=click.Path(path_type=Path, file_okay=False),
+    required=False,
+    help="""If set, the modules are also added to a local bazel registry in this directory.
+If path is relative, it is assumed to be relative to the workspace dir.""",
+)
+@click.option(
+    "--registry_url_prefix",
+    "-ru",
+    type=str,
+    required=False,
+    help="""The URL prefix of the archives listed in the registry's source.json files.
+Defaults to --url_prefix if set, otherwise to a file:// URL of the modules path.""",
+)
+@click.option(
+    "--elf_workers",
+    "-ew",
+    type=click.IntRange(min=1),
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help="""The number of ELF files of a package that are scanned and rpath patched concurrently.""",
+)
+@click.option(
+    "--pipeline",
+    "-p",
+    is_flag=True,
+    default=False,
+    help="""If set, downloading, extracting, rpath patching and packaging overlap across packages.""",
+)
+@click.option(
+    "--pipeline_stage_workers",
+    "-pw",
+    type=str,
+    required=False,
+    help="""The workers of each pipeline stage and the size of the queues between them,
+e.g. download=8,extract=4,patch=2,package=1,queue_size=8. Implies --pipeline.""",
+)
+@click.option(
+    "--strip",
+    "-s",
+    type=click.Choice(["none", "debug", "all"]),
+    default="none",
+    show_default=True,
+    help="""Strips the ELF files after rpath patching. debug only removes the debug info,
+all also removes the symbols that are not needed for relocation.""",
+)
+@click.option(
+    "--debug_sidecar",
+    "-dsc",
+    is_flag=True,
+    default=False,
+    help="""If set, the stripped debug info is kept in a <module>.debug.tar.gz tarball next to the module archive.""",
+)
+@click.option(
+    "--module_cache",
+    "-mc",
+    type=str,
+    required=False,
+    help="""The module cache shared by the runs, either an http(s) url served with GET and PUT, or a
+local directory. Modules are stored under the fingerprint of their inputs, and fetched instead of
+being modularized again. If path is relative, it is assumed to be relative to the workspace dir.""",
+)
+@click.option(
+    "--profile",
+    "-pr",
+    type=click.Path(path_type=Path, file_okay=False),
+    required=False,
+    help="""If set, the run is profiled into this dir: bazelize.pstats for the whole run,
+packages/<package>.pstats for each package, and bazelize.collapsed, the sampled stacks of all the
+threads rooted at their package, ready for flamegraph.pl. If path is relative, it is assumed to be
+relative to the workspace dir.""",
+)
+@click.option(
+    "--shard",
+    "-sh",
+    type=str,
+    required=False,
+    help="""K/N: only modularizes the K-th of N shards of the topologically sorted graph.
+Requires --shard_dir. The modules paths of the N shards are combined with the merge command.""",
+)
+@click.option(
+    "--shard_dir",
+    "-sd",
+    type=click.Path(path_type=Path, file_okay=False),
+    required=False,
+    help="""A directory shared by all the shards, through which they exchange the rpaths of their modules.
+If path is relative, it is assumed to be relative to the workspace dir.""",
+)
 def main(
-    input_file: List[Path],
+    input_file: List[str],
     modules_path: Path,
     delimiter: str,
     tags: List[str],
@@ -97,6 +255,24 @@ def main(
     build_file_package: str,
     archives_file: Optional[Path],
     build_files_dir: Optional[Path],
+    layered_archives: bool,
+    explicit_file_lists: bool,
+    refresh_build_files: bool,
+    minimal_rpaths: bool,
+    upload_url: Optional[str],
+    upload_connections: int,
+    deb_source: Optional[Path],
+    registry_dir: Optional[Path],
+    registry_url_prefix: Optional[str],
+    elf_workers: int,
+    pipeline: bool,
+    pipeline_stage_workers: Optional[str],
+    strip: str,
+    debug_sidecar: bool,
+    module_cache: Optional[str],
+    profile: Optional[Path],
+    shard: Optional[str],
+    shard_dir: Optional[Path],
 ):
     """Turns input deb packages into modules and dumps it in modules_path."""
     if delimiter not in {"~", "+"}:
@@ -114,17 +290,39 @@ def main(
             "--build_file_package, --url_prefix, --archives_file_path and --build_files_path are required when --detach_build_file is set."
         )
 
-    input_files = [
-        file if file.is_absolute() else Path(BAZEL_WORKSPACE_DIR_STR) / file
-        for file in input_file
-    ]
+    if layered_archives and not detached_build_files_mode:
+        raise ValueError("--layered_archives requires --detached_build_files_mode.")
+
+    if refresh_build_files and input_file:
+        raise ValueError(
+            "--refresh_build_files only reads the lockfile, --input_file can't be set."
+        )
+    if not refresh_build_files and not input_file:
+        raise ValueError(
+            "At least one --input_file is required unless --refresh_build_files is set."
+        )
+
+    grouped_input_files: Dict[str, List[Path]] = {}
+    for value in input_file:
+        group, file = parse_input_file(value)
+        grouped_input_files.setdefault(group, []).append(
+            file if file.is_absolute() else Path(BAZEL_WORKSPACE_DIR_STR) / file
+        )
+    if "" in grouped_input_files and len(grouped_input_files) > 1:
+        raise ValueError(
+            "Either all input files or none of them must be part of a group."
+        )
+    if grouped_input_files and "" not in grouped_input_files and shard:
+        raise ValueError("--shard can't be combined with input groups.")
+    input_files = [file for files in grouped_input_files.values() for file in files]
 
     for file in input_files:
         if not file.exists():
             raise ValueError(f"{file} does not exist")
 
-    if archives_file and archives_file.exists():
-        archives_file.unlink()
+    local_deb_source: Optional[LocalDebSource] = (
+        read_local_deb_source(_get_path(deb_source)) if deb_source else None
+    )
 
     detached_mode_metadata: None | DetachedModeMetadata = None
     if detached_build_files_mode:
@@ -133,16 +331,299 @@ def main(
             build_file_package=build_file_package,
             archives_file=archives_file,
             build_files_dir=build_files_dir,
+            layered_archives=layered_archives,
         )
 
-    bazelize_deps(
+    if refresh_build_files:
+        if not detached_mode_metadata:
+            raise ValueError(
+                "--refresh_build_files requires --detached_build_files_mode."
+            )
+        packages = refresh_detached_build_files(
+            modules_path=_get_path(modules_path),
+            detached_mode_metadata=detached_mode_metadata,
+            delimiter=delimiter,
+            tags=tags,
+            explicit_file_lists=explicit_file_lists,
+        )
+        print("=========================")
+        print(f"The BUILD files of {len(packages)} packages were refreshed")
+        print("=========================")
+        return
+
+    registry_metadata: Optional[RegistryMetadata] = None
+    if registry_dir:
+        registry_metadata = RegistryMetadata(
+            registry_dir=_get_path(registry_dir),
+            url_prefix=registry_url_prefix
+            or url_prefix
+            or _get_path(modules_path).resolve().as_uri(),
+        )
+
+    stage_limits: Optional[StageLimits] = None
+    if pipeline or pipeline_stage_workers:
+        stage_limits = parse_stage_limits(pipeline_stage_workers or "")
+
+    shard_metadata: Optional[ShardMetadata] = None
+    if shard or shard_dir:
+        if not shard or not shard_dir:
+            raise ValueError("--shard and --shard_dir must be set together.")
+        if stage_limits:
+            raise ValueError("--shard can't be combined with --pipeline.")
+        shard_metadata = parse_shard(shard, _get_path(shard_dir))
+
+    strip_metadata: Optional[StripMetadata] = None
+    if strip != "none":
+        strip_metadata = StripMetadata(mode=strip, debug_sidecar=debug_sidecar)
+
+    input_groups: Optional[Dict[str, Set[PackageMetadata]]] = None
+    if "" not in grouped_input_files:
+        input_groups = {
+            group: read_input_files(input_files=files, deb_source=local_deb_source)
+            for group, files in grouped_input_files.items()
+        }
+
+    with profiling(_get_path(profile) if profile else None):
+        bazelize_deps(
+            modules_path=_get_path(modules_path),
+            input_package_metadatas=set().union(*input_groups.values())
+            if input_groups
+            else read_input_files(input_files=input_files, deb_source=local_deb_source),
+            delimiter=delimiter,
+            tags=tags,
+            detached_mode_metadata=detached_mode_metadata,
+            explicit_file_lists=explicit_file_lists,
+            minimal_rpaths=minimal_rpaths,
+            upload_url=upload_url,
+            upload_connections=upload_connections,
+            deb_source=local_deb_source,
+            registry_metadata=registry_metadata,
+            elf_workers=elf_workers,
+            stage_limits=stage_limits,
+            strip_metadata=strip_metadata,
+            shard_metadata=shard_metadata,
+            input_groups=input_groups,
+            module_cache_location=module_cache
+            if not module_cache or "://" in module_cache
+            else str(_get_path(Path(module_cache))),
+        )
+
+
+@click.command()
+@click.option(
+    "--modules_path",
+    "-m",
+    type=click.Path(path_type=Path, file_okay=False),
+    required=True,
+    help="""The path to combine the modules of all the shards in.
+If path is relative, it is assumed to be relative to the workspace dir.""",
+)
+@click.option(
+    "--archives_file",
+    "-af",
+    type=click.Path(path_type=Path, dir_okay=False),
+    required=False,
+    help="""In detached mode, the archives file to combine the http_archives of all the shards in.""",
+)
+@click.option(
+    "--build_files_dir",
+    "-bf",
+    type=click.Path(path_type=Path, file_okay=False),
+    required=False,
+    help="""In detached mode, the path to combine the build files of all the shards in.""",
+)
+@click.option(
+    "--registry_dir",
+    "-rd",
+    type=click.Path(path_type=Path, file_okay=False),
+    required=False,
+    help="""The local bazel registry to combine the registry modules of all the shards in.
+If path is relative, it is assumed to be relative to the workspace dir.""",
+)
+@click.argument(
+    "shard_modules_paths",
+    nargs=-1,
+    required=True,
+    type=click.Path(path_type=Path, file_okay=False, exists=True),
+)
+def merge(
+    modules_path: Path,
+    archives_file: Optional[Path],
+    build_files_dir: Optional[Path],
+    registry_dir: Optional[Path],
+    shard_modules_paths: List[Path],
+):
+    """Combines the modules paths of the shards of a --shard run into a single modules path."""
+    packages = merge_shards(
+        shard_paths=[_get_path(path) for path in shard_modules_paths],
+        modules_path=_get_path(modules_path),
+        archives_file=_get_path(archives_file) if archives_file else None,
+        build_files_dir=_get_path(build_files_dir) if build_files_dir else None,
+        registry_dir=_get_path(registry_dir) if registry_dir else None,
+    )
+    print("=========================")
+    print(
+        f"{len(packages)} packages were merged from {len(shard_modules_paths)} shards"
+    )
+    print("=========================")
+
+
+@click.command()
+@click.option(
+    "--modules_path",
+    "-m",
+    type=click.Path(path_type=Path, file_okay=False, exists=True),
+    required=True,
+    help="""The path holding the modules to verify.
+If path is relative, it is assumed to be relative to the workspace dir.""",
+)
+@click.option(
+    "--runfiles_dir",
+    "-r",
+    type=click.Path(path_type=Path, file_okay=False),
+    required=False,
+    help="""The dir to lay the modules out in, kept for inspection. By default, a temporary dir is used.""",
+)
+@click.option(
+    "--elf_workers",
+    "-ew",
+    type=click.IntRange(min=1),
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help="""The number of archives that are extracted, and of ELF files that are verified, concurrently.""",
+)
+@click.option(
+    "--archive",
+    "-a",
+    "archives",
+    type=click.Path(path_type=Path, dir_okay=False, exists=True),
+    multiple=True,
+    help="""The module archives to verify. By default, the ones locked in the bazelize.lock.json of the modules path.""",
+)
+def verify(
+    modules_path: Path,
+    runfiles_dir: Optional[Path],
+    elf_workers: int,
+    archives: List[Path],
+):
+    """Checks that the DT_NEEDED libs of the ELF files of the modules resolve through their rpaths,
+    with the modules laid out like runfiles. Exits with 1 if any lib is unresolved.
+
+    Each ELF file is checked on its own: the DT_RPATH of the objects loading it is not
+    inherited, so a lib that only resolves through the DT_RPATH of an executable loading it
+    is reported as unresolved."""
+    unresolved = verify_modules(
         modules_path=_get_path(modules_path),
-        input_package_metadatas=read_input_files(input_files=input_files),
-        delimiter=delimiter,
-        tags=tags,
-        detached_mode_metadata=detached_mode_metadata,
+        workers=elf_workers,
+        runfiles_dir=_get_path(runfiles_dir) if runfiles_dir else None,
+        archives=[_get_path(archive) for archive in archives],
     )
+    print("=========================")
+    for file, libs in unresolved.items():
+        print(f"{file}: {', '.join(libs)} not found")
+    print(f"{len(unresolved)} ELF files have unresolved libs")
+    print("=========================")
+    if unresolved:
+        sys.exit(1)
+
+
+@click.command()
+@click.option(
+    "--modules_path",
+    "-m",
+    type=click.Path(path_type=Path, file_okay=False, exists=True),
+    required=True,
+    help="""The path to remove the unreferenced artifacts from. Its own lockfile is always a reference.
+If path is relative, it is assumed to be relative to the workspace dir.""",
+)
+@click.option(
+    "--lockfile",
+    "-l",
+    type=click.Path(path_type=Path, dir_okay=False, exists=True),
+    multiple=True,
+    help="""Other lockfiles whose packages are kept, like the ones of other runs sharing the modules path.""",
+)
+@click.option(
+    "--input_file",
+    "-i",
+    type=click.Path(path_type=Path, dir_okay=False, exists=True),
+    multiple=True,
+    help="""Input files whose packages and resolved deps are kept. They are resolved like in a run.""",
+)
+@click.option(
+    "--deb_source",
+    "-ds",
+    type=click.Path(path_type=Path, file_okay=False),
+    required=False,
+    help="""Path to a local mirror directory, to resolve the unpinned versions of the input files from.""",
+)
+@click.option(
+    "--dry_run",
+    "-dr",
+    is_flag=True,
+    help="""If set, the artifacts that would be removed are only listed.""",
+)
+def gc(
+    modules_path: Path,
+    lockfile: List[Path],
+    input_file: List[Path],
+    deb_source: Optional[Path],
+    dry_run: bool,
+):
+    """Removes the artifacts indexed in the inventory of modules_path whose package is neither
+    locked by a lockfile, nor resolved from an input file, along with its deps."""
+    modules_path = _get_path(modules_path)
+    lockfiles = [_get_path(file) for file in lockfile]
+    if (modules_path / LOCKFILE).exists():
+        lockfiles.append(modules_path / LOCKFILE)
+    if not lockfiles and not input_file:
+        raise ValueError(
+            f"Nothing references the artifacts of {modules_path}, which has no {LOCKFILE}. At least one --lockfile or --input_file is required."
+        )
+
+    local_deb_source: Optional[LocalDebSource] = (
+        read_local_deb_source(_get_path(deb_source)) if deb_source else None
+    )
+    # each input file is resolved on its own, like in the run modularizing it
+    input_closures: Set[PackageMetadata] = set()
+    for file in input_file:
+        input_package_metadatas = read_input_files(
+            input_files=[_get_path(file)], deb_source=local_deb_source
+        )
+        input_closures.update(
+            get_closure(
+                resolve_graph(input_package_metadatas, local_deb_source),
+                input_package_metadatas,
+            )
+        )
+    garbage = collect_garbage(
+        modules_path=modules_path,
+        referenced=get_referenced_packages(lockfiles, input_closures),
+        dry_run=dry_run,
+    )
+    print("=========================")
+    for entry in garbage:
+        print(f"{entry['file']}: {entry['size']} bytes, last run: {entry['last_run']}")
+    print(
+        f"{len(garbage)} artifacts {'would be' if dry_run else 'were'} removed, freeing {sum(entry['size'] for entry in garbage)} bytes"
+    )
+    print("=========================")
+
+
+class _DefaultCommandGroup(click.Group):
+    """Runs the bazelize command unless the first argument is another command, so that
+    main.py -i <input_file> -m <modules_path> keeps working next to the other commands."""
+
+    def parse_args(self, ctx, args):
+        if not args or (args[0] not in self.commands and args[0] != "--help"):
+            args = ["bazelize"] + list(args)
+        return super().parse_args(ctx, args)
+
+
+cli = _DefaultCommandGroup(
+    commands={"bazelize": main, "merge": merge, "verify": verify, "gc": gc}
+)
 
 
 if __name__ == "__main__":
-    main()
+    cli()
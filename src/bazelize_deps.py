@@ -1,10 +1,47 @@
-from typing import Iterable, Dict, List, Set, Optional
+from typing import Callable, Iterable, Dict, List, Set, Optional
 from pathlib import Path
 
-from src.package_factory import create_deb_package
-from src.module import Module
-from src.modularize_package import modularize_package
-from src.package import Package, PackageMetadata, DetachedModeMetadata
+import functools
+
+from src.deb_source import LocalDebSource
+from src.graph import get_strongly_connected_components, get_transitive_deps
+from src.package_factory import (
+    create_deb_package,
+    get_control_deps_str,
+    get_installed_size,
+    get_requested_version,
+    is_real_package,
+)
+from src.groups import write_group_views
+from src.lockfile import LOCKFILE, write_lockfile
+from src.resolver import get_closure, resolve_versions
+from src.timings import TIMINGS_DOT_JSON, TimingDatabase, tracking
+from src.shard import (
+    export_modules,
+    get_shard_components,
+    wait_for_modules,
+    write_shard_summary,
+)
+from src.inventory import Inventory
+from src.module import Module, get_module_name
+from src.module_cache import (
+    ModuleCache,
+    fetch_cached_packages,
+    get_fingerprints,
+    get_module_cache,
+)
+from src.modularize_package import get_layer_tars, modularize_package
+from src.pipeline import StageLimits, bazelize_pipelined
+from src.package import (
+    Package,
+    PackageMetadata,
+    DetachedModeMetadata,
+    RegistryMetadata,
+    ShardMetadata,
+    StripMetadata,
+)
+from src.upload import ArchiveUploader, DEFAULT_MAX_CONNECTIONS
+from src.writers import WRITE_STATS, prune_http_archives
 
 
 def _add_deps_to_stack(
@@ -42,58 +79,431 @@ def _print_summary(deb_package_cache: Dict[PackageMetadata, Package]):
         print(f"{i}) {package.pinned_name}")
 
 
+def _print_upload_summary(uploader: ArchiveUploader):
+    print("=========================")
+    print(
+        f"{len(uploader.uploaded)} archives were uploaded, {len(uploader.skipped)} were already up to date"
+    )
+    print("=========================")
+
+
+def _print_module_cache_summary(module_cache: ModuleCache):
+    print("=========================")
+    print(
+        f"{len(module_cache.hits)} modules were fetched from the module cache, {len(module_cache.stored)} were stored in it"
+    )
+    print("=========================")
+
+
+def _print_write_summary():
+    print("=========================")
+    print(
+        f"{WRITE_STATS.written} files were written, {WRITE_STATS.skipped} were unchanged and skipped"
+    )
+    print("=========================")
+
+
+def _get_metadata_sort_key(metadata: PackageMetadata) -> str:
+    return f"{metadata.name}:{metadata.arch}={metadata.version}"
+
+
+def resolve_graph(
+    input_package_metadatas: Iterable[PackageMetadata],
+    deb_source: Optional[LocalDebSource] = None,
+) -> Dict[PackageMetadata, Set[PackageMetadata]]:
+    """Resolves the dependency graph of the input packages, from the control data of
+    deb_source if provided, otherwise from apt."""
+    return resolve_versions(
+        input_package_metadatas=input_package_metadatas,
+        get_deps_str=functools.partial(get_control_deps_str, deb_source=deb_source),
+        get_requested_version=functools.partial(
+            get_requested_version, deb_source=deb_source
+        ),
+        is_real_package=functools.partial(is_real_package, deb_source=deb_source),
+    )
+
+
+def _get_shard_cost(
+    shard_metadata: ShardMetadata, deb_source: Optional[LocalDebSource] = None
+) -> Callable[[PackageMetadata], float]:
+    """Every shard must split the graph the same way, so the packages are estimated from the
+    timings of the shard dir they all share, e.g. the merged timings of a previous run,
+    otherwise from their Installed-Size. Packages of unknown size count as one KiB."""
+    timing_database = TimingDatabase(shard_metadata.shard_dir / TIMINGS_DOT_JSON)
+    if timing_database.packages:
+        return timing_database.get_cost
+
+    return lambda metadata: float(get_installed_size(metadata, deb_source) or 1)
+
+
+def _resolve_packages(
+    resolved_graph: Dict[PackageMetadata, Set[PackageMetadata]],
+    delimiter: str,
+    tags: Iterable[str],
+    detached_mode_metadata: Optional[DetachedModeMetadata],
+    explicit_file_lists: bool,
+    deb_source: Optional[LocalDebSource],
+    elf_workers: int,
+) -> Dict[PackageMetadata, Package]:
+    """Creates the packages of the resolved dependency graph, and only those.
+    Deps that are not keys of resolved_graph, like the ones of other shards, are not created."""
+    processed_packages: Dict[PackageMetadata, Package] = {}
+    # will be used as a stack for the DFS algorithm
+    package_stack = sorted(resolved_graph, key=_get_metadata_sort_key, reverse=True)
+    while package_stack:
+        package_metadata = package_stack.pop()
+        if (
+            package_metadata in processed_packages
+            or package_metadata not in resolved_graph
+        ):
+            continue
+
+        processed_packages[package_metadata] = create_deb_package(
+            metadata=package_metadata,
+            delimiter=delimiter,
+            tags=tags,
+            detached_mode_metadata=detached_mode_metadata,
+            explicit_file_lists=explicit_file_lists,
+            deb_source=deb_source,
+            elf_workers=elf_workers,
+            deps=resolved_graph[package_metadata],
+        )
+        _add_deps_to_stack(
+            package_metadata,
+            package_stack=package_stack,
+            visited_modules=processed_packages,
+            deb_package_cache=processed_packages,
+        )
+
+    return processed_packages
+
+
 def bazelize_deps(
     input_package_metadatas: Set[PackageMetadata],
     modules_path: Path,
     delimiter: str = "~",
     tags: Iterable[str] = [],
     detached_mode_metadata: Optional[DetachedModeMetadata] = None,
+    explicit_file_lists: bool = False,
+    minimal_rpaths: bool = False,
+    upload_url: Optional[str] = None,
+    upload_connections: int = DEFAULT_MAX_CONNECTIONS,
+    deb_source: Optional[LocalDebSource] = None,
+    registry_metadata: Optional[RegistryMetadata] = None,
+    elf_workers: int = 1,
+    stage_limits: Optional[StageLimits] = None,
+    strip_metadata: Optional[StripMetadata] = None,
+    shard_metadata: Optional[ShardMetadata] = None,
+    input_groups: Optional[Dict[str, Set[PackageMetadata]]] = None,
+    module_cache_location: Optional[str] = None,
 ) -> None:
-    """This function bazelizes deps in a topological order."""
-    visited_modules: Dict[PackageMetadata, Module] = {}
-    # will be used as a stack for the DFS algorithm
-    package_stack: List[PackageMetadata] = []
-    processed_packages: Dict[PackageMetadata, Package] = {}
+    """This function bazelizes deps in a topological order.
+    The versions of the whole graph are resolved from the packages' control data first, so
+    that only one version per (name, arch, compatibility_level) is ever downloaded.
+    Dependency cycles are condensed into strongly connected components, which are modularized
+    together after the components they depend on.
+    If upload_url is provided, each archive is uploaded in the background as soon as it is written.
+    If stage_limits is provided, the download, extract, patch and package stages are pipelined.
+    If strip_metadata is provided, the ELF files are stripped after being rpath patched.
+    If shard_metadata is provided, only the components of the shard are modularized, the
+    rpaths of their deps in other shards are read from the shared shard dir.
+    If input_groups is provided, the input packages are the union of the groups, which are
+    resolved and modularized together. Each group then gets its own view of the modules.
+    If module_cache_location is provided, the modules whose fingerprint is in the module cache
+    are fetched from it instead of being modularized, the others are stored in it.
+    The modularized packages are locked in modules_path, so that their detached BUILD files can
+    later be refreshed without running again. Their artifacts are indexed in the inventory of
+    modules_path as soon as they are written. The stage timings of the packages are kept in
+    modules_path, to report the progress of the next runs and start their longest packages first."""
+    resolved_graph = resolve_graph(input_package_metadatas, deb_source)
+    group_closures = {
+        name: get_closure(resolved_graph, metadatas)
+        for name, metadatas in (input_groups or {}).items()
+    }
+    components = get_strongly_connected_components(
+        resolved_graph, sort_key=_get_metadata_sort_key
+    )
+    all_components = components
+    all_resolved_graph = resolved_graph
+    # the transitive deps of every package, shared by the members of its component
+    transitive_deps = {
+        metadata: deps
+        for component, deps in zip(
+            all_components, get_transitive_deps(all_components, all_resolved_graph)
+        )
+        for metadata in component
+    }
+    if shard_metadata:
+        if stage_limits:
+            raise ValueError("Sharding can't be combined with the pipelined stages")
+        if input_groups:
+            raise ValueError("Sharding can't be combined with input groups")
+        components = get_shard_components(
+            components,
+            shard_metadata.count,
+            get_cost=_get_shard_cost(shard_metadata, deb_source),
+        )[shard_metadata.index - 1]
+        resolved_graph = {
+            metadata: resolved_graph[metadata]
+            for component in components
+            for metadata in component
+        }
 
-    for input_package_metadata in input_package_metadatas:
-        processed_packages[input_package_metadata] = create_deb_package(
-            metadata=input_package_metadata,
+    module_cache: Optional[ModuleCache] = None
+    fingerprints: Dict[PackageMetadata, str] = {}
+    if module_cache_location:
+        if stage_limits:
+            raise ValueError(
+                "The module cache can't be combined with the pipelined stages"
+            )
+        module_cache = get_module_cache(module_cache_location)
+        fingerprints = get_fingerprints(
+            components=all_components,
+            resolved_graph=all_resolved_graph,
             delimiter=delimiter,
             tags=tags,
-            detached_mode_metadata=detached_mode_metadata,
+            detached=detached_mode_metadata is not None,
+            explicit_file_lists=explicit_file_lists,
+            minimal_rpaths=minimal_rpaths,
+            strip_metadata=strip_metadata,
+            layered_archives=bool(
+                detached_mode_metadata and detached_mode_metadata.layered_archives
+            ),
         )
 
-    package_stack = list(processed_packages.keys())
+    uploader = (
+        ArchiveUploader(upload_url=upload_url, max_connections=upload_connections)
+        if upload_url
+        else None
+    )
+    inventory = Inventory(modules_path)
+    timing_database = TimingDatabase(modules_path / TIMINGS_DOT_JSON)
+    try:
+        if stage_limits:
+            with tracking(timing_database, resolved_graph):
+                processed_packages = bazelize_pipelined(
+                    components=components,
+                    resolved_graph=resolved_graph,
+                    modules_path=modules_path,
+                    delimiter=delimiter,
+                    tags=tags,
+                    detached_mode_metadata=detached_mode_metadata,
+                    explicit_file_lists=explicit_file_lists,
+                    minimal_rpaths=minimal_rpaths,
+                    uploader=uploader,
+                    inventory=inventory,
+                    deb_source=deb_source,
+                    registry_metadata=registry_metadata,
+                    elf_workers=elf_workers,
+                    stage_limits=stage_limits,
+                    strip_metadata=strip_metadata,
+                    get_cost=timing_database.get_cost,
+                )
+        else:
+            cached_packages: Dict[PackageMetadata, Package] = {}
+            if module_cache:
+                cached_packages = fetch_cached_packages(
+                    module_cache=module_cache,
+                    components=components,
+                    resolved_graph=resolved_graph,
+                    fingerprints=fingerprints,
+                    modules_path=modules_path,
+                    delimiter=delimiter,
+                    tags=tags,
+                    detached_mode_metadata=detached_mode_metadata,
+                    explicit_file_lists=explicit_file_lists,
+                    registry_metadata=registry_metadata,
+                )
+                for package in cached_packages.values():
+                    inventory.record(package)
+            with tracking(
+                timing_database,
+                [
+                    metadata
+                    for metadata in resolved_graph
+                    if metadata not in cached_packages
+                ],
+            ):
+                processed_packages = _resolve_packages(
+                    resolved_graph={
+                        metadata: deps
+                        for metadata, deps in resolved_graph.items()
+                        if metadata not in cached_packages
+                    },
+                    delimiter=delimiter,
+                    tags=tags,
+                    detached_mode_metadata=detached_mode_metadata,
+                    explicit_file_lists=explicit_file_lists,
+                    deb_source=deb_source,
+                    elf_workers=elf_workers,
+                )
+                upstream_modules: Dict[PackageMetadata, Module] = {
+                    metadata: _get_module(package)
+                    for metadata, package in cached_packages.items()
+                }
+                if shard_metadata:
+                    upstream_modules.update(
+                        _exchange_shard_modules(
+                            shard_metadata,
+                            {**cached_packages, **processed_packages},
+                            all_components,
+                            transitive_deps,
+                        )
+                    )
+                _bazelize_components(
+                    components=[
+                        component
+                        for component in components
+                        if component[0] not in cached_packages
+                    ],
+                    upstream_modules=upstream_modules,
+                    transitive_deps=transitive_deps,
+                    processed_packages=processed_packages,
+                    modules_path=modules_path,
+                    minimal_rpaths=minimal_rpaths,
+                    uploader=uploader,
+                    inventory=inventory,
+                    registry_metadata=registry_metadata,
+                    elf_workers=elf_workers,
+                    strip_metadata=strip_metadata,
+                )
+            if module_cache:
+                for metadata, package in processed_packages.items():
+                    module_cache.store_module(
+                        fingerprints[metadata], package, modules_path
+                    )
+            processed_packages.update(cached_packages)
+    finally:
+        if uploader:
+            uploader.close()
+        inventory.close()
+        if module_cache:
+            module_cache.close()
 
-    while package_stack:
-        if package_stack[-1] in visited_modules:
-            package_stack.pop()
-            continue
+    if detached_mode_metadata:
+        prune_http_archives(
+            detached_mode_metadata.archives_file,
+            {
+                get_module_name(name=package.name, arch=package.arch)
+                for package in processed_packages.values()
+            },
+        )
 
-        if package_stack[-1] not in processed_packages:
-            processed_packages[package_stack[-1]] = create_deb_package(
-                metadata=package_stack[-1],
-                delimiter=delimiter,
-                tags=tags,
-                detached_mode_metadata=detached_mode_metadata,
-            )
+    write_lockfile(modules_path / LOCKFILE, processed_packages.values())
 
-        if not _add_deps_to_stack(
-            package_stack[-1],
-            package_stack=package_stack,
-            deb_package_cache=processed_packages,
-            visited_modules=visited_modules,
-        ):
-            package_metadata = package_stack.pop()
-            package = processed_packages[package_metadata]
-            modularize_package(
-                package=package, modules=visited_modules, modules_path=modules_path
-            )
-            visited_modules[package_metadata] = Module(
-                name=package.name,
-                arch=package.arch,
-                version=package.version,
-                rpaths=package.rpaths,
-            )
+    if group_closures:
+        write_group_views(
+            group_closures=group_closures,
+            processed_packages=processed_packages,
+            modules_path=modules_path,
+            archives_file=detached_mode_metadata.archives_file
+            if detached_mode_metadata
+            else None,
+        )
+
+    if shard_metadata:
+        write_shard_summary(
+            modules_path=modules_path,
+            shard_metadata=shard_metadata,
+            packages=processed_packages.values(),
+            archives_file=detached_mode_metadata.archives_file
+            if detached_mode_metadata
+            else None,
+            build_files_dir=detached_mode_metadata.build_files_dir
+            if detached_mode_metadata
+            else None,
+            registry_dir=registry_metadata.registry_dir if registry_metadata else None,
+        )
 
     _print_summary(processed_packages)
+    _print_write_summary()
+    if uploader:
+        _print_upload_summary(uploader)
+    if module_cache:
+        _print_module_cache_summary(module_cache)
+
+
+def _get_module(package: Package) -> Module:
+    return Module(
+        name=package.name,
+        arch=package.arch,
+        version=package.version,
+        rpaths=package.rpaths,
+    )
+
+
+def _exchange_shard_modules(
+    shard_metadata: ShardMetadata,
+    processed_packages: Dict[PackageMetadata, Package],
+    all_components: List[List[PackageMetadata]],
+    transitive_deps: Dict[PackageMetadata, List[PackageMetadata]],
+) -> Dict[PackageMetadata, Module]:
+    """Exports the modules of the shard, then waits for the modules of its transitive deps in
+    other shards. Returns the latter in a topological order."""
+    export_modules(
+        shard_metadata,
+        [_get_module(package) for package in processed_packages.values()],
+    )
+    needed = {
+        dep for metadata in processed_packages for dep in transitive_deps[metadata]
+    } - processed_packages.keys()
+    upstream_modules = wait_for_modules(shard_metadata, needed)
+
+    return {
+        metadata: upstream_modules[metadata]
+        for component in all_components
+        for metadata in component
+        if metadata in upstream_modules
+    }
+
+
+def _bazelize_components(
+    components: List[List[PackageMetadata]],
+    processed_packages: Dict[PackageMetadata, Package],
+    modules_path: Path,
+    minimal_rpaths: bool,
+    uploader: Optional[ArchiveUploader],
+    registry_metadata: Optional[RegistryMetadata],
+    elf_workers: int,
+    strip_metadata: Optional[StripMetadata] = None,
+    upstream_modules: Dict[PackageMetadata, Module] = {},
+    inventory: Optional[Inventory] = None,
+    transitive_deps: Dict[PackageMetadata, List[PackageMetadata]] = {},
+) -> None:
+    """Modularizes the strongly connected components, given in a topological order.
+    upstream_modules are the already modularized deps, like the ones of other shards.
+    With minimal_rpaths, the sonames of a package are looked up in its transitive_deps only,
+    like in the pipelined stages, so that its rpaths do not depend on the processing order."""
+    visited_modules: Dict[PackageMetadata, Module] = dict(upstream_modules)
+    for component in components:
+        # the rpaths of a package are known as soon as it is extracted, so the members of a
+        # cycle can see each other's rpaths before any of them is patched
+        for package_metadata in component:
+            package = processed_packages[package_metadata]
+            package.cycle_peers = set(component) - {package_metadata}
+            visited_modules[package_metadata] = _get_module(package)
+
+        # maps the sonames of the transitive deps to their rpath directories
+        soname_index: Optional[Dict[str, str]] = None
+        if minimal_rpaths:
+            soname_index = {}
+            for dep in transitive_deps[component[0]]:
+                soname_index.update(visited_modules[dep].rpaths)
+
+        for package_metadata in component:
+            package = processed_packages[package_metadata]
+            module_archive = modularize_package(
+                package=package,
+                modules=visited_modules,
+                modules_path=modules_path,
+                soname_index=soname_index,
+                registry_metadata=registry_metadata,
+                elf_workers=elf_workers,
+                strip_metadata=strip_metadata,
+            )
+            if uploader:
+                uploader.submit(module_archive)
+                for layer_tar in get_layer_tars(package, modules_path):
+                    uploader.submit(layer_tar)
+            if inventory:
+                inventory.record(package)
@@ -0,0 +1,170 @@
+"""File containing a local mirror of debian packages, used instead of apt."""
+
+from pathlib import Path
+from typing import Dict, Final, List, Tuple
+
+import dataclasses
+import functools
+import gzip
+import hashlib
+import lzma
+
+from src.package import PackageMetadata
+from src.version import compare_dpkg_versions
+
+PACKAGES_INDEX_FILES: Final = ("Packages", "Packages.gz", "Packages.xz")
+ARCH_ALL: Final = "all"
+HASH_CHUNK_SIZE: Final = 1 << 20
+# the checksum fields of the Packages index, from the strongest to the weakest
+CHECKSUM_FIELDS: Final = (("SHA256", "sha256"), ("SHA1", "sha1"), ("MD5sum", "md5"))
+
+
+@dataclasses.dataclass(frozen=True)
+class DebIndexEntry:
+    """An entry of a Packages index file."""
+
+    name: str
+    arch: str
+    version: str
+    filename: str
+    sha256: str
+    depends: str = ""
+    sha1: str = ""
+    md5sum: str = ""
+    # in KiB, 0 if unknown
+    installed_size: int = 0
+
+    def get_checksum(self) -> Tuple[str, str]:
+        """Returns the strongest checksum field of the entry and its value."""
+        checksums = (self.sha256, self.sha1, self.md5sum)
+        for (field, _), checksum in zip(CHECKSUM_FIELDS, checksums):
+            if checksum:
+                return field, checksum
+
+        raise ValueError(
+            f"{self.name}:{self.arch}={self.version} has no checksum in the Packages index, "
+            f"one of {', '.join(field for field, _ in CHECKSUM_FIELDS)} is needed"
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class LocalDebSource:
+    """A directory containing .deb archives and the Packages index file listing them."""
+
+    directory: Path
+    # (name, arch) mapped to the available entries, sorted from oldest to newest version
+    entries: Dict[Tuple[str, str], List[DebIndexEntry]]
+
+    def _get_entries(self, name: str, arch: str) -> List[DebIndexEntry]:
+        entries = self.entries.get((name, arch)) or self.entries.get((name, ARCH_ALL))
+        if not entries:
+            raise ValueError(
+                f"{name}:{arch} could not be found in the Packages index of {self.directory}"
+            )
+        return entries
+
+    def is_real_package(self, name: str, arch: str) -> bool:
+        """Virtual packages, only provided by others, are not listed in the index."""
+        return (name, arch) in self.entries or (name, ARCH_ALL) in self.entries
+
+    def get_package_version(self, name: str, arch: str) -> str:
+        """Returns the newest version of the package available in the index."""
+        return self._get_entries(name, arch)[-1].version
+
+    def get_entry(self, metadata: PackageMetadata) -> DebIndexEntry:
+        """Returns the index entry of the pinned package."""
+        for entry in self._get_entries(metadata.name, metadata.arch):
+            if entry.version == metadata.version:
+                return entry
+
+        raise ValueError(
+            f"{metadata.name}:{metadata.arch}={metadata.version} could not be found in the Packages index of {self.directory}"
+        )
+
+    def get_archive(self, metadata: PackageMetadata) -> Path:
+        """Returns the path of the .deb archive of the pinned package, after verifying its
+        checksum, the strongest one listed in the Packages index."""
+        entry = self.get_entry(metadata)
+        field, expected = entry.get_checksum()
+        archive_path = self.directory / entry.filename
+        if not archive_path.is_file():
+            raise ValueError(
+                f"{archive_path} listed in the Packages index does not exist"
+            )
+
+        digest = hashlib.new(dict(CHECKSUM_FIELDS)[field])
+        with archive_path.open("rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+
+        if digest.hexdigest() != expected:
+            raise ValueError(
+                f"{field} mismatch for {archive_path}: expected {expected}, got {digest.hexdigest()}"
+            )
+
+        return archive_path.resolve()
+
+
+def _parse_stanza(stanza: str) -> Dict[str, str]:
+    "Parses a deb822 stanza into a dict of fields, folding continuation lines."
+    fields: Dict[str, str] = {}
+    field = ""
+    for line in stanza.splitlines():
+        if line.startswith((" ", "\t")):
+            if field:
+                fields[field] += " " + line.strip()
+            continue
+
+        field, _, value = line.partition(":")
+        fields[field] = value.strip()
+
+    return fields
+
+
+def _read_packages_index(directory: Path) -> str:
+    for index_file in PACKAGES_INDEX_FILES:
+        file = directory / index_file
+        if not file.exists():
+            continue
+        if file.suffix == ".gz":
+            return gzip.decompress(file.read_bytes()).decode("utf-8")
+        if file.suffix == ".xz":
+            return lzma.decompress(file.read_bytes()).decode("utf-8")
+        return file.read_text(encoding="utf-8")
+
+    raise ValueError(
+        f"None of {', '.join(PACKAGES_INDEX_FILES)} could be found in {directory}"
+    )
+
+
+def read_local_deb_source(directory: Path) -> LocalDebSource:
+    """Reads the Packages index of a local mirror directory."""
+    entries: Dict[Tuple[str, str], List[DebIndexEntry]] = {}
+    for stanza in _read_packages_index(directory).split("\n\n"):
+        fields = _parse_stanza(stanza)
+        if "Package" not in fields:
+            continue
+
+        entry = DebIndexEntry(
+            name=fields["Package"],
+            arch=fields.get("Architecture", ""),
+            version=fields.get("Version", ""),
+            filename=fields.get("Filename", ""),
+            sha256=fields.get("SHA256", ""),
+            depends=fields.get("Depends", ""),
+            sha1=fields.get("SHA1", ""),
+            md5sum=fields.get("MD5sum", ""),
+            installed_size=int(fields.get("Installed-Size", "0") or 0),
+        )
+        entries.setdefault((entry.name, entry.arch), []).append(entry)
+
+    for package_entries in entries.values():
+        package_entries.sort(
+            key=functools.cmp_to_key(
+                lambda entry_1, entry_2: compare_dpkg_versions(
+                    entry_1.version, entry_2.version
+                )
+            )
+        )
+
+    return LocalDebSource(directory=directory.resolve(), entries=entries)
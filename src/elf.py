@@ -0,0 +1,133 @@
+"""Minimal in-process reader for the dynamic section of ELF files."""
+
+from pathlib import Path
+from typing import Final, List, Optional, Tuple, Union
+
+import dataclasses
+import mmap
+import struct
+
+ELF_MAGIC: Final = b"\x7fELF"
+ELF_CLASS_32: Final = 1
+ELF_CLASS_64: Final = 2
+ELF_DATA_LITTLE_ENDIAN: Final = 1
+ET_EXEC: Final = 2
+ET_DYN: Final = 3
+PT_LOAD: Final = 1
+PT_DYNAMIC: Final = 2
+PT_INTERP: Final = 3
+DT_NULL: Final = 0
+DT_NEEDED: Final = 1
+DT_STRTAB: Final = 5
+DT_SONAME: Final = 14
+DT_RPATH: Final = 15
+DT_RUNPATH: Final = 29
+
+
+@dataclasses.dataclass(frozen=True)
+class ElfDynamicInfo:
+    """The parts of an ELF file relevant for the dynamic loader."""
+
+    elf_type: int
+    has_interpreter: bool
+    needed: Tuple[str, ...] = ()
+    soname: str = ""
+    rpath: str = ""
+    runpath: str = ""
+
+
+def _read_c_string(data: Union[bytes, mmap.mmap], offset: int) -> str:
+    end = data.find(b"\0", offset)
+    return data[offset : end if end != -1 else len(data)].decode(
+        "utf-8", errors="replace"
+    )
+
+
+def _vaddr_to_offset(loads: List[Tuple[int, int, int]], vaddr: int) -> int:
+    "Translates a virtual address into a file offset using the PT_LOAD segments"
+    for p_offset, p_vaddr, p_filesz in loads:
+        if p_vaddr <= vaddr < p_vaddr + p_filesz:
+            return vaddr - p_vaddr + p_offset
+
+    raise ValueError(f"virtual address {hex(vaddr)} is not mapped by any segment")
+
+
+def parse_elf_dynamic_info(data: Union[bytes, mmap.mmap]) -> Optional[ElfDynamicInfo]:
+    """Parses the dynamic section out of the raw (or memory-mapped) content of an ELF file.
+    Returns None if the content is not an ELF file."""
+    if len(data) < 16 or data[:4] != ELF_MAGIC:
+        return None
+
+    is_64 = data[4] == ELF_CLASS_64
+    endian = "<" if data[5] == ELF_DATA_LITTLE_ENDIAN else ">"
+    if is_64:
+        elf_type, _, _, _, phoff = struct.unpack_from(endian + "HHIQQ", data, 16)
+        phentsize, phnum = struct.unpack_from(endian + "HH", data, 54)
+        phdr_format, dyn_format = endian + "IIQQQQ", endian + "qQ"
+    else:
+        elf_type, _, _, _, phoff = struct.unpack_from(endian + "HHIII", data, 16)
+        phentsize, phnum = struct.unpack_from(endian + "HH", data, 42)
+        phdr_format, dyn_format = endian + "IIIIII", endian + "iI"
+
+    loads: List[Tuple[int, int, int]] = []
+    dynamic: Optional[Tuple[int, int]] = None
+    has_interpreter = False
+    for i in range(phnum):
+        fields = struct.unpack_from(phdr_format, data, phoff + i * phentsize)
+        if is_64:
+            p_type, _, p_offset, p_vaddr, _, p_filesz = fields
+        else:
+            p_type, p_offset, p_vaddr, _, p_filesz, _ = fields
+        if p_type == PT_LOAD:
+            loads.append((p_offset, p_vaddr, p_filesz))
+        elif p_type == PT_DYNAMIC:
+            dynamic = (p_offset, p_filesz)
+        elif p_type == PT_INTERP:
+            has_interpreter = True
+
+    if dynamic is None:
+        return ElfDynamicInfo(elf_type=elf_type, has_interpreter=has_interpreter)
+
+    entries: List[Tuple[int, int]] = []
+    dyn_offset, dyn_size = dynamic
+    dyn_entry_size = struct.calcsize(dyn_format)
+    for offset in range(dyn_offset, dyn_offset + dyn_size, dyn_entry_size):
+        tag, value = struct.unpack_from(dyn_format, data, offset)
+        if tag == DT_NULL:
+            break
+        entries.append((tag, value))
+
+    strtab_vaddr = next((value for tag, value in entries if tag == DT_STRTAB), None)
+    if strtab_vaddr is None:
+        return ElfDynamicInfo(elf_type=elf_type, has_interpreter=has_interpreter)
+
+    strtab = _vaddr_to_offset(loads, strtab_vaddr)
+    strings = {
+        tag: [
+            _read_c_string(data, strtab + value)
+            for entry_tag, value in entries
+            if entry_tag == tag
+        ]
+        for tag in (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH)
+    }
+
+    return ElfDynamicInfo(
+        elf_type=elf_type,
+        has_interpreter=has_interpreter,
+        needed=tuple(strings[DT_NEEDED]),
+        soname=next(iter(strings[DT_SONAME]), ""),
+        rpath=next(iter(strings[DT_RPATH]), ""),
+        runpath=next(iter(strings[DT_RUNPATH]), ""),
+    )
+
+
+def read_elf_dynamic_info(file: Path) -> Optional[ElfDynamicInfo]:
+    """Reads the dynamic section of an ELF file. Returns None if file is not an ELF file.
+    The file is memory-mapped, so only the pages holding the headers are actually read."""
+    try:
+        with file.open("rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return parse_elf_dynamic_info(data)
+    except (struct.error, ValueError, OSError):
+        # truncated or malformed ELF file
+        return None
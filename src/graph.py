@@ -0,0 +1,92 @@
+"""File containing graph algorithms over the resolved dependency graph."""
+
+from typing import Callable, Dict, Hashable, Iterable, List, Mapping, Set, TypeVar
+
+Node = TypeVar("Node", bound=Hashable)
+
+
+def get_strongly_connected_components(
+    graph: Mapping[Node, Iterable[Node]],
+    sort_key: Callable[[Node], str] = str,
+) -> List[List[Node]]:
+    """Returns the strongly connected components of graph using an iterative Tarjan's algorithm,
+    in linear time. A node's edges point to its deps, and the components are returned in a
+    topological order: every component comes after the components it depends on.
+    Nodes and edges are visited in sort_key order, which makes the result deterministic."""
+    index: Dict[Node, int] = {}
+    low_link: Dict[Node, int] = {}
+    on_stack: Dict[Node, bool] = {}
+    stack: List[Node] = []
+    components: List[List[Node]] = []
+    edges = {
+        node: sorted((dep for dep in deps if dep in graph), key=sort_key)
+        for node, deps in graph.items()
+    }
+
+    for root in sorted(graph, key=sort_key):
+        if root in index:
+            continue
+
+        # each frame holds a node and the position of the next edge to visit
+        call_stack = [(root, 0)]
+        index[root] = low_link[root] = len(index)
+        stack.append(root)
+        on_stack[root] = True
+        while call_stack:
+            node, edge = call_stack.pop()
+            if edge < len(edges[node]):
+                call_stack.append((node, edge + 1))
+                dep = edges[node][edge]
+                if dep not in index:
+                    index[dep] = low_link[dep] = len(index)
+                    stack.append(dep)
+                    on_stack[dep] = True
+                    call_stack.append((dep, 0))
+                elif on_stack[dep]:
+                    low_link[node] = min(low_link[node], index[dep])
+                continue
+
+            # all the edges of node are visited
+            if call_stack:
+                parent = call_stack[-1][0]
+                low_link[parent] = min(low_link[parent], low_link[node])
+
+            if low_link[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(sorted(component, key=sort_key))
+
+    return components
+
+
+def get_transitive_deps(
+    components: List[List[Node]], graph: Mapping[Node, Iterable[Node]]
+) -> List[List[Node]]:
+    """Returns the transitive deps of each of the components, given in a topological order,
+    without the members of the component itself. The deps are sorted in the topological order,
+    so that a result only depends on the graph, and not on the order the graph is processed in."""
+    component_of = {
+        node: i for i, component in enumerate(components) for node in component
+    }
+    position = {
+        node: k
+        for k, node in enumerate(node for component in components for node in component)
+    }
+    closures: List[Set[Node]] = []
+    for i, component in enumerate(components):
+        closure: Set[Node] = set()
+        dep_components = {
+            component_of[dep] for node in component for dep in graph[node]
+        }
+        for j in dep_components - {i}:
+            # depending on a member of a cycle is depending on all of them
+            closure.update(components[j])
+            closure.update(closures[j])
+        closures.append(closure)
+
+    return [sorted(closure, key=position.__getitem__) for closure in closures]
@@ -0,0 +1,82 @@
+"""File containing the input groups of a batch run, which share their modules through views."""
+
+from pathlib import Path
+from typing import Dict, Final, Iterable, Optional, Set, Tuple
+
+import re
+
+from src.module import get_module_name
+from src.modularize_package import DEBUG_SUFFIX, LAYER_SUFFIX, LAYERS
+from src.package import Package, PackageMetadata
+from src.writers import link_or_copy, read_http_archives, write_http_archives
+
+GROUPS_DIR: Final = Path("groups")
+GROUP_NAME_PATTERN: Final = re.compile(r"^[A-Za-z0-9_.-]+$")
+MODULE_ARCHIVE_SUFFIXES: Final = (
+    ".tar.gz",
+    DEBUG_SUFFIX + ".tar.gz",
+    *(f".{layer}{LAYER_SUFFIX}.tar.gz" for layer in LAYERS),
+)
+
+
+def parse_input_file(value: str) -> Tuple[str, Path]:
+    """Splits an input file option of the form [group=]path into the group name and the path.
+    Input files that are not part of a group get an empty group name."""
+    name, separator, path = value.partition("=")
+    if separator and GROUP_NAME_PATTERN.match(name):
+        return name, Path(path)
+
+    return "", Path(value)
+
+
+def get_group_archives_file(archives_file: Path, name: str) -> Path:
+    return archives_file.with_name(f"{name}_{archives_file.name}")
+
+
+def _write_group_view(
+    view_dir: Path, packages: Iterable[Package], modules_path: Path
+) -> None:
+    "Hardlinks the archives of packages into view_dir, dropping the ones of previous runs"
+    archives: Dict[str, Path] = {}
+    for package in packages:
+        for suffix in MODULE_ARCHIVE_SUFFIXES:
+            archive = modules_path / (package.prefix_version + suffix)
+            if archive.exists():
+                archives[archive.name] = archive
+
+    view_dir.mkdir(parents=True, exist_ok=True)
+    for archive in view_dir.glob("*.tar.gz"):
+        if archive.name not in archives:
+            archive.unlink()
+    for name, archive in sorted(archives.items()):
+        link_or_copy(archive, view_dir / name)
+
+
+def write_group_views(
+    group_closures: Dict[str, Set[PackageMetadata]],
+    processed_packages: Dict[PackageMetadata, Package],
+    modules_path: Path,
+    archives_file: Optional[Path] = None,
+) -> None:
+    """Gives each group its own modules path under modules_path/groups/<name>, made of
+    hardlinks to the shared module archives of its closure. In detached mode, each group also
+    gets its own <name>_<archives_file> with only the http_archives of its closure."""
+    shared_http_archives = read_http_archives(archives_file) if archives_file else {}
+    for name, closure in sorted(group_closures.items()):
+        packages = [processed_packages[metadata] for metadata in closure]
+        _write_group_view(modules_path / GROUPS_DIR / name, packages, modules_path)
+        if not archives_file:
+            continue
+
+        module_names = {
+            get_module_name(name=package.name, arch=package.arch)
+            for package in packages
+        }
+        write_http_archives(
+            get_group_archives_file(archives_file, name),
+            {
+                module_name: http_archive
+                for module_name, http_archive in shared_http_archives.items()
+                if module_name in module_names
+            },
+        )
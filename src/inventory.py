@@ -0,0 +1,146 @@
+"""File containing the inventory index of modules_path, and the garbage collection of the
+artifacts that are not referenced anymore."""
+
+from pathlib import Path
+from typing import Any, Dict, Final, Iterable, List, Optional, Set
+
+import datetime
+import json
+import threading
+
+from src.lockfile import read_lockfile
+from src.modularize_package import DEBUG_SUFFIX, MANIFEST_SUFFIX, get_layer_tars
+from src.package import Package, PackageMetadata
+from src.writers import write_json_lines
+
+INVENTORY_FILE: Final = Path("bazelize.inventory.jsonl")
+
+
+def get_run_id() -> str:
+    "Runs are identified by the UTC time they started at"
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def _get_package_artifacts(package: Package, modules_path: Path) -> List[Path]:
+    "Returns the files written into modules_path for package"
+    artifacts = [
+        modules_path / (package.prefix_version + ".tar.gz"),
+        modules_path / (package.prefix_version + MANIFEST_SUFFIX),
+        modules_path / (package.prefix_version + DEBUG_SUFFIX + ".tar.gz"),
+    ] + get_layer_tars(package, modules_path)
+
+    return [artifact for artifact in artifacts if artifact.exists()]
+
+
+def read_inventory(modules_path: Path) -> Dict[str, Dict[str, Any]]:
+    """Returns the inventory entries of modules_path by artifact file name.
+    The index is only ever appended to, so the last entry of an artifact wins."""
+    file = modules_path / INVENTORY_FILE
+    if not file.exists():
+        return {}
+
+    entries: Dict[str, Dict[str, Any]] = {}
+    for line in file.read_text().splitlines():
+        if line:
+            entry = json.loads(line)
+            entries[entry["file"]] = entry
+
+    return entries
+
+
+def _write_inventory(modules_path: Path, entries: Iterable[Dict[str, Any]]):
+    write_json_lines(
+        modules_path / INVENTORY_FILE,
+        sorted(entries, key=lambda entry: entry["file"]),
+    )
+
+
+class Inventory:
+    """Indexes the artifacts of the packages written by a run, as soon as they are written.
+    Each artifact is mapped to its module, version, size and the last run referencing it."""
+
+    def __init__(self, modules_path: Path, run_id: Optional[str] = None):
+        self.modules_path = modules_path
+        self.run_id = run_id or get_run_id()
+        self.recorded = 0
+        self._lock = threading.Lock()
+
+    def record(self, package: Package):
+        "Appends the artifacts of package, already written into modules_path, to the index"
+        lines = [
+            json.dumps(
+                {
+                    "file": artifact.name,
+                    "module": package.module_name,
+                    "pinned_name": package.pinned_name,
+                    "version": package.version,
+                    "size": artifact.stat().st_size,
+                    "last_run": self.run_id,
+                },
+                sort_keys=True,
+            )
+            + "\n"
+            for artifact in _get_package_artifacts(package, self.modules_path)
+        ]
+        with self._lock:
+            self.modules_path.mkdir(parents=True, exist_ok=True)
+            with (self.modules_path / INVENTORY_FILE).open("a") as f:
+                f.writelines(lines)
+            self.recorded += len(lines)
+
+    def close(self):
+        "Compacts the index down to the last entry of every artifact"
+        with self._lock:
+            _write_inventory(
+                self.modules_path, read_inventory(self.modules_path).values()
+            )
+
+
+def merge_inventories(modules_paths: Iterable[Path], modules_path: Path):
+    "Combines the inventories of the shards of a run into the one of modules_path"
+    _write_inventory(
+        modules_path,
+        {
+            file: entry
+            for shard_path in modules_paths
+            for file, entry in read_inventory(shard_path).items()
+        }.values(),
+    )
+
+
+def get_referenced_packages(
+    lockfiles: Iterable[Path], input_package_metadatas: Iterable[PackageMetadata]
+) -> Set[str]:
+    "Returns the pinned names of the packages locked by lockfiles, or listed as inputs"
+    referenced = {
+        pinned_name for lockfile in lockfiles for pinned_name in read_lockfile(lockfile)
+    }
+    referenced.update(
+        f"{metadata.name}:{metadata.arch}={metadata.version}"
+        for metadata in input_package_metadatas
+    )
+
+    return referenced
+
+
+def collect_garbage(
+    modules_path: Path, referenced: Set[str], dry_run: bool = False
+) -> List[Dict[str, Any]]:
+    """Removes the indexed artifacts of modules_path whose package is not referenced, and
+    drops them from the index. Artifacts that are not indexed are never removed. Returns the
+    entries of the removed artifacts, which are only listed if dry_run is set."""
+    entries = read_inventory(modules_path)
+    garbage = [
+        entry
+        for file, entry in sorted(entries.items())
+        if entry["pinned_name"] not in referenced
+    ]
+    if dry_run:
+        return garbage
+
+    for entry in garbage:
+        (modules_path / entry["file"]).unlink(missing_ok=True)
+        del entries[entry["file"]]
+    _write_inventory(modules_path, entries.values())
+
+    return garbage
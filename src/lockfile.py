@@ -0,0 +1,124 @@
+"""File containing the lockfile of a run, from which the detached BUILD files are refreshed."""
+
+from pathlib import Path
+from typing import Any, Dict, Final, Iterable, List
+
+import dataclasses
+import json
+
+from src.manifest import read_manifest
+from src.modularize_package import MANIFEST_SUFFIX
+from src.package import DetachedModeMetadata, Package, PackageMetadata
+from src.package_factory import init_deb_package
+from src.writers import (
+    json_dump,
+    write_build_file,
+    write_name_txt_file,
+    write_version_txt_file,
+)
+
+LOCKFILE: Final = Path("bazelize.lock.json")
+
+
+def _get_metadata_dicts(metadatas: Iterable[PackageMetadata]) -> List[Dict[str, str]]:
+    return sorted(
+        (dataclasses.asdict(metadata) for metadata in metadatas),
+        key=lambda metadata: (metadata["name"], metadata["arch"], metadata["version"]),
+    )
+
+
+def _get_lockfile_entry(package: Package) -> Dict[str, Any]:
+    "Everything the BUILD file of package needs that is not given on the command line"
+    return {
+        "name": package.name,
+        "arch": package.arch,
+        "version": package.version,
+        "deps": _get_metadata_dicts(package.deps),
+        "cycle_peers": _get_metadata_dicts(package.cycle_peers),
+        "manifest": package.prefix_version + MANIFEST_SUFFIX,
+        "elf_files": sorted(
+            package_file.path.as_posix()
+            for package_file in package.files
+            if package_file.is_elf
+        ),
+    }
+
+
+def read_lockfile(file: Path) -> Dict[str, Dict[str, Any]]:
+    "Returns the lockfile entries by pinned name"
+    if not file.exists():
+        return {}
+
+    return json.loads(file.read_text())["packages"]
+
+
+def write_lockfile(file: Path, packages: Iterable[Package]):
+    "Locks the packages modularized by a run, replacing the ones of previous runs"
+    json_dump(
+        file,
+        {
+            "packages": {
+                package.pinned_name: _get_lockfile_entry(package)
+                for package in packages
+            }
+        },
+    )
+
+
+def merge_lockfiles(files: Iterable[Path], file: Path):
+    "Combines the lockfiles of the shards of a run into file"
+    json_dump(
+        file,
+        {
+            "packages": {
+                pinned_name: entry
+                for lockfile in files
+                for pinned_name, entry in read_lockfile(lockfile).items()
+            }
+        },
+    )
+
+
+def refresh_build_files(
+    modules_path: Path,
+    detached_mode_metadata: DetachedModeMetadata,
+    delimiter: str = "~",
+    tags: Iterable[str] = [],
+    explicit_file_lists: bool = False,
+) -> List[Package]:
+    """Regenerates the detached BUILD, name.txt and version.txt files of the packages locked in
+    modules_path, with the given tags and file lists. Nothing is downloaded, and neither the
+    archives nor the archives file are touched. Returns the refreshed packages."""
+    lockfile = modules_path / LOCKFILE
+    if not lockfile.exists():
+        raise ValueError(
+            f"{lockfile} does not exist, the modules must be generated into {modules_path} first"
+        )
+
+    packages: List[Package] = []
+    for entry in read_lockfile(lockfile).values():
+        package = init_deb_package(
+            metadata=PackageMetadata(
+                name=entry["name"], arch=entry["arch"], version=entry["version"]
+            ),
+            delimiter=delimiter,
+            tags=tags,
+            detached_mode_metadata=detached_mode_metadata,
+            explicit_file_lists=explicit_file_lists,
+        )
+        package.deps = {PackageMetadata(**dep) for dep in entry["deps"]}
+        package.cycle_peers = {PackageMetadata(**peer) for peer in entry["cycle_peers"]}
+        if explicit_file_lists:
+            manifest_file = modules_path / entry["manifest"]
+            if not manifest_file.exists():
+                raise ValueError(
+                    f"{manifest_file} does not exist, the files of {package.pinned_name} can't be listed"
+                )
+            package.files = set(read_manifest(manifest_file, set(entry["elf_files"])))
+
+        write_build_file(package)
+        write_name_txt_file(package)
+        write_version_txt_file(package)
+        packages.append(package)
+
+    return packages
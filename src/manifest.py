@@ -0,0 +1,115 @@
+"""File containing the per module manifest of the shipped files."""
+
+from pathlib import Path
+from typing import Final, Iterable, List, Optional, Set
+
+import hashlib
+import os
+
+from src.elf import ELF_MAGIC, ET_DYN, ET_EXEC, ElfDynamicInfo, read_elf_dynamic_info
+from src.package import PackageFile
+
+MANIFEST_FILE: Final = Path("manifest.tsv")
+MANIFEST_HEADER: Final = "# path\tsize\tsha256\tmode\telf_kind\n"
+HASH_CHUNK_SIZE: Final = 1 << 20
+ELF_KIND_EXEC: Final = "exec"
+ELF_KIND_SHARED_LIB: Final = "shared_lib"
+ELF_KIND_OBJECT: Final = "object"
+ELF_KIND_NON_ELF: Final = "non_elf"
+
+
+def get_elf_kind(elf_info: Optional[ElfDynamicInfo]) -> str:
+    "PIE executables are ET_DYN like shared libs, but they request an interpreter"
+    if elf_info is None:
+        return ELF_KIND_NON_ELF
+    if elf_info.elf_type == ET_EXEC or (
+        elf_info.elf_type == ET_DYN and elf_info.has_interpreter
+    ):
+        return ELF_KIND_EXEC
+    if elf_info.elf_type == ET_DYN:
+        return ELF_KIND_SHARED_LIB
+
+    return ELF_KIND_OBJECT
+
+
+def scan_file(file: Path, path: Path, hash_elf_file: bool = True) -> PackageFile:
+    """Returns the manifest entry of file, listed as path. The content is hashed in a single
+    read, the ELF headers are then parsed from the memory-mapped file only if the content
+    starts with the ELF magic. Unless hash_elf_file is set, ELF files are not hashed, since
+    patching rewrites them: only their magic and headers are read."""
+    sha256 = hashlib.sha256()
+    try:
+        with file.open("rb") as f:
+            magic = f.read(len(ELF_MAGIC))
+            stat = os.fstat(f.fileno())
+            mode = stat.st_mode & 0o7777
+            if magic == ELF_MAGIC and not hash_elf_file:
+                return PackageFile(
+                    path=path,
+                    is_elf=False,
+                    size=stat.st_size,
+                    mode=mode,
+                    elf_kind=get_elf_kind(read_elf_dynamic_info(file)),
+                )
+
+            sha256.update(magic)
+            size = len(magic)
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+                size += len(chunk)
+    except PermissionError:
+        # like patchelf, unreadable files are treated as non-ELF files
+        stat = file.stat()
+        return PackageFile(
+            path=path,
+            is_elf=False,
+            size=stat.st_size,
+            mode=stat.st_mode & 0o7777,
+            elf_kind=ELF_KIND_NON_ELF,
+        )
+
+    return PackageFile(
+        path=path,
+        is_elf=False,
+        size=size,
+        sha256=sha256.hexdigest(),
+        mode=mode,
+        elf_kind=get_elf_kind(read_elf_dynamic_info(file))
+        if magic == ELF_MAGIC
+        else ELF_KIND_NON_ELF,
+    )
+
+
+def get_manifest_content(files: Iterable[PackageFile]) -> str:
+    "One tab separated line per file, sorted by path"
+    return MANIFEST_HEADER + "".join(
+        f"{file.path.as_posix()}\t{file.size}\t{file.sha256}\t{file.mode:04o}\t{file.elf_kind}\n"
+        for file in sorted(files, key=lambda file: file.path.as_posix())
+    )
+
+
+def read_manifest(
+    manifest_file: Path, elf_files: Optional[Set[str]] = None
+) -> List[PackageFile]:
+    """Reads a manifest back. The patchable ELF files are elf_files if provided, otherwise the
+    executables and shared libs."""
+    files: List[PackageFile] = []
+    for line in manifest_file.read_text().splitlines():
+        if not line or line.startswith("#"):
+            continue
+
+        path, size, sha256, mode, elf_kind = line.split("\t")
+        files.append(
+            PackageFile(
+                path=Path(path),
+                is_elf=path in elf_files
+                if elf_files is not None
+                else elf_kind in {ELF_KIND_EXEC, ELF_KIND_SHARED_LIB},
+                size=int(size),
+                sha256=sha256,
+                mode=int(mode, 8),
+                elf_kind=elf_kind,
+            )
+        )
+
+    return files
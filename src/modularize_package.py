@@ -1,14 +1,31 @@
-from typing import Dict, Final, Set
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Final, List, Optional, Set
 from pathlib import Path
 
+import dataclasses
+import gzip
+import hashlib
 import os
 import subprocess
 import tarfile
 import shutil
 
+from src.elf import read_elf_dynamic_info
+from src.manifest import MANIFEST_FILE, scan_file
 from src.module import Module
-from src.package import Package, PackageMetadata
+from src.package import (
+    Package,
+    PackageFile,
+    PackageMetadata,
+    RegistryMetadata,
+    StripMetadata,
+)
+from src.profiler import profiled_per_package
+from src.timings import timed_stage
 from src.writers import (
+    MODULE_DOT_BAZEL,
+    RPATHS_DOT_JSON,
+    WORKSPACE_FILE,
     write_build_file,
     write_module_file,
     write_python_path_file,
@@ -17,13 +34,27 @@ from src.writers import (
     write_http_archive,
     write_name_txt_file,
     write_version_txt_file,
+    write_registry_module,
+    write_manifest_file,
+    write_layered_archive,
+    get_generated_files,
+    get_integrity_from_digest,
+    is_shared_library,
 )
 
-RPATHS_DOT_JSON: Final = Path("rpaths.json")
 UPLOAD_BUCKET: Final = "upload_bucket"
 UPLOAD_URL: Final = "upload_url"
 PREFIX: Final = "prefix"
 DOWNLOAD_URL: Final = "download_url"
+# --strip-unneeded rather than --strip-all, so that shared libs keep the symbols needed for relocation
+STRIP_FLAGS: Final = {"debug": "--strip-debug", "all": "--strip-unneeded"}
+DEBUG_SUFFIX: Final = ".debug"
+MANIFEST_SUFFIX: Final = ".manifest.tsv"
+LAYER_SUFFIX: Final = ".layer"
+# the generated files change with every version, the others only with their content
+LAYERS: Final = ("module", "data", "libs", "bins")
+# the mtime of all archive members, honoring https://reproducible-builds.org/specs/source-date-epoch/
+SOURCE_DATE_EPOCH: Final = int(os.environ.get("SOURCE_DATE_EPOCH", "0"))
 
 
 def _get_dep_rpath_set(rpaths: Set[str], prefix: str) -> Set[str]:
@@ -50,29 +81,355 @@ def _concatentate_rpaths(
     return rpath_set
 
 
-def _rpath_patch_elf_files(package: Package, modules: Dict[PackageMetadata, Module]):
-    for file in package.elf_files:
-        rpath_prefix = "$ORIGIN" + "..".join(["/"] * (os.fspath(file).count("/") + 2))
-        rpaths_set = _concatentate_rpaths(package, rpath_prefix, modules)
-        rpaths_set.add("$ORIGIN")
+def _get_rpath_prefix(file: Path) -> str:
+    "Returns the prefix leading from the directory of file to the root of the runfiles"
+    return "$ORIGIN" + "..".join(["/"] * (os.fspath(file).count("/") + 2))
+
+
+def _get_soname_index(
+    package: Package,
+    modules: Dict[PackageMetadata, Module],
+    soname_index: Dict[str, str],
+) -> Dict[str, str]:
+    """Maps sonames to their rpath directory. The package's own libs take precedence over
+    the libs of its direct deps, which take precedence over the rest of the graph."""
+    index = dict(soname_index)
+    for dep in package.deps:
+        if dep not in modules:
+            raise ValueError(
+                f"dependency: {dep.name} has not been processed. Dependencies must be processed in a topoligcal order"
+            )
+        index.update(modules[dep].rpaths)
+    index.update(package.rpaths)
+
+    return index
+
+
+def _get_needed_rpath_dirs(
+    package: Package, file: Path, soname_index: Dict[str, str]
+) -> Set[str]:
+    "Returns the rpath directories providing the DT_NEEDED libs of file"
+    elf_info = read_elf_dynamic_info(Path(package.package_dir / file))
+    if not elf_info:
+        return set()
+
+    # libs in the same directory are already covered by $ORIGIN
+    own_dir = os.fspath(package.prefix / file.parent)
+    return {
+        soname_index[needed]
+        for needed in elf_info.needed
+        if needed in soname_index and soname_index[needed] != own_dir
+    }
+
+
+def _get_elf_file_rpaths(
+    package: Package,
+    file: Path,
+    modules: Dict[PackageMetadata, Module],
+    soname_index: Optional[Dict[str, str]],
+    rpaths_per_prefix: Dict[str, str],
+) -> str:
+    rpath_prefix = _get_rpath_prefix(file)
+    if soname_index is not None:
+        dirs = _get_needed_rpath_dirs(package, file, soname_index)
+        return ":".join(["$ORIGIN"] + sorted(rpath_prefix + dir for dir in dirs))
+
+    # the rpaths of the deps only differ by their prefix, which only depends on the depth
+    if rpath_prefix not in rpaths_per_prefix:
+        rpaths_per_prefix[rpath_prefix] = ":".join(
+            ["$ORIGIN"] + sorted(_concatentate_rpaths(package, rpath_prefix, modules))
+        )
+    return rpaths_per_prefix[rpath_prefix]
+
+
+def _patch_rpath(file: Path, rpaths: str):
+    subprocess.run(
+        ["patchelf", "--force-rpath", "--set-rpath", rpaths, file],
+        check=True,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def _rpath_patch_elf_files(
+    package: Package,
+    modules: Dict[PackageMetadata, Module],
+    soname_index: Optional[Dict[str, str]] = None,
+    elf_workers: int = 1,
+):
+    """Patches the rpaths of the ELF files in package, up to elf_workers files concurrently.
+    If soname_index is provided, only the directories of the DT_NEEDED libs are set,
+    otherwise all the deps' rpaths are set."""
+    index = (
+        _get_soname_index(package, modules, soname_index)
+        if soname_index is not None
+        else None
+    )
+    rpaths_per_prefix: Dict[str, str] = {}
+    # symlinks are patched through their real file. Like in a serial patch in sorted order,
+    # the last path resolving to a real file decides its rpaths.
+    real_file_rpaths: Dict[Path, str] = {}
+    for file in sorted(package.elf_files):
+        real_file_rpaths[Path(package.package_dir / file).resolve()] = (
+            _get_elf_file_rpaths(package, file, modules, index, rpaths_per_prefix)
+        )
+
+    with ThreadPoolExecutor(max_workers=elf_workers) as executor:
+        # consume the results so that patching errors are raised
+        list(
+            executor.map(
+                _patch_rpath, real_file_rpaths.keys(), real_file_rpaths.values()
+            )
+        )
+
+
+def _normalize_tar_info(tar_info: tarfile.TarInfo) -> tarfile.TarInfo:
+    "Drops the metadata of the archive member that depends on the machine or the time"
+    tar_info.mtime = SOURCE_DATE_EPOCH
+    tar_info.uid = tar_info.gid = 0
+    tar_info.uname = tar_info.gname = ""
+    if tar_info.issym():
+        tar_info.mode = 0o777
+    elif tar_info.isdir() or tar_info.mode & 0o111:
+        tar_info.mode = 0o755
+    else:
+        tar_info.mode = 0o644
+
+    return tar_info
+
+
+def _add_sorted(tar: tarfile.TarFile, path: Path, arcname: str):
+    "Adds path to tar, then the content of the directory path in sorted order"
+    tar.add(path, arcname=arcname, recursive=False, filter=_normalize_tar_info)
+    if path.is_dir() and not path.is_symlink():
+        for child in sorted(path.iterdir(), key=lambda child: child.name):
+            _add_sorted(tar, child, f"{arcname}/{child.name}")
+
+
+def _write_reproducible_tar(fileobj, directory: Path, arcname: str):
+    """Writes directory as a .tar.gz into fileobj. The same content always gives the same
+    bytes: members are sorted, their metadata normalized and the gzip header is fixed."""
+    with gzip.GzipFile(
+        filename="", mode="wb", fileobj=fileobj, mtime=SOURCE_DATE_EPOCH
+    ) as gz:
+        with tarfile.open(fileobj=gz, mode="w", format=tarfile.GNU_FORMAT) as tar:
+            _add_sorted(tar, directory, arcname)
+
+
+def _write_reproducible_layer_tar(
+    fileobj, directory: Path, arcname: str, paths: List[Path]
+):
+    """Writes the paths of directory, and their parent directories, as a .tar.gz into fileobj.
+    Like _write_reproducible_tar, the same content always gives the same bytes."""
+    members = set(paths)
+    for path in paths:
+        members.update(path.parents)
+    with gzip.GzipFile(
+        filename="", mode="wb", fileobj=fileobj, mtime=SOURCE_DATE_EPOCH
+    ) as gz:
+        with tarfile.open(fileobj=gz, mode="w", format=tarfile.GNU_FORMAT) as tar:
+            # sorting by parts gives the depth first order of _add_sorted
+            for member in sorted(members, key=lambda member: member.parts):
+                tar.add(
+                    directory / member,
+                    arcname="/".join((arcname,) + member.parts),
+                    recursive=False,
+                    filter=_normalize_tar_info,
+                )
+
+
+def _get_layer_paths(package: Package) -> Dict[str, List[Path]]:
+    """Splits the content of package into the layers, like the libs, bins and data filegroups.
+    Empty directories are part of the data layer. Empty layers are left out."""
+    generated_files = set(get_generated_files(package))
+    elf_files = {
+        package_file.path for package_file in package.files if package_file.is_elf
+    }
+    layer_paths: Dict[str, List[Path]] = {}
+    for root, dirs, files in os.walk(package.package_dir):
+        root_path = Path(root).relative_to(package.package_dir)
+        # symlinks to directories are not walked into, they are members like files
+        leaf_dirs = [
+            name
+            for name in dirs
+            if os.path.islink(os.path.join(root, name))
+            or not os.listdir(os.path.join(root, name))
+        ]
+        for name in files + leaf_dirs:
+            path = root_path / name
+            if path.as_posix() in generated_files:
+                layer = "module"
+            elif path not in elf_files:
+                layer = "data"
+            elif is_shared_library(path):
+                layer = "libs"
+            else:
+                layer = "bins"
+            layer_paths.setdefault(layer, []).append(path)
+
+    return {layer: layer_paths[layer] for layer in LAYERS if layer in layer_paths}
+
+
+def get_layer_tar(package: Package, modules_path: Path, layer: str) -> Path:
+    "Returns the path of the layer archive of package, like <module>.libs.layer.tar.gz"
+    return modules_path / f"{package.prefix_version}.{layer}{LAYER_SUFFIX}.tar.gz"
+
+
+def get_layer_tars(package: Package, modules_path: Path) -> List[Path]:
+    "Returns the layer archives of package in modules_path, empty if it is not layered"
+    return [
+        get_layer_tar(package, modules_path, layer)
+        for layer in LAYERS
+        if get_layer_tar(package, modules_path, layer).exists()
+    ]
+
+
+def _write_layers(package: Package, modules_path: Path) -> List[Path]:
+    """Tars the layers of package into modules_path, and stitches them together in the
+    archives file. A layer whose content did not change keeps the same bytes and integrity."""
+    modules_path.mkdir(exist_ok=True, parents=True)
+    layer_tars: List[Path] = []
+    integrities: List[str] = []
+    for layer in LAYERS:
+        get_layer_tar(package, modules_path, layer).unlink(missing_ok=True)
+    for layer, paths in _get_layer_paths(package).items():
+        layer_tar = get_layer_tar(package, modules_path, layer)
+        with layer_tar.open("wb") as f:
+            hashing_writer = _HashingWriter(f)
+            _write_reproducible_layer_tar(
+                hashing_writer,
+                package.package_dir,
+                package.package_dir.relative_to(Path(".").resolve()).as_posix(),
+                paths,
+            )
+        layer_tars.append(layer_tar)
+        integrities.append(get_integrity_from_digest(hashing_writer.sha256.digest()))
+    write_layered_archive(package, layer_tars, integrities)
+
+    return layer_tars
+
+
+def _is_layered(package: Package) -> bool:
+    return bool(
+        package.detached_mode_metadata
+        and package.detached_mode_metadata.layered_archives
+    )
+
+
+def _rescan_elf_files(package: Package, elf_workers: int = 1):
+    "Patching and stripping rewrite the ELF files, so their manifest entries are updated"
+    elf_package_files = [
+        package_file for package_file in package.files if package_file.is_elf
+    ]
+
+    def rescan(package_file: PackageFile) -> PackageFile:
+        return dataclasses.replace(
+            scan_file(package.package_dir / package_file.path, package_file.path),
+            is_elf=True,
+        )
+
+    with ThreadPoolExecutor(max_workers=elf_workers) as executor:
+        rescanned_files = list(executor.map(rescan, elf_package_files))
+
+    package.files.difference_update(elf_package_files)
+    package.files.update(rescanned_files)
+
+
+def _get_debug_dir(package: Package) -> Path:
+    "Returns the directory holding the debug info stripped out of package"
+    return package.package_dir.parent / (package.prefix + DEBUG_SUFFIX)
+
+
+def _strip_elf_file(file: Path, mode: str, debug_file: Optional[Path]):
+    if debug_file:
+        debug_file.parent.mkdir(parents=True, exist_ok=True)
         subprocess.run(
-            [
-                "patchelf",
-                "--force-rpath",
-                "--set-rpath",
-                ":".join(rpaths_set),
-                Path(package.package_dir / file),
-            ],
+            ["objcopy", "--only-keep-debug", file, debug_file],
             check=True,
-            stderr=subprocess.STDOUT,
+            capture_output=True,
+        )
+    subprocess.run(
+        ["strip", STRIP_FLAGS[mode], file],
+        check=True,
+        capture_output=True,
+    )
+    if debug_file:
+        # lets debuggers find the sidecar file once it is extracted next to file
+        subprocess.run(
+            ["objcopy", f"--add-gnu-debuglink={debug_file}", file],
+            check=True,
+            capture_output=True,
+        )
+
+
+def _strip_elf_files(
+    package: Package, strip_metadata: StripMetadata, elf_workers: int = 1
+):
+    """Strips the ELF files in package, up to elf_workers files concurrently.
+    If strip_metadata.debug_sidecar is set, the debug info is kept in the debug dir first."""
+    debug_dir = _get_debug_dir(package)
+    # symlinks are stripped through their real file, only once
+    real_files: Dict[Path, Optional[Path]] = {}
+    for file in sorted(package.elf_files):
+        real_file = Path(package.package_dir / file).resolve()
+        # absolute symlinks may point to the host's files, those are left untouched
+        if package.package_dir not in real_file.parents:
+            continue
+        real_files[real_file] = (
+            debug_dir
+            / (real_file.relative_to(package.package_dir).as_posix() + DEBUG_SUFFIX)
+            if strip_metadata.debug_sidecar
+            else None
         )
 
+    with ThreadPoolExecutor(max_workers=elf_workers) as executor:
+        # consume the results so that stripping errors are raised
+        list(
+            executor.map(
+                _strip_elf_file,
+                real_files.keys(),
+                [strip_metadata.mode] * len(real_files),
+                real_files.values(),
+            )
+        )
+
+
+def _write_debug_sidecar(package: Package, modules_path: Path) -> Optional[Path]:
+    "Tars the stripped debug info of package next to its module archive"
+    debug_dir = _get_debug_dir(package)
+    if not debug_dir.is_dir():
+        return None
+
+    modules_path.mkdir(exist_ok=True, parents=True)
+    debug_tar = modules_path / (package.prefix_version + DEBUG_SUFFIX + ".tar.gz")
+    with debug_tar.open("wb") as f:
+        _write_reproducible_tar(f, debug_dir, package.prefix)
+    shutil.rmtree(debug_dir)
+
+    return debug_tar
+
+
+class _HashingWriter:
+    "Write-only file wrapper computing the sha256 of the written content on the fly"
+
+    def __init__(self, file):
+        self._file = file
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
 
-def _repackage_deb_package(package: Package) -> Path:
+
+def _repackage_deb_package(
+    package: Package, registry_metadata: Optional[RegistryMetadata] = None
+) -> Path:
     # create empty WORKSPACE file
-    Path(package.package_dir / Path("WORKSPACE")).touch()
+    Path(package.package_dir / WORKSPACE_FILE).touch()
     write_build_file(package)
-    write_module_file(package)
+    module_file_content = write_module_file(package)
     write_python_path_file(
         package.rpaths, package.package_dir / Path(package.module_name + "_paths.py")
     )
@@ -84,22 +441,152 @@ def _repackage_deb_package(package: Package) -> Path:
     json_dump(package.package_dir / RPATHS_DOT_JSON, package.rpaths)
     write_version_txt_file(package)
     write_name_txt_file(package)
+    write_manifest_file(package.files, package.package_dir / MANIFEST_FILE)
     debian_module_tar = Path(package.prefix_version + ".tar.gz")
-    # repackage Debian Module as a tarball.
-    with tarfile.open(debian_module_tar, "w:gz") as tar:
-        tar.add(package.package_dir.relative_to(Path(".").resolve()))
-    write_http_archive(package, debian_module_tar)
+    # repackage Debian Module as a reproducible tarball, hashing it while it is written.
+    with debian_module_tar.open("wb") as f:
+        hashing_writer = _HashingWriter(f)
+        _write_reproducible_tar(
+            hashing_writer,
+            package.package_dir,
+            package.package_dir.relative_to(Path(".").resolve()).as_posix(),
+        )
+    integrity = get_integrity_from_digest(hashing_writer.sha256.digest())
+    if not _is_layered(package):
+        write_http_archive(package, debian_module_tar, integrity)
+    if registry_metadata:
+        write_registry_module(
+            registry_metadata=registry_metadata,
+            package=package,
+            module_file_content=module_file_content,
+            integrity=integrity,
+            debian_module_tar=debian_module_tar,
+        )
 
     return debian_module_tar
 
 
-def modularize_package(
-    package: Package, modules: Dict[PackageMetadata, Module], modules_path: Path
+@profiled_per_package
+@timed_stage("patch")
+def patch_package(
+    package: Package,
+    modules: Dict[PackageMetadata, Module],
+    soname_index: Optional[Dict[str, str]] = None,
+    elf_workers: int = 1,
+    strip_metadata: Optional[StripMetadata] = None,
 ):
-    """Turns package into a module."""
-    _rpath_patch_elf_files(package=package, modules=modules)
-    module_tar = _repackage_deb_package(package)
+    """Patches the rpaths of the ELF files of package, the deps must be in modules already.
+    If strip_metadata is provided, the ELF files are stripped after being patched."""
+    _rpath_patch_elf_files(
+        package=package,
+        modules=modules,
+        soname_index=soname_index,
+        elf_workers=elf_workers,
+    )
+    if strip_metadata:
+        _strip_elf_files(package, strip_metadata, elf_workers=elf_workers)
+    _rescan_elf_files(package, elf_workers=elf_workers)
+
+
+@profiled_per_package
+@timed_stage("package")
+def package_module(
+    package: Package,
+    modules_path: Path,
+    registry_metadata: Optional[RegistryMetadata] = None,
+) -> Path:
+    """Writes the module files of an already patched package, then tars it into modules_path.
+    The manifest of the module is also written next to its archive.
+    The debug info stripped out of package, if kept, gets its own tarball in modules_path.
+    In layered mode, the layer archives are also written into modules_path, and the archives
+    file refers to them instead of the module archive."""
+    module_tar = _repackage_deb_package(package, registry_metadata)
     modules_path.mkdir(exist_ok=True, parents=True)
     shutil.copy(module_tar, modules_path / module_tar.name)
+    # lets tools find which module ships a file without opening the archives
+    write_manifest_file(
+        package.files,
+        modules_path / (package.prefix_version + MANIFEST_SUFFIX),
+    )
+    _write_debug_sidecar(package, modules_path)
+    if _is_layered(package):
+        _write_layers(package, modules_path)
 
     module_tar.unlink()
+
+    return modules_path / module_tar.name
+
+
+def _read_module_file_content(package: Package, module_tar: Path) -> str:
+    with tarfile.open(module_tar) as tar:
+        member = tar.extractfile(f"{package.prefix}/{MODULE_DOT_BAZEL}")
+        if member is None:
+            raise ValueError(f"{module_tar} does not contain a {MODULE_DOT_BAZEL} file")
+        return member.read().decode("utf-8")
+
+
+def register_module(
+    package: Package,
+    module_tar: Path,
+    registry_metadata: Optional[RegistryMetadata] = None,
+):
+    """Writes what refers to an already packaged module from outside of its archive: the
+    detached BUILD, name.txt and version.txt files, the http_archive and the registry entry.
+    In layered mode, the layer archives must be next to module_tar.
+    Used for the modules fetched from the module cache, which are not packaged again."""
+    if package.detached_mode_metadata:
+        write_build_file(package)
+    write_version_txt_file(package)
+    write_name_txt_file(package)
+    integrity = get_integrity_from_digest(
+        hashlib.sha256(module_tar.read_bytes()).digest()
+    )
+    if _is_layered(package):
+        layer_tars = get_layer_tars(package, module_tar.parent)
+        write_layered_archive(
+            package,
+            layer_tars,
+            [
+                get_integrity_from_digest(
+                    hashlib.sha256(layer_tar.read_bytes()).digest()
+                )
+                for layer_tar in layer_tars
+            ],
+        )
+    else:
+        write_http_archive(package, Path(module_tar.name), integrity)
+    if registry_metadata:
+        write_registry_module(
+            registry_metadata=registry_metadata,
+            package=package,
+            module_file_content=_read_module_file_content(package, module_tar),
+            integrity=integrity,
+            debian_module_tar=Path(module_tar.name),
+        )
+
+
+def modularize_package(
+    package: Package,
+    modules: Dict[PackageMetadata, Module],
+    modules_path: Path,
+    soname_index: Optional[Dict[str, str]] = None,
+    registry_metadata: Optional[RegistryMetadata] = None,
+    elf_workers: int = 1,
+    strip_metadata: Optional[StripMetadata] = None,
+) -> Path:
+    """Turns package into a module and returns the path of its archive in modules_path.
+    If soname_index is provided, ELF files only get the rpaths of the libs they need.
+    If registry_metadata is provided, the module is also added to a local bazel registry.
+    Up to elf_workers ELF files are rpath patched concurrently.
+    If strip_metadata is provided, the ELF files are stripped after being patched."""
+    patch_package(
+        package=package,
+        modules=modules,
+        soname_index=soname_index,
+        elf_workers=elf_workers,
+        strip_metadata=strip_metadata,
+    )
+
+    return package_module(
+        package=package, modules_path=modules_path, registry_metadata=registry_metadata
+    )
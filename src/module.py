@@ -1,7 +1,10 @@
 from typing import Dict
 import dataclasses
+import functools
 
 
+# the same deps are named in the MODULE.bazel and BUILD files of every package depending on them
+@functools.lru_cache(maxsize=None)
 def get_module_name(name: str, arch: str):
     """Architecture is appended to the module name to accommodate for the case of debian packages
     having the same name and different achitectures since there is no arch attribute in module().
@@ -26,6 +29,7 @@ def get_module_name(name: str, arch: str):
     return module_name
 
 
+@functools.lru_cache(maxsize=None)
 def get_module_version(version: str):
     """Debian versions have all sort of characters.
     This gets rid of the bazel unallowed version characters."""
@@ -0,0 +1,359 @@
+"""File containing the shared module cache, keyed by the fingerprint of the module inputs."""
+
+from pathlib import Path
+from typing import Any, Dict, Final, Iterable, List, Optional, Set
+
+import abc
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import urllib.parse
+
+from src.manifest import read_manifest
+from src.modularize_package import (
+    DEBUG_SUFFIX,
+    LAYER_SUFFIX,
+    LAYERS,
+    MANIFEST_SUFFIX,
+    SOURCE_DATE_EPOCH,
+    get_layer_tar,
+    register_module,
+)
+from src.package import (
+    DetachedModeMetadata,
+    Package,
+    PackageMetadata,
+    RegistryMetadata,
+    StripMetadata,
+)
+from src.package_factory import init_deb_package
+from src.upload import DEFAULT_TIMEOUT, HttpConnectionPool
+
+MODULE_DOT_JSON: Final = "module.json"
+MODULE_TAR: Final = "module.tar.gz"
+DEBUG_TAR: Final = "debug.tar.gz"
+MANIFEST_TSV: Final = "manifest.tsv"
+
+
+def _get_layer_tar_name(layer: str) -> str:
+    return f"{layer}{LAYER_SUFFIX}.tar.gz"
+
+
+@functools.lru_cache(maxsize=None)
+def get_tool_version() -> str:
+    "Any change to the bazelizer sources invalidates the cached modules"
+    sha256 = hashlib.sha256()
+    for source in sorted(Path(__file__).parent.glob("*.py")):
+        sha256.update(source.name.encode("utf-8") + b"\0" + source.read_bytes())
+
+    return sha256.hexdigest()
+
+
+def _get_hash(obj: Any) -> str:
+    return hashlib.sha256(
+        json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def _get_metadata_key(metadata: PackageMetadata) -> str:
+    return f"{metadata.name}:{metadata.arch}={metadata.version}"
+
+
+def get_fingerprints(
+    components: List[List[PackageMetadata]],
+    resolved_graph: Dict[PackageMetadata, Set[PackageMetadata]],
+    delimiter: str = "~",
+    tags: Iterable[str] = [],
+    detached: bool = False,
+    explicit_file_lists: bool = False,
+    minimal_rpaths: bool = False,
+    strip_metadata: Optional[StripMetadata] = None,
+    layered_archives: bool = False,
+) -> Dict[PackageMetadata, str]:
+    """Fingerprints the inputs of every package of the graph, whose components are given in a
+    topological order. The members of a cycle patch against each other's rpaths, so they share
+    the fingerprint of their component, made of their metadata and of the fingerprints of the
+    deps outside of the component."""
+    options = {
+        "tool_version": get_tool_version(),
+        "source_date_epoch": SOURCE_DATE_EPOCH,
+        "delimiter": delimiter,
+        "tags": sorted(tags),
+        "detached": detached,
+        "explicit_file_lists": explicit_file_lists,
+        "minimal_rpaths": minimal_rpaths,
+        "strip": dataclasses.asdict(strip_metadata) if strip_metadata else None,
+        "layered_archives": layered_archives,
+    }
+    fingerprints: Dict[PackageMetadata, str] = {}
+    for component in components:
+        members = set(component)
+        component_fingerprint = _get_hash(
+            {
+                "options": options,
+                "members": sorted(_get_metadata_key(metadata) for metadata in members),
+                "deps": sorted(
+                    {
+                        fingerprints[dep]
+                        for metadata in component
+                        for dep in resolved_graph[metadata]
+                        if dep not in members
+                    }
+                ),
+            }
+        )
+        for metadata in component:
+            fingerprints[metadata] = _get_hash(
+                [component_fingerprint, _get_metadata_key(metadata)]
+            )
+
+    return fingerprints
+
+
+class ModuleCache(abc.ABC):
+    """Stores the module archives and their metadata under their fingerprint.
+    Backends only have to fetch and store single files."""
+
+    def __init__(self):
+        # pinned names of the fetched and stored modules
+        self.hits: List[str] = []
+        self.stored: List[str] = []
+
+    @abc.abstractmethod
+    def _fetch_file(self, fingerprint: str, name: str, destination: Path) -> bool:
+        "Fetches the file name of the module into destination, returns False on a miss"
+
+    @abc.abstractmethod
+    def _store_file(self, fingerprint: str, name: str, source: Path) -> None:
+        "Stores source as the file name of the module"
+
+    def close(self) -> None:
+        pass
+
+    def fetch_module(
+        self, fingerprint: str, package: Package, modules_path: Path
+    ) -> Optional[Dict[str, Any]]:
+        """Fetches the archive, the manifest, the debug sidecar and the layers, if any, of a
+        cached module into modules_path. Returns its metadata, or None on a miss."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            module_json = Path(temp_dir) / MODULE_DOT_JSON
+            if not self._fetch_file(fingerprint, MODULE_DOT_JSON, module_json):
+                return None
+            entry = json.loads(module_json.read_text())
+
+        modules_path.mkdir(parents=True, exist_ok=True)
+        prefix_version = package.prefix_version
+        files = [
+            (MODULE_TAR, modules_path / (prefix_version + ".tar.gz")),
+            (MANIFEST_TSV, modules_path / (prefix_version + MANIFEST_SUFFIX)),
+        ]
+        if entry["debug_sidecar"]:
+            files.append(
+                (DEBUG_TAR, modules_path / (prefix_version + DEBUG_SUFFIX + ".tar.gz"))
+            )
+        # the layers of previous runs are dropped, like when the layers are written
+        for layer in LAYERS:
+            get_layer_tar(package, modules_path, layer).unlink(missing_ok=True)
+        for layer in entry["layers"]:
+            files.append(
+                (
+                    _get_layer_tar_name(layer),
+                    get_layer_tar(package, modules_path, layer),
+                )
+            )
+        for name, destination in files:
+            if not self._fetch_file(fingerprint, name, destination):
+                return None
+
+        return entry
+
+    def store_module(self, fingerprint: str, package: Package, modules_path: Path):
+        """Stores the module of package, already packaged into modules_path.
+        module.json is stored last, so that only complete modules are ever fetched."""
+        debug_tar = modules_path / (package.prefix_version + DEBUG_SUFFIX + ".tar.gz")
+        self._store_file(
+            fingerprint, MODULE_TAR, modules_path / (package.prefix_version + ".tar.gz")
+        )
+        self._store_file(
+            fingerprint,
+            MANIFEST_TSV,
+            modules_path / (package.prefix_version + MANIFEST_SUFFIX),
+        )
+        if debug_tar.exists():
+            self._store_file(fingerprint, DEBUG_TAR, debug_tar)
+        layers: List[str] = []
+        for layer in LAYERS:
+            layer_tar = get_layer_tar(package, modules_path, layer)
+            if layer_tar.exists():
+                self._store_file(fingerprint, _get_layer_tar_name(layer), layer_tar)
+                layers.append(layer)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            module_json = Path(temp_dir) / MODULE_DOT_JSON
+            module_json.write_text(
+                json.dumps(
+                    {
+                        "rpaths": package.rpaths,
+                        "elf_files": sorted(
+                            elf_file.as_posix() for elf_file in package.elf_files
+                        ),
+                        "debug_sidecar": debug_tar.exists(),
+                        "layers": layers,
+                    },
+                    indent=4,
+                    sort_keys=True,
+                )
+            )
+            self._store_file(fingerprint, MODULE_DOT_JSON, module_json)
+        self.stored.append(package.pinned_name)
+
+
+class LocalDirectoryModuleCache(ModuleCache):
+    """Module cache in a directory, like one on a shared file system."""
+
+    def __init__(self, directory: Path):
+        super().__init__()
+        self.directory = directory
+
+    def _fetch_file(self, fingerprint: str, name: str, destination: Path) -> bool:
+        source = self.directory / fingerprint[:2] / fingerprint / name
+        if not source.exists():
+            return False
+
+        # copied rather than hardlinked, the modules path is written to in place
+        shutil.copyfile(source, destination)
+        return True
+
+    def _store_file(self, fingerprint: str, name: str, source: Path) -> None:
+        destination = self.directory / fingerprint[:2] / fingerprint / name
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        # concurrent writers of the same module write the same content, the last rename wins
+        fd, temp_file = tempfile.mkstemp(dir=destination.parent, prefix=f".{name}.")
+        os.close(fd)
+        try:
+            shutil.copyfile(source, temp_file)
+            os.replace(temp_file, destination)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.unlink(temp_file)
+            raise
+
+
+class HttpModuleCache(ModuleCache):
+    """Module cache behind an HTTP server, files are fetched with GET and stored with PUT."""
+
+    def __init__(self, url: str, timeout: float = DEFAULT_TIMEOUT):
+        super().__init__()
+        self._pool = HttpConnectionPool(url, timeout=timeout)
+
+    def _get_path(self, fingerprint: str, name: str) -> str:
+        return f"{self._pool.url.path.rstrip('/')}/{fingerprint[:2]}/{fingerprint}/{urllib.parse.quote(name)}"
+
+    def _fetch_file(self, fingerprint: str, name: str, destination: Path) -> bool:
+        # streamed into a temporary file, renamed once complete
+        fd, temp_file = tempfile.mkstemp(dir=destination.parent, prefix=f".{name}.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                status, _, _ = self._pool.request(
+                    "GET", self._get_path(fingerprint, name), output=f
+                )
+            if status == 404:
+                os.unlink(temp_file)
+                return False
+            if status != 200:
+                raise ValueError(
+                    f"fetching {name} of {fingerprint} from the module cache failed with status {status}"
+                )
+
+            os.replace(temp_file, destination)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.unlink(temp_file)
+            raise
+
+        return True
+
+    def _store_file(self, fingerprint: str, name: str, source: Path) -> None:
+        with source.open("rb") as f:
+            status, _, _ = self._pool.request(
+                "PUT",
+                self._get_path(fingerprint, name),
+                body=f,
+                headers={"Content-Length": str(source.stat().st_size)},
+            )
+        if status not in {200, 201, 204}:
+            raise ValueError(
+                f"storing {name} of {fingerprint} in the module cache failed with status {status}"
+            )
+
+    def close(self) -> None:
+        self._pool.close()
+
+
+def get_module_cache(location: str) -> ModuleCache:
+    "http(s) urls are served by an HTTP server, anything else is a local directory"
+    if urllib.parse.urlsplit(location).scheme in {"http", "https"}:
+        return HttpModuleCache(location)
+
+    return LocalDirectoryModuleCache(Path(location))
+
+
+def fetch_cached_packages(
+    module_cache: ModuleCache,
+    components: List[List[PackageMetadata]],
+    resolved_graph: Dict[PackageMetadata, Set[PackageMetadata]],
+    fingerprints: Dict[PackageMetadata, str],
+    modules_path: Path,
+    delimiter: str = "~",
+    tags: Iterable[str] = [],
+    detached_mode_metadata: Optional[DetachedModeMetadata] = None,
+    explicit_file_lists: bool = False,
+    registry_metadata: Optional[RegistryMetadata] = None,
+) -> Dict[PackageMetadata, Package]:
+    """Fetches the cached modules of the components into modules_path, and registers them like
+    freshly packaged ones. A component is only fetched if all its members are cached, since they
+    are patched together. Returns the fetched packages, in a topological order."""
+    cached_packages: Dict[PackageMetadata, Package] = {}
+    for component in components:
+        packages: List[Package] = []
+        entries: List[Dict[str, Any]] = []
+        for metadata in component:
+            package = init_deb_package(
+                metadata=metadata,
+                delimiter=delimiter,
+                tags=tags,
+                detached_mode_metadata=detached_mode_metadata,
+                explicit_file_lists=explicit_file_lists,
+            )
+            entry = module_cache.fetch_module(
+                fingerprints[metadata], package, modules_path
+            )
+            if entry is None:
+                break
+            packages.append(package)
+            entries.append(entry)
+        else:
+            for metadata, package, entry in zip(component, packages, entries):
+                package.deps = set(resolved_graph[metadata])
+                package.cycle_peers = set(component) - {metadata}
+                package.rpaths = entry["rpaths"]
+                package.elf_files = {Path(elf_file) for elf_file in entry["elf_files"]}
+                package.files = set(
+                    read_manifest(
+                        modules_path / (package.prefix_version + MANIFEST_SUFFIX),
+                        set(entry["elf_files"]),
+                    )
+                )
+                register_module(
+                    package,
+                    modules_path / (package.prefix_version + ".tar.gz"),
+                    registry_metadata,
+                )
+                cached_packages[metadata] = package
+                module_cache.hits.append(package.pinned_name)
+
+    return cached_packages
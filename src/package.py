@@ -1,4 +1,4 @@
-from typing import Dict, Optional, Set
+from typing import Dict, Optional, Set, Tuple
 from pathlib import Path
 import dataclasses
 
@@ -12,6 +12,30 @@ class DetachedModeMetadata:
     build_file_package: str
     archives_file: Path
     build_files_dir: Path
+    # if set, each module is split into layer archives, stitched by a layered_archive
+    layered_archives: bool = False
+
+
+@dataclasses.dataclass(frozen=True)
+class RegistryMetadata:
+    registry_dir: Path
+    url_prefix: str
+
+
+@dataclasses.dataclass(frozen=True)
+class ShardMetadata:
+    # 1-based, like in --shard K/N
+    index: int
+    count: int
+    # shared by all the shards, to exchange the rpaths of their modules
+    shard_dir: Path
+
+
+@dataclasses.dataclass(frozen=True)
+class StripMetadata:
+    # either "debug" or "all"
+    mode: str
+    debug_sidecar: bool = False
 
 
 @dataclasses.dataclass(frozen=True)
@@ -21,12 +45,30 @@ class PackageMetadata:
     version: str
 
 
+@dataclasses.dataclass(frozen=True)
+class PackageRelation:
+    """A dependency as listed in the Depends field, like: dep:any (>= 0.1) [amd64]
+    Unversioned dependencies have an empty operator and version."""
+
+    name: str
+    operator: str
+    version: str
+    # the arch qualifier, like any or amd64. Empty if there is none
+    arch: str = ""
+    arch_restrictions: Tuple[str, ...] = ()
+
+
 @dataclasses.dataclass(frozen=True)
 class PackageFile:
     """File class that contains path of the file and whether or not it is ELF"""
 
     path: Path
     is_elf: bool
+    # the manifest entry of the file, see src/manifest.py
+    size: int = 0
+    sha256: str = ""
+    mode: int = 0
+    elf_kind: str = ""
 
 
 @dataclasses.dataclass()
@@ -43,8 +85,11 @@ class Package:
     compatibility_level: int = 0
     package_dir: Path = Path()
     deps: Set[PackageMetadata] = dataclasses.field(default_factory=set)
+    # the other packages of the dependency cycle (strongly connected component) of the package
+    cycle_peers: Set[PackageMetadata] = dataclasses.field(default_factory=set)
     files: Set[PackageFile] = dataclasses.field(default_factory=set)
     elf_files: Set[Path] = dataclasses.field(default_factory=set)
     rpaths: Dict[str, str] = dataclasses.field(default_factory=dict)
     tags: Set[str] = dataclasses.field(default_factory=set)
     detached_mode_metadata: Optional[DetachedModeMetadata] = None
+    explicit_file_lists: bool = False
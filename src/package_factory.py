@@ -1,14 +1,33 @@
-from typing import Final, Iterable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Final, Iterable, List, Optional, Set
 from pathlib import Path
 
+import dataclasses
+import functools
 import os
 import subprocess
 
-from src.version import get_package_version, get_compatibility_level
+from src.deb_source import LocalDebSource
+from src.manifest import scan_file
+from src.version import (
+    get_compatibility_level,
+    get_package_version,
+    has_package_version,
+)
 from src.module import get_module_name
-from src.package import PackageMetadata, Package, DetachedModeMetadata
+from src.package import (
+    PackageMetadata,
+    Package,
+    PackageFile,
+    PackageRelation,
+    DetachedModeMetadata,
+)
+from src.profiler import profiled_per_package
+from src.timings import timed_stage
+from src.relations import get_package_relations, get_relation_arch
 
 DEPENDS_ATTR: Final = "Depends"
+INSTALLED_SIZE_ATTR: Final = "Installed-Size"
 
 
 def _get_http_archive_prefix(delimiter: str) -> str:
@@ -59,6 +78,39 @@ def _is_patchable_elf_file(file: Path) -> bool:
         raise error
 
 
+def _scan_real_file(file: Path) -> PackageFile:
+    """Classifies file, then tells if it is patchable. Patchable ELF files are only hashed once
+    patched, the ELF files patchelf can't handle are hashed here."""
+    package_file = scan_file(file, path=file, hash_elf_file=False)
+    if _is_patchable_elf_file(file):
+        return dataclasses.replace(package_file, is_elf=True)
+    if not package_file.sha256:
+        package_file = scan_file(file, path=file)
+
+    return package_file
+
+
+def _scan_package_files(
+    package_dir: Path, file_paths: List[Path], elf_workers: int = 1
+) -> List[PackageFile]:
+    """Returns the manifest entry of each file, telling if it is a patchable ELF file.
+    Up to elf_workers files are scanned concurrently. Files resolving to the same real file
+    (symlinks) are only scanned once, so no file is patched by two threads at the same time."""
+    real_files: Dict[Path, Path] = {
+        file_path: Path(package_dir / file_path).resolve() for file_path in file_paths
+    }
+    unique_real_files = list(dict.fromkeys(real_files.values()))
+    with ThreadPoolExecutor(max_workers=elf_workers) as executor:
+        scanned_files = dict(
+            zip(unique_real_files, executor.map(_scan_real_file, unique_real_files))
+        )
+
+    return [
+        dataclasses.replace(scanned_files[real_files[file_path]], path=file_path)
+        for file_path in file_paths
+    ]
+
+
 def _get_deb_pinned_name(name: str, arch: str = "", version: str = ""):
     package = name
     if arch:
@@ -91,6 +143,14 @@ def _download_package_dot_debian(
     )
 
 
+def _remove_downloaded_archive(
+    archive_path: Path, deb_source: Optional[LocalDebSource] = None
+):
+    "Archives of the local mirror are read in place and must be kept."
+    if not deb_source:
+        archive_path.unlink()
+
+
 def _extract_attribute(
     package_info: str, attribute: str, must_exist: bool = True
 ) -> str:
@@ -111,71 +171,116 @@ def _extract_attribute(
     )
 
 
-def _get_package_deps(archive_path: Path, arch: str):
-    deps_str = _extract_attribute(
+def _get_deps_str(
+    metadata: PackageMetadata,
+    archive_path: Path,
+    deb_source: Optional[LocalDebSource] = None,
+) -> str:
+    "Returns the Depends field of the package, from the local index if any, otherwise from the archive."
+    if deb_source:
+        return deb_source.get_entry(metadata).depends
+
+    return _extract_attribute(
         subprocess.check_output(["dpkg-deb", "-I", archive_path], encoding="utf-8"),
         DEPENDS_ATTR,
         False,
     )
 
-    deps = set()
-    if not deps_str:
-        return deps
-
-    # TODO: use a lib that does the parsing for you. I was too lazy to leave the code and search =D
-    polluted_deps = deps_str.split(", ")
-    for dep_name in polluted_deps:
-        # imagine a case where the following is returned: debconf (>= 0.5) | debconf-2.0,
-        # we want the left hand side, since it is not a virtual dep. The way to do that, is to search for brackets
-        # not too smart but works for now :)
-        alternative_deps = dep_name.split(" | ")
-        dep_name = alternative_deps[0]
-        for alternative_dep in alternative_deps:
-            if "(" in alternative_deps and ")" in alternative_deps:
-                dep_name = alternative_dep
-                break
-
-        # with the not-so-clever check above, we may still end up with something like: dep-1.0
-        # for now we ignore deps without version spec.
-        if "(" not in dep_name:
-            continue
 
-        # now it is of the pattern dep (>= 0.1)
-        dep_name, version_spec = dep_name.split(maxsplit=1)
-        dep_name = dep_name.split(":")[0]
-        is_strict_version = (
-            "=" in version_spec
-            and ">=" not in version_spec
-            and "<=" not in version_spec
-            and "~= " not in version_spec
-        )
+def get_control_deps_str(
+    metadata: PackageMetadata, deb_source: Optional[LocalDebSource] = None
+) -> str:
+    "Returns the Depends field of the package from the local index or apt-cache, without downloading it."
+    if deb_source:
+        return deb_source.get_entry(metadata).depends
+
+    return _extract_attribute(
+        subprocess.check_output(
+            [
+                "apt-cache",
+                "show",
+                _get_deb_pinned_name(
+                    name=metadata.name, arch=metadata.arch, version=metadata.version
+                ),
+            ],
+            encoding="utf-8",
+        ),
+        DEPENDS_ATTR,
+        False,
+    )
 
-        # Another workaround: tzdata accesses files from system, it needs more investigation to handle it properly.
-        # TODO: find a general way to handle deps accessing files from system.
-        if dep_name == "tzdata":
-            continue
 
-        dep_version = (
-            get_package_version(
-                name=dep_name,
-                arch=arch,
-            )
-            if not is_strict_version
-            else version_spec.split()[1][:-1]
-        )
+def get_installed_size(
+    metadata: PackageMetadata, deb_source: Optional[LocalDebSource] = None
+) -> int:
+    "Returns the Installed-Size field of the package in KiB, 0 if unknown, without downloading it."
+    if deb_source:
+        return deb_source.get_entry(metadata).installed_size
+
+    installed_size = _extract_attribute(
+        subprocess.check_output(
+            [
+                "apt-cache",
+                "show",
+                _get_deb_pinned_name(
+                    name=metadata.name, arch=metadata.arch, version=metadata.version
+                ),
+            ],
+            encoding="utf-8",
+        ),
+        INSTALLED_SIZE_ATTR,
+        False,
+    )
+    return int(installed_size) if installed_size.isdigit() else 0
 
-        deps.add(PackageMetadata(name=dep_name, arch=arch, version=dep_version))
 
-    return deps
+def get_requested_version(
+    relation: PackageRelation, arch: str, deb_source: Optional[LocalDebSource] = None
+) -> str:
+    "Strict relations request their version, the others request the candidate version."
+    if relation.operator == "=":
+        return relation.version
+    if deb_source:
+        return deb_source.get_package_version(name=relation.name, arch=arch)
+    return get_package_version(name=relation.name, arch=arch)
+
+
+def is_real_package(
+    name: str, arch: str, deb_source: Optional[LocalDebSource] = None
+) -> bool:
+    "Tells if name is a real package rather than a purely virtual one, provided by others."
+    if deb_source:
+        return deb_source.is_real_package(name=name, arch=arch)
+    return has_package_version(name=name, arch=arch)
+
+
+def _get_package_deps(
+    deps_str: str, arch: str, deb_source: Optional[LocalDebSource] = None
+):
+    return {
+        PackageMetadata(
+            name=relation.name,
+            arch=get_relation_arch(relation, arch),
+            version=get_requested_version(
+                relation, get_relation_arch(relation, arch), deb_source
+            ),
+        )
+        for relation in get_package_relations(
+            deps_str,
+            arch,
+            is_real_package=functools.partial(is_real_package, deb_source=deb_source),
+        )
+    }
 
 
-def create_deb_package(
+def init_deb_package(
     metadata: PackageMetadata,
     delimiter: str = "~",
     tags: Iterable[str] = [],
     detached_mode_metadata: Optional[DetachedModeMetadata] = None,
+    explicit_file_lists: bool = False,
 ) -> Package:
-    """Factory function to create deb packages."""
+    """Creates a deb package holding everything that is known before downloading it."""
     if not metadata.name or not metadata.arch or not metadata.version:
         raise ValueError(
             f"name, arch and version must all be provided and not empty, in order to create a debian package. Provided values are: name={metadata.name}, version={metadata.version}, arch={metadata.arch}"
@@ -195,14 +300,47 @@ def create_deb_package(
     package.compatibility_level = get_compatibility_level(metadata.version)
     package.tags = set(f'"{tag}"' for tag in tags)
     package.detached_mode_metadata = detached_mode_metadata
-    # path to package.deb
-    archive_path = _download_package_dot_debian(
-        name=metadata.name,
-        arch=metadata.arch,
-        version=metadata.version,
+    package.explicit_file_lists = explicit_file_lists
+
+    return package
+
+
+@profiled_per_package
+@timed_stage("download")
+def download_deb_package(
+    package: Package, deb_source: Optional[LocalDebSource] = None
+) -> Path:
+    """Returns the path to package.deb, downloaded with apt or read from the local mirror."""
+    if deb_source:
+        return deb_source.get_archive(
+            PackageMetadata(
+                name=package.name, arch=package.arch, version=package.version
+            )
+        )
+
+    return _download_package_dot_debian(
+        name=package.name,
+        arch=package.arch,
+        version=package.version,
         pinned_name=package.pinned_name,
     )
-    package_dir = archive_path.parent / Path(package.prefix)
+
+
+@profiled_per_package
+@timed_stage("extract")
+def extract_deb_package(
+    package: Package,
+    archive_path: Path,
+    deb_source: Optional[LocalDebSource] = None,
+    elf_workers: int = 1,
+    deps: Optional[Set[PackageMetadata]] = None,
+) -> Package:
+    """Extracts the archive of package, then fills its files, ELF files, rpaths and deps.
+    The downloaded archive is removed afterwards."""
+    metadata = PackageMetadata(
+        name=package.name, arch=package.arch, version=package.version
+    )
+    package_dir = Path.cwd() / Path(package.prefix)
     package_dir.mkdir(exist_ok=True)
     package.package_dir = package_dir.resolve()
     # the following fills the files-related attributes of the deb package
@@ -212,6 +350,7 @@ def create_deb_package(
         stderr=subprocess.STDOUT,
     )
 
+    file_paths: List[Path] = []
     for file in files_str.split("\n"):
         # the ":" part is a workaround some files having unacceptable names for bazel targets
         if ":" in file:
@@ -221,21 +360,63 @@ def create_deb_package(
         if not Path(package.package_dir / file_path).is_file():
             continue
 
-        if not _is_patchable_elf_file(Path(package.package_dir / file_path)):
+        file_paths.append(file_path)
+
+    # results are registered in the listing order, exactly like a serial scan would
+    for package_file in _scan_package_files(
+        package.package_dir, file_paths, elf_workers=elf_workers
+    ):
+        package.files.add(package_file)
+        if not package_file.is_elf:
             continue
 
+        file_path = package_file.path
         package.elf_files.add(file_path)
         # register the parent of the ELF file as an rpath
         package.rpaths[file_path.name] = os.fspath(package.prefix / file_path.parent)
 
-    # The next check is needed since libc6 is cyclic with libcrypt1.
-    # I assume libc6 does not have deps in this case :D
-    if package.name == "libc6":
-        archive_path.unlink()
-        return package
-
     # now fillup the transitive deps
-    package.deps = _get_package_deps(archive_path=archive_path, arch=package.arch)
-    archive_path.unlink()
+    package.deps = (
+        set(deps)
+        if deps is not None
+        else _get_package_deps(
+            deps_str=_get_deps_str(metadata, archive_path, deb_source),
+            arch=package.arch,
+            deb_source=deb_source,
+        )
+    )
+    _remove_downloaded_archive(archive_path, deb_source)
 
     return package
+
+
+def create_deb_package(
+    metadata: PackageMetadata,
+    delimiter: str = "~",
+    tags: Iterable[str] = [],
+    detached_mode_metadata: Optional[DetachedModeMetadata] = None,
+    explicit_file_lists: bool = False,
+    deb_source: Optional[LocalDebSource] = None,
+    elf_workers: int = 1,
+    deps: Optional[Set[PackageMetadata]] = None,
+) -> Package:
+    """Factory function to create deb packages.
+    If deb_source is provided, the archive is read from the local mirror instead of apt.
+    If deps is provided, the already resolved deps are used instead of the archive's Depends.
+    Up to elf_workers files are classified as ELF or non-ELF concurrently."""
+    package = init_deb_package(
+        metadata=metadata,
+        delimiter=delimiter,
+        tags=tags,
+        detached_mode_metadata=detached_mode_metadata,
+        explicit_file_lists=explicit_file_lists,
+    )
+    archive_path = download_deb_package(package, deb_source)
+
+    return extract_deb_package(
+        package=package,
+        archive_path=archive_path,
+        deb_source=deb_source,
+        elf_workers=elf_workers,
+        deps=deps,
+    )
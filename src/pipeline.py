@@ -0,0 +1,404 @@
+"""File containing the pipelined bazelization: packages are downloaded, extracted, patched
+and packaged by concurrent stages connected with bounded queues."""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+import asyncio
+import dataclasses
+import itertools
+import math
+
+from src.deb_source import LocalDebSource
+from src.graph import get_transitive_deps
+from src.inventory import Inventory
+from src.modularize_package import get_layer_tars, package_module, patch_package
+from src.module import Module
+from src.package import (
+    DetachedModeMetadata,
+    Package,
+    PackageMetadata,
+    RegistryMetadata,
+    StripMetadata,
+)
+from src.package_factory import (
+    download_deb_package,
+    extract_deb_package,
+    init_deb_package,
+)
+from src.upload import ArchiveUploader
+
+STAGES = ("download", "extract", "patch", "package")
+
+
+@dataclasses.dataclass(frozen=True)
+class StageLimits:
+    """The number of concurrent workers of each stage, and the size of the bounded queues
+    between download and extract, and between patch and package."""
+
+    download: int = 4
+    extract: int = 2
+    patch: int = 2
+    package: int = 1
+    queue_size: int = 8
+
+
+def parse_stage_limits(spec: str) -> StageLimits:
+    """Parses a comma separated list of stage=count, e.g. "download=8,extract=4".
+    queue_size can be set the same way, the unset values keep their default."""
+    values: Dict[str, int] = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key not in STAGES and key != "queue_size":
+            raise ValueError(
+                f"Unknown pipeline stage: {key}. Stage must be one of {', '.join(STAGES)} or queue_size"
+            )
+        if not value.strip().isdigit() or int(value) < 1:
+            raise ValueError(
+                f"The value of {key} must be a positive integer, got: {value.strip()}"
+            )
+        values[key] = int(value)
+
+    return StageLimits(**values)
+
+
+@dataclasses.dataclass
+class _ComponentState:
+    members: List[PackageMetadata]
+    dep_components: Set[int]
+    # the components depending on this one
+    dependents: List[int] = dataclasses.field(default_factory=list)
+    remaining_extractions: int = 0
+    remaining_patches: int = 0
+    unpatched_deps: int = 0
+
+
+def _get_component_states(
+    components: List[List[PackageMetadata]],
+    resolved_graph: Dict[PackageMetadata, Set[PackageMetadata]],
+) -> List[_ComponentState]:
+    component_of = {
+        metadata: i for i, component in enumerate(components) for metadata in component
+    }
+    states: List[_ComponentState] = []
+    for i, component in enumerate(components):
+        dep_components = {
+            component_of[dep]
+            for metadata in component
+            for dep in resolved_graph[metadata]
+        } - {i}
+        states.append(
+            _ComponentState(
+                members=component,
+                dep_components=dep_components,
+                remaining_extractions=len(component),
+                remaining_patches=len(component),
+                unpatched_deps=len(dep_components),
+            )
+        )
+
+    for i, state in enumerate(states):
+        for j in state.dep_components:
+            states[j].dependents.append(i)
+
+    return states
+
+
+def _get_component_ranks(
+    states: List[_ComponentState], costs: List[float]
+) -> List[float]:
+    """Returns the cost of the longest chain of components starting at each component, which is
+    what is left of the run once it starts. Deps never rank below their dependents."""
+    ranks: List[float] = [0.0] * len(states)
+    for i in reversed(range(len(states))):
+        ranks[i] = costs[i] + max((ranks[j] for j in states[i].dependents), default=0.0)
+
+    return ranks
+
+
+async def _run_stages(stages: Iterable[Awaitable[Any]]) -> None:
+    "Runs the stages concurrently, the first failure cancels the others and is raised"
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    for task in done:
+        if not task.cancelled() and task.exception():
+            raise task.exception()  # type: ignore[misc]
+
+
+async def _run_workers(
+    count: int,
+    worker: Callable[[], Awaitable[None]],
+    next_queue: "Optional[asyncio.Queue]" = None,
+    next_count: int = 0,
+) -> None:
+    "Runs count workers, then tells the workers of the next stage that no more items will come"
+    await asyncio.gather(*(worker() for _ in range(count)))
+    if next_queue is not None:
+        for _ in range(next_count):
+            await next_queue.put(None)
+
+
+async def _bazelize_pipelined(
+    components: List[List[PackageMetadata]],
+    resolved_graph: Dict[PackageMetadata, Set[PackageMetadata]],
+    modules_path: Path,
+    delimiter: str,
+    tags: Iterable[str],
+    detached_mode_metadata: Optional[DetachedModeMetadata],
+    explicit_file_lists: bool,
+    minimal_rpaths: bool,
+    uploader: Optional[ArchiveUploader],
+    inventory: Optional[Inventory],
+    deb_source: Optional[LocalDebSource],
+    registry_metadata: Optional[RegistryMetadata],
+    elf_workers: int,
+    stage_limits: StageLimits,
+    strip_metadata: Optional[StripMetadata],
+    executor: ThreadPoolExecutor,
+    get_cost: Callable[[PackageMetadata], float],
+) -> Dict[PackageMetadata, Package]:
+    loop = asyncio.get_running_loop()
+    states = _get_component_states(components, resolved_graph)
+    transitive_deps = get_transitive_deps(components, resolved_graph)
+    component_of = {
+        metadata: i for i, component in enumerate(components) for metadata in component
+    }
+    ranks = _get_component_ranks(
+        states,
+        [sum(get_cost(metadata) for metadata in component) for component in components],
+    )
+    processed_packages: Dict[PackageMetadata, Package] = {}
+    modules: Dict[PackageMetadata, Module] = {}
+    remaining_patches = sum(len(component) for component in components)
+
+    # the archives are fetched by decreasing rank, which is a topological order too, so that the
+    # deps are patchable first and the longest chains of packages start first
+    download_queue: "asyncio.Queue[Optional[PackageMetadata]]" = asyncio.Queue()
+    for i in sorted(range(len(components)), key=lambda i: (-ranks[i], i)):
+        for metadata in components[i]:
+            download_queue.put_nowait(metadata)
+    for _ in range(stage_limits.download):
+        download_queue.put_nowait(None)
+    extract_queue: asyncio.Queue = asyncio.Queue(maxsize=stage_limits.queue_size)
+    # a component waits for its deps to be patched, so this queue must not block the
+    # extract and patch workers feeding it. The ready packages are patched by decreasing rank,
+    # then cost, the end of the run marker last.
+    patch_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+    patch_order = itertools.count()
+    package_queue: asyncio.Queue = asyncio.Queue(maxsize=stage_limits.queue_size)
+
+    def schedule_if_ready(i: int):
+        state = states[i]
+        if state.remaining_extractions or state.unpatched_deps:
+            return
+
+        # the rpaths of a package are known as soon as it is extracted, so the members of a
+        # cycle can see each other's rpaths before any of them is patched
+        for metadata in state.members:
+            package = processed_packages[metadata]
+            package.cycle_peers = set(state.members) - {metadata}
+            modules[metadata] = Module(
+                name=package.name,
+                arch=package.arch,
+                version=package.version,
+                rpaths=package.rpaths,
+            )
+
+        soname_index: Optional[Dict[str, str]] = None
+        if minimal_rpaths:
+            soname_index = {}
+            for dep in transitive_deps[i]:
+                soname_index.update(processed_packages[dep].rpaths)
+
+        for metadata in state.members:
+            patch_queue.put_nowait(
+                (
+                    (-ranks[i], -get_cost(metadata)),
+                    next(patch_order),
+                    (processed_packages[metadata], soname_index),
+                )
+            )
+
+    async def download_worker():
+        while True:
+            metadata = await download_queue.get()
+            if metadata is None:
+                return
+
+            package = init_deb_package(
+                metadata=metadata,
+                delimiter=delimiter,
+                tags=tags,
+                detached_mode_metadata=detached_mode_metadata,
+                explicit_file_lists=explicit_file_lists,
+            )
+            archive_path = await loop.run_in_executor(
+                executor, download_deb_package, package, deb_source
+            )
+            await extract_queue.put((package, archive_path))
+
+    async def extract_worker():
+        while True:
+            item = await extract_queue.get()
+            if item is None:
+                return
+
+            package, archive_path = item
+            metadata = PackageMetadata(
+                name=package.name, arch=package.arch, version=package.version
+            )
+            await loop.run_in_executor(
+                executor,
+                lambda: extract_deb_package(
+                    package=package,
+                    archive_path=archive_path,
+                    deb_source=deb_source,
+                    elf_workers=elf_workers,
+                    deps=resolved_graph[metadata],
+                ),
+            )
+            processed_packages[metadata] = package
+            i = component_of[metadata]
+            states[i].remaining_extractions -= 1
+            schedule_if_ready(i)
+
+    async def patch_worker():
+        nonlocal remaining_patches
+        if not remaining_patches:
+            return
+
+        while True:
+            _, _, item = await patch_queue.get()
+            if item is None:
+                return
+
+            package, soname_index = item
+            await loop.run_in_executor(
+                executor,
+                lambda: patch_package(
+                    package=package,
+                    modules=modules,
+                    soname_index=soname_index,
+                    elf_workers=elf_workers,
+                    strip_metadata=strip_metadata,
+                ),
+            )
+            await package_queue.put(package)
+
+            i = component_of[
+                PackageMetadata(
+                    name=package.name, arch=package.arch, version=package.version
+                )
+            ]
+            states[i].remaining_patches -= 1
+            if not states[i].remaining_patches:
+                for j in states[i].dependents:
+                    states[j].unpatched_deps -= 1
+                    schedule_if_ready(j)
+
+            remaining_patches -= 1
+            if not remaining_patches:
+                for _ in range(stage_limits.patch):
+                    patch_queue.put_nowait(
+                        ((math.inf, math.inf), next(patch_order), None)
+                    )
+
+    async def package_worker():
+        while True:
+            package = await package_queue.get()
+            if package is None:
+                return
+
+            module_archive = await loop.run_in_executor(
+                executor, package_module, package, modules_path, registry_metadata
+            )
+            if uploader:
+                uploader.submit(module_archive)
+                for layer_tar in get_layer_tars(package, modules_path):
+                    uploader.submit(layer_tar)
+            if inventory:
+                inventory.record(package)
+
+    await _run_stages(
+        [
+            _run_workers(
+                stage_limits.download,
+                download_worker,
+                extract_queue,
+                stage_limits.extract,
+            ),
+            _run_workers(stage_limits.extract, extract_worker),
+            _run_workers(
+                stage_limits.patch,
+                patch_worker,
+                package_queue,
+                stage_limits.package,
+            ),
+            _run_workers(stage_limits.package, package_worker),
+        ]
+    )
+
+    return processed_packages
+
+
+def bazelize_pipelined(
+    components: List[List[PackageMetadata]],
+    resolved_graph: Dict[PackageMetadata, Set[PackageMetadata]],
+    modules_path: Path,
+    delimiter: str = "~",
+    tags: Iterable[str] = [],
+    detached_mode_metadata: Optional[DetachedModeMetadata] = None,
+    explicit_file_lists: bool = False,
+    minimal_rpaths: bool = False,
+    uploader: Optional[ArchiveUploader] = None,
+    inventory: Optional[Inventory] = None,
+    deb_source: Optional[LocalDebSource] = None,
+    registry_metadata: Optional[RegistryMetadata] = None,
+    elf_workers: int = 1,
+    stage_limits: StageLimits = StageLimits(),
+    strip_metadata: Optional[StripMetadata] = None,
+    get_cost: Callable[[PackageMetadata], float] = lambda _: 1.0,
+) -> Dict[PackageMetadata, Package]:
+    """Modularizes the strongly connected components of the resolved graph, given in a
+    topological order, with the download, extract, patch and package stages overlapping.
+    A component is patched once all its members are extracted and all the components it
+    depends on are patched. The packages heading the longest chains of estimated cost, given
+    by get_cost, start first. Returns the processed packages."""
+    executor = ThreadPoolExecutor(
+        max_workers=sum(getattr(stage_limits, stage) for stage in STAGES),
+        thread_name_prefix="pipeline",
+    )
+    try:
+        return asyncio.run(
+            _bazelize_pipelined(
+                components=components,
+                resolved_graph=resolved_graph,
+                modules_path=modules_path,
+                delimiter=delimiter,
+                tags=tags,
+                detached_mode_metadata=detached_mode_metadata,
+                explicit_file_lists=explicit_file_lists,
+                minimal_rpaths=minimal_rpaths,
+                uploader=uploader,
+                inventory=inventory,
+                deb_source=deb_source,
+                registry_metadata=registry_metadata,
+                elf_workers=elf_workers,
+                stage_limits=stage_limits,
+                strip_metadata=strip_metadata,
+                executor=executor,
+                get_cost=get_cost,
+            )
+        )
+    finally:
+        executor.shutdown(wait=True)
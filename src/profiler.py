@@ -0,0 +1,175 @@
+"""File containing the optional profiler of a run, broken down per package."""
+
+from pathlib import Path
+from typing import Any, Callable, Dict, Final, List, Optional, TypeVar
+
+import cProfile
+import collections
+import contextlib
+import functools
+import os
+import pstats
+import re
+import sys
+import threading
+
+PSTATS_FILE: Final = Path("bazelize.pstats")
+COLLAPSED_STACKS_FILE: Final = Path("bazelize.collapsed")
+PACKAGES_DIR: Final = Path("packages")
+RUN_LABEL: Final = "<run>"
+DEFAULT_SAMPLE_INTERVAL: Final = 0.005
+UNSAFE_FILE_NAME_CHARS: Final = re.compile(r"[^A-Za-z0-9_.+~-]")
+
+T = TypeVar("T")
+
+
+def _get_frame_name(frame) -> str:
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+class Profiler:
+    """Profiles a run with cProfile, and samples the stacks of all the threads every
+    sample_interval seconds. Both are broken down by the label of the package being processed,
+    the rest of the run being labelled <run>."""
+
+    def __init__(
+        self, profile_dir: Path, sample_interval: float = DEFAULT_SAMPLE_INTERVAL
+    ):
+        self.profile_dir = profile_dir
+        self.sample_interval = sample_interval
+        self.stats: Dict[str, pstats.Stats] = {}
+        self.stacks: Dict[str, int] = collections.Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # the innermost label of each thread, read by the sampler
+        self._thread_labels: Dict[int, str] = {}
+        self._stop_sampling = threading.Event()
+        self._sampler = threading.Thread(
+            target=self._sample, name="profiler-sampler", daemon=True
+        )
+
+    def _get_label_stack(self) -> List[Any]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def label(self, label: str):
+        """Profiles the calling thread under label. Since a thread can only have one active
+        profile, the profile of the enclosing label is paused meanwhile."""
+        stack = self._get_label_stack()
+        if stack and stack[-1][0] == label:
+            yield
+            return
+
+        if stack and stack[-1][1]:
+            stack[-1][1].disable()
+        profile: Optional[cProfile.Profile] = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # since python 3.12, a single cProfile can be active across all the threads,
+            # the stacks of this label are then only sampled
+            profile = None
+        stack.append((label, profile))
+        self._thread_labels[threading.get_ident()] = label
+        try:
+            yield
+        finally:
+            stack.pop()
+            if profile:
+                profile.disable()
+                # pstats can't load a profile without any call
+                if profile.getstats():
+                    with self._lock:
+                        self.stats.setdefault(label, pstats.Stats()).add(profile)
+            if stack:
+                self._thread_labels[threading.get_ident()] = stack[-1][0]
+                if stack[-1][1]:
+                    with contextlib.suppress(ValueError):
+                        stack[-1][1].enable()
+            else:
+                self._thread_labels.pop(threading.get_ident(), None)
+
+    def _sample(self):
+        sampler_id = threading.get_ident()
+        while not self._stop_sampling.wait(self.sample_interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+
+                names: List[str] = []
+                while frame is not None:
+                    names.append(_get_frame_name(frame))
+                    frame = frame.f_back
+                label = self._thread_labels.get(thread_id, RUN_LABEL)
+                self.stacks[";".join([label] + names[::-1])] += 1
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop_sampling.set()
+        self._sampler.join()
+
+    def write(self):
+        """Writes the pstats of the whole run, the pstats of each package under packages/
+        and the collapsed stacks of all the labels, ready for flamegraph.pl or speedscope."""
+        packages_dir = self.profile_dir / PACKAGES_DIR
+        packages_dir.mkdir(parents=True, exist_ok=True)
+        run_stats = pstats.Stats()
+        for label, stats in sorted(self.stats.items()):
+            if label != RUN_LABEL:
+                stats.dump_stats(
+                    packages_dir / (UNSAFE_FILE_NAME_CHARS.sub("_", label) + ".pstats")
+                )
+            run_stats.add(stats)
+        run_stats.dump_stats(self.profile_dir / PSTATS_FILE)
+
+        (self.profile_dir / COLLAPSED_STACKS_FILE).write_text(
+            "".join(
+                f"{stack} {count}\n" for stack, count in sorted(self.stacks.items())
+            )
+        )
+
+
+_PROFILER: Optional[Profiler] = None
+
+
+@contextlib.contextmanager
+def profiling(profile_dir: Optional[Path]):
+    """Profiles the enclosed run into profile_dir. Does nothing if profile_dir is None."""
+    global _PROFILER
+    if profile_dir is None:
+        yield
+        return
+
+    _PROFILER = Profiler(profile_dir)
+    _PROFILER.start()
+    try:
+        with _PROFILER.label(RUN_LABEL):
+            yield
+    finally:
+        profiler, _PROFILER = _PROFILER, None
+        profiler.stop()
+        profiler.write()
+
+
+def profiled_per_package(function: Callable[..., T]) -> Callable[..., T]:
+    """Labels the calls of function with the pinned name of their package argument.
+    Without an active profiler, this costs a single global lookup per call."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs) -> T:
+        profiler = _PROFILER
+        if profiler is None:
+            return function(*args, **kwargs)
+
+        package = args[0] if args else kwargs["package"]
+        with profiler.label(package.pinned_name):
+            return function(*args, **kwargs)
+
+    return wrapper
@@ -1,11 +1,12 @@
 """File containing an input file reader for deb packages."""
 
 from collections import defaultdict
-from typing import Dict, Iterable, Set
+from typing import Dict, Iterable, Optional, Set
 from pathlib import Path
 
 import functools
 
+from src.deb_source import LocalDebSource
 from src.package import PackageMetadata
 from src.version import (
     get_package_version,
@@ -14,7 +15,9 @@ from src.version import (
 )
 
 
-def _get_package_metadata(pinned_package: str) -> PackageMetadata:
+def _get_package_metadata(
+    pinned_package: str, deb_source: Optional[LocalDebSource] = None
+) -> PackageMetadata:
     _check_entry(pinned_package)
     # entries format: name:arch=version
     name, arch_version = pinned_package.split(":", maxsplit=1)
@@ -30,7 +33,11 @@ def _get_package_metadata(pinned_package: str) -> PackageMetadata:
         )
 
     if not version:
-        version = get_package_version(name=name, arch=arch)
+        version = (
+            deb_source.get_package_version(name=name, arch=arch)
+            if deb_source
+            else get_package_version(name=name, arch=arch)
+        )
 
     return PackageMetadata(name=name, arch=arch, version=version)
 
@@ -72,8 +79,11 @@ def _get_unique_pacakges(package_versions: Set[str]) -> Set[str]:
     }
 
 
-def read_input_files(input_files: Iterable[Path]) -> Set[PackageMetadata]:
-    """Reads input files and returns a Set of PackageMetadatas."""
+def read_input_files(
+    input_files: Iterable[Path], deb_source: Optional[LocalDebSource] = None
+) -> Set[PackageMetadata]:
+    """Reads input files and returns a Set of PackageMetadatas.
+    Unpinned versions are resolved from deb_source if provided, otherwise from apt-cache."""
     input_packages_dict: Dict[str, Set[str]] = {}
     for input_file in input_files:
         input_packages = input_file.read_text().splitlines()
@@ -93,7 +103,7 @@ def read_input_files(input_files: Iterable[Path]) -> Set[PackageMetadata]:
             input_packages_dict[package_name_arch].add(input_package)
 
     return {
-        _get_package_metadata(pinned_package=entry)
+        _get_package_metadata(pinned_package=entry, deb_source=deb_source)
         for entries in input_packages_dict.values()
         for entry in _get_unique_pacakges(entries)
     }
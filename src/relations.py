@@ -0,0 +1,112 @@
+"""File containing the parser of Debian relationship fields, like Depends.
+See https://www.debian.org/doc/debian-policy/ch-relationships.html"""
+
+from typing import Callable, Final, List, Optional, Tuple
+
+import functools
+import re
+
+from src.package import PackageRelation
+
+# name[:arch] [(op version)] [[arch ...]] [<profile ...> ...]
+RELATION_PATTERN: Final = re.compile(
+    r"""^(?P<name>[a-z0-9][a-z0-9+.-]*)
+    (?::(?P<arch>[a-z0-9-]+))?
+    \s*(?:\(\s*(?P<operator><<|<=|=|>=|>>|<|>)\s*(?P<version>[^)\s]+)\s*\))?
+    \s*(?:\[(?P<archs>[^\]]*)\])?
+    \s*(?:<[^>]*>\s*)*$""",
+    re.VERBOSE,
+)
+# qualifiers standing for the arch of the depending package
+SAME_ARCH_QUALIFIERS: Final = {"", "any", "native"}
+# tzdata accesses files from the system, it needs more investigation to handle it properly.
+# TODO: find a general way to handle deps accessing files from system.
+IGNORED_PACKAGES: Final = {"tzdata"}
+
+Alternatives = Tuple[PackageRelation, ...]
+
+
+def _parse_relation(alternative: str, field: str) -> PackageRelation:
+    match = RELATION_PATTERN.match(alternative.strip())
+    if not match:
+        raise ValueError(f"{alternative} is not a valid relation, in: {field}")
+
+    return PackageRelation(
+        name=match.group("name"),
+        operator=match.group("operator") or "",
+        version=match.group("version") or "",
+        arch=match.group("arch") or "",
+        arch_restrictions=tuple((match.group("archs") or "").split()),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def parse_relations(field: str) -> Tuple[Alternatives, ...]:
+    """Parses a relationship field into its comma separated relations, each being a tuple of
+    | separated alternatives. Identical fields are shared by many packages, so each of them is
+    only parsed once per run."""
+    return tuple(
+        tuple(_parse_relation(alternative, field) for alternative in group.split("|"))
+        for group in field.split(",")
+        if group.strip()
+    )
+
+
+def _is_arch_allowed(relation: PackageRelation, arch: str) -> bool:
+    "An arch restriction list either only lists arches, or only excludes them with !"
+    if not relation.arch_restrictions:
+        return True
+    if relation.arch_restrictions[0].startswith("!"):
+        return "!" + arch not in relation.arch_restrictions
+    return arch in relation.arch_restrictions
+
+
+def get_relation_arch(relation: PackageRelation, arch: str) -> str:
+    "Returns the arch of the dep, arch being the one of the depending package"
+    return arch if relation.arch in SAME_ARCH_QUALIFIERS else relation.arch
+
+
+def _choose_alternative(
+    alternatives: Alternatives,
+    arch: str,
+    is_real_package: Optional[Callable[[str, str], bool]],
+) -> Optional[PackageRelation]:
+    """The first versioned alternative is chosen, like debconf in: debconf (>= 0.5) | debconf-2.0,
+    since unversioned alternatives are often virtual packages. Otherwise the first real one is.
+    Returns None if all the alternatives are virtual, like perlapi-5.36.0."""
+    for alternative in alternatives:
+        if alternative.operator:
+            return alternative
+
+    for alternative in alternatives:
+        if is_real_package is None or is_real_package(
+            alternative.name, get_relation_arch(alternative, arch)
+        ):
+            return alternative
+
+    return None
+
+
+def get_package_relations(
+    deps_str: str,
+    arch: str = "",
+    is_real_package: Optional[Callable[[str, str], bool]] = None,
+) -> List[PackageRelation]:
+    """Returns the relation chosen out of each group of alternatives of a Depends field, for a
+    package of arch. Relations restricted to other arches are left out, and so are the
+    groups of virtual packages, as told by is_real_package(name, arch)."""
+    relations: List[PackageRelation] = []
+    for alternatives in parse_relations(deps_str):
+        allowed_alternatives = tuple(
+            alternative
+            for alternative in alternatives
+            if not arch or _is_arch_allowed(alternative, arch)
+        )
+        if not allowed_alternatives:
+            continue
+
+        relation = _choose_alternative(allowed_alternatives, arch, is_real_package)
+        if relation and relation.name not in IGNORED_PACKAGES:
+            relations.append(relation)
+
+    return relations
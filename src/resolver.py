@@ -0,0 +1,168 @@
+"""File containing the graph-wide version resolution, run before any package is downloaded."""
+
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import functools
+
+from src.package import PackageMetadata, PackageRelation
+from src.relations import get_package_relations, get_relation_arch
+from src.version import compare_dpkg_versions, get_compatibility_level
+
+# (name, arch, compatibility_level): only one version is selected for each of them
+VersionGroup = Tuple[str, str, int]
+
+
+def satisfies(version: str, relation: PackageRelation) -> bool:
+    """Tells if version satisfies the version constraint of relation.
+    Unversioned relations are satisfied by any version."""
+    if not relation.operator:
+        return True
+
+    comparison = compare_dpkg_versions(version, relation.version)
+    if relation.operator == "=":
+        return comparison == 0
+    if relation.operator in {"<<", "<"}:
+        return comparison < 0
+    if relation.operator == "<=":
+        return comparison <= 0
+    if relation.operator == ">=":
+        return comparison >= 0
+    if relation.operator in {">>", ">"}:
+        return comparison > 0
+
+    raise ValueError(f"Unknown version operator: {relation.operator}")
+
+
+def _get_version_group(metadata: PackageMetadata) -> VersionGroup:
+    return (metadata.name, metadata.arch, get_compatibility_level(metadata.version))
+
+
+def _select_version(
+    group: VersionGroup,
+    requested_versions: Set[str],
+    constraints: List[PackageRelation],
+) -> str:
+    """Like bazel's minimal version selection, selects the highest requested version.
+    Versions violating a constraint of the group, like an upper bound, are skipped. Raises a
+    ValueError if every requested version violates one."""
+    # equal versions, like 1.0 and 0:1.0, keep their string order
+    versions = sorted(
+        sorted(requested_versions),
+        key=functools.cmp_to_key(compare_dpkg_versions),
+        reverse=True,
+    )
+    for version in versions:
+        if all(satisfies(version, constraint) for constraint in constraints):
+            return version
+
+    name, arch, _ = group
+    conflicts = sorted(
+        {
+            f"{constraint.name} ({constraint.operator} {constraint.version})"
+            for constraint in constraints
+            if constraint.operator
+        }
+    )
+    raise ValueError(
+        f"No requested version of {name}:{arch} ({', '.join(versions)}) satisfies "
+        f"the constraints: {', '.join(conflicts)}"
+    )
+
+
+def resolve_versions(
+    input_package_metadatas: Iterable[PackageMetadata],
+    get_deps_str: Callable[[PackageMetadata], str],
+    get_requested_version: Callable[[PackageRelation, str], str],
+    is_real_package: Optional[Callable[[str, str], bool]] = None,
+) -> Dict[PackageMetadata, Set[PackageMetadata]]:
+    """Resolves the dependency graph of the input packages from their control data only.
+    Groups of alternatives only made of virtual packages, as told by is_real_package, are left out.
+    Every version constraint (>=, <<, =, ...) of the explored graph is collected, then one
+    version is selected per (name, arch, compatibility_level), a ValueError is raised if none
+    satisfies the constraints. Returns the selected packages mapped to their selected deps,
+    the versions that were not selected are not part of it."""
+    # every explored package mapped to the relations of its deps and the versions they request
+    edges: Dict[PackageMetadata, List[Tuple[PackageRelation, PackageMetadata]]] = {}
+    requested_versions: Dict[VersionGroup, Set[str]] = {}
+    constraints: Dict[VersionGroup, List[PackageRelation]] = {}
+    requested_version_cache: Dict[Tuple[PackageRelation, str], str] = {}
+
+    inputs = list(input_package_metadatas)
+    for metadata in inputs:
+        requested_versions.setdefault(_get_version_group(metadata), set()).add(
+            metadata.version
+        )
+
+    package_stack = list(inputs)
+    while package_stack:
+        metadata = package_stack.pop()
+        if metadata in edges:
+            continue
+
+        edges[metadata] = []
+        for relation in get_package_relations(
+            get_deps_str(metadata), metadata.arch, is_real_package
+        ):
+            arch = get_relation_arch(relation, metadata.arch)
+            cache_key = (relation, arch)
+            if cache_key not in requested_version_cache:
+                requested_version_cache[cache_key] = get_requested_version(
+                    relation, arch
+                )
+            dep = PackageMetadata(
+                name=relation.name,
+                arch=arch,
+                version=requested_version_cache[cache_key],
+            )
+            group = _get_version_group(dep)
+            requested_versions.setdefault(group, set()).add(dep.version)
+            constraints.setdefault(group, []).append(relation)
+            edges[metadata].append((relation, dep))
+            package_stack.append(dep)
+
+    selected_versions = {
+        group: _select_version(group, versions, constraints.get(group, []))
+        for group, versions in requested_versions.items()
+    }
+
+    def select(metadata: PackageMetadata) -> PackageMetadata:
+        return PackageMetadata(
+            name=metadata.name,
+            arch=metadata.arch,
+            version=selected_versions[_get_version_group(metadata)],
+        )
+
+    # the final graph only contains what is reachable through the selected versions
+    resolved_graph: Dict[PackageMetadata, Set[PackageMetadata]] = {}
+    package_stack = [select(metadata) for metadata in inputs]
+    while package_stack:
+        metadata = package_stack.pop()
+        if metadata in resolved_graph:
+            continue
+
+        resolved_graph[metadata] = {select(dep) for _, dep in edges[metadata]}
+        package_stack.extend(resolved_graph[metadata])
+
+    return resolved_graph
+
+
+def get_closure(
+    resolved_graph: Dict[PackageMetadata, Set[PackageMetadata]],
+    input_package_metadatas: Iterable[PackageMetadata],
+) -> Set[PackageMetadata]:
+    """Returns the packages of resolved_graph reachable from the input packages, once these
+    are mapped to the version selected for them."""
+    selected = {_get_version_group(metadata): metadata for metadata in resolved_graph}
+    closure: Set[PackageMetadata] = set()
+    package_stack = [
+        selected[_get_version_group(metadata)] for metadata in input_package_metadatas
+    ]
+    while package_stack:
+        metadata = package_stack.pop()
+        if metadata in closure:
+            continue
+
+        closure.add(metadata)
+        package_stack.extend(resolved_graph[metadata])
+
+    return closure
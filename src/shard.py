@@ -0,0 +1,266 @@
+"""File containing the sharding of a run across machines, and the merge of the shard outputs."""
+
+from pathlib import Path
+from typing import Callable, Dict, Final, Iterable, List, Optional, Set
+
+import dataclasses
+import json
+import shutil
+import time
+
+from src.inventory import merge_inventories
+from src.lockfile import LOCKFILE, merge_lockfiles
+from src.modularize_package import MANIFEST_SUFFIX
+from src.module import Module, get_module_name, get_module_version
+from src.package import Package, PackageMetadata, ShardMetadata
+from src.timings import merge_timings
+from src.writers import (
+    MODULE_DOT_BAZEL,
+    REGISTRY_MODULES_DIR,
+    SOURCE_DOT_JSON,
+    json_dump,
+    link_or_copy,
+    read_http_archives,
+    write_http_archives,
+    write_registry_version,
+)
+
+SHARD_SUMMARY_DOT_JSON: Final = Path("shard_summary.json")
+# the detached build files and the registry modules of the shard, kept in its modules path
+SHARD_BUILD_FILES_DIR: Final = Path("build_files")
+SHARD_REGISTRY_DIR: Final = Path("registry")
+DEFAULT_WAIT_TIMEOUT: Final = 3600
+DEFAULT_POLL_INTERVAL: Final = 5
+
+
+def parse_shard(spec: str, shard_dir: Path) -> ShardMetadata:
+    """Parses a K/N shard spec, K being the 1-based index of the shard out of N shards."""
+    index, _, count = spec.partition("/")
+    if not index.isdigit() or not count.isdigit() or not 1 <= int(index) <= int(count):
+        raise ValueError(
+            f"Shard: {spec} is not allowed. Shard must be K/N, where 1 <= K <= N"
+        )
+
+    return ShardMetadata(index=int(index), count=int(count), shard_dir=shard_dir)
+
+
+def get_shard_components(
+    components: List[List[PackageMetadata]],
+    shard_count: int,
+    get_cost: Callable[[PackageMetadata], float] = lambda _: 1.0,
+) -> List[List[List[PackageMetadata]]]:
+    """Splits the components, given in a topological order, into shard_count contiguous shards
+    of about the same cost. A shard therefore only depends on the shards before it.
+    Without a better estimate, every package costs the same."""
+    costs = [
+        sum(get_cost(metadata) for metadata in component) for component in components
+    ]
+    total_cost = sum(costs) or 1.0
+    shards: List[List[List[PackageMetadata]]] = [[] for _ in range(shard_count)]
+    cumulative_cost = 0.0
+    for component, cost in zip(components, costs):
+        # the component goes to the shard whose share of the total cost holds its middle
+        shard = int(shard_count * (cumulative_cost + cost / 2) / total_cost)
+        shards[min(shard, shard_count - 1)].append(component)
+        cumulative_cost += cost
+
+    return shards
+
+
+def _get_modules_file(shard_dir: Path, index: int, count: int) -> Path:
+    return shard_dir / f"shard-{index}-of-{count}.modules.json"
+
+
+def export_modules(shard_metadata: ShardMetadata, modules: Iterable[Module]):
+    """Exports the rpaths of the modules of the shard for the shards depending on them.
+    The rpaths of a package are known as soon as it is extracted, so this is called before
+    patching and the shards can patch concurrently."""
+    json_dump(
+        _get_modules_file(
+            shard_metadata.shard_dir, shard_metadata.index, shard_metadata.count
+        ),
+        {
+            "modules": [
+                dataclasses.asdict(module)
+                for module in sorted(
+                    modules,
+                    key=lambda module: (module.name, module.arch, module.version),
+                )
+            ]
+        },
+    )
+
+
+def _read_modules(file: Path) -> Dict[PackageMetadata, Module]:
+    modules: Dict[PackageMetadata, Module] = {}
+    for module_dict in json.loads(file.read_text())["modules"]:
+        module = Module(**module_dict)
+        modules[
+            PackageMetadata(name=module.name, arch=module.arch, version=module.version)
+        ] = module
+
+    return modules
+
+
+def wait_for_modules(
+    shard_metadata: ShardMetadata,
+    needed: Set[PackageMetadata],
+    timeout: float = DEFAULT_WAIT_TIMEOUT,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+) -> Dict[PackageMetadata, Module]:
+    """Waits until the other shards exported the needed modules, then returns them."""
+    deadline = time.monotonic() + timeout
+    modules: Dict[PackageMetadata, Module] = {}
+    while True:
+        for index in range(1, shard_metadata.count + 1):
+            file = _get_modules_file(
+                shard_metadata.shard_dir, index, shard_metadata.count
+            )
+            if index != shard_metadata.index and file.exists():
+                modules.update(_read_modules(file))
+
+        missing = needed - modules.keys()
+        if not missing:
+            return {metadata: modules[metadata] for metadata in needed}
+
+        if time.monotonic() >= deadline:
+            missing_str = ", ".join(
+                sorted(
+                    f"{metadata.name}:{metadata.arch}={metadata.version}"
+                    for metadata in missing
+                )
+            )
+            raise ValueError(
+                f"Timed out waiting for the other shards to export: {missing_str}"
+            )
+        time.sleep(poll_interval)
+
+
+def write_shard_summary(
+    modules_path: Path,
+    shard_metadata: ShardMetadata,
+    packages: Iterable[Package],
+    archives_file: Optional[Path] = None,
+    build_files_dir: Optional[Path] = None,
+    registry_dir: Optional[Path] = None,
+):
+    """Writes what the merge needs from the shard next to its module archives: the shard
+    index, the modularized packages and, in detached mode, their http_archives. Their
+    detached build files and registry modules are copied along."""
+    packages = list(packages)
+    module_names = {
+        get_module_name(name=package.name, arch=package.arch) for package in packages
+    }
+    http_archives = read_http_archives(archives_file) if archives_file else {}
+    for shard_dir in [SHARD_BUILD_FILES_DIR, SHARD_REGISTRY_DIR]:
+        shutil.rmtree(modules_path / shard_dir, ignore_errors=True)
+    for package in packages:
+        if build_files_dir:
+            shutil.copytree(
+                build_files_dir / package.module_name,
+                modules_path / SHARD_BUILD_FILES_DIR / package.module_name,
+            )
+        if registry_dir:
+            version = get_module_version(package.version)
+            shutil.copytree(
+                registry_dir / REGISTRY_MODULES_DIR / package.module_name / version,
+                modules_path / SHARD_REGISTRY_DIR / package.module_name / version,
+            )
+    json_dump(
+        modules_path / SHARD_SUMMARY_DOT_JSON,
+        {
+            "shard": shard_metadata.index,
+            "shard_count": shard_metadata.count,
+            "packages": sorted(package.pinned_name for package in packages),
+            "http_archives": {
+                name: http_archive
+                for name, http_archive in http_archives.items()
+                if name in module_names
+            },
+            # registry URLs of the shard modules path are moved to the merged one
+            "modules_uri": modules_path.resolve().as_uri(),
+        },
+    )
+
+
+def _merge_registry(
+    shard_path: Path, modules_uri: str, modules_path: Path, registry_dir: Path
+):
+    "Adds the registry modules of the shard to registry_dir"
+    for version_dir in sorted((shard_path / SHARD_REGISTRY_DIR).glob("*/*")):
+        source = json.loads((version_dir / SOURCE_DOT_JSON).read_text())
+        if source["url"].startswith(modules_uri + "/"):
+            source["url"] = (
+                modules_path.resolve().as_uri() + source["url"][len(modules_uri) :]
+            )
+        write_registry_version(
+            registry_dir=registry_dir,
+            module_name=version_dir.parent.name,
+            version=version_dir.name,
+            module_file_content=(version_dir / MODULE_DOT_BAZEL).read_text(),
+            source=source,
+        )
+
+
+def merge_shards(
+    shard_paths: Iterable[Path],
+    modules_path: Path,
+    archives_file: Optional[Path] = None,
+    build_files_dir: Optional[Path] = None,
+    registry_dir: Optional[Path] = None,
+) -> List[str]:
+    """Combines the modules paths of all the shards of a run into modules_path, their
+    http_archives into archives_file, their detached build files into build_files_dir and
+    their registry modules into registry_dir. Returns the pinned names of the modularized
+    packages."""
+    shard_paths = list(shard_paths)
+    summaries = []
+    for shard_path in shard_paths:
+        summary_file = shard_path / SHARD_SUMMARY_DOT_JSON
+        if not summary_file.exists():
+            raise ValueError(
+                f"{summary_file} does not exist, {shard_path} is not the modules path of a shard"
+            )
+        summaries.append(json.loads(summary_file.read_text()))
+
+    shard_counts = {summary["shard_count"] for summary in summaries}
+    shard_indexes = sorted(summary["shard"] for summary in summaries)
+    if len(shard_counts) != 1 or shard_indexes != list(
+        range(1, shard_counts.pop() + 1)
+    ):
+        raise ValueError(
+            f"Every shard of a single run must be merged exactly once, got shards: {shard_indexes}"
+        )
+
+    modules_path.mkdir(parents=True, exist_ok=True)
+    for shard_path in shard_paths:
+        for pattern in ["*.tar.gz", "*" + MANIFEST_SUFFIX]:
+            for file in sorted(shard_path.glob(pattern)):
+                link_or_copy(file, modules_path / file.name)
+    merge_lockfiles(
+        [shard_path / LOCKFILE for shard_path in shard_paths], modules_path / LOCKFILE
+    )
+    merge_inventories(shard_paths, modules_path)
+    merge_timings(shard_paths, modules_path)
+    for shard_path, summary in zip(shard_paths, summaries):
+        if build_files_dir:
+            for module_dir in sorted((shard_path / SHARD_BUILD_FILES_DIR).glob("*")):
+                shutil.copytree(
+                    module_dir, build_files_dir / module_dir.name, dirs_exist_ok=True
+                )
+        if registry_dir:
+            _merge_registry(
+                shard_path, summary["modules_uri"], modules_path, registry_dir
+            )
+
+    if archives_file:
+        write_http_archives(
+            archives_file,
+            {
+                name: http_archive
+                for summary in summaries
+                for name, http_archive in summary["http_archives"].items()
+            },
+        )
+
+    return sorted(package for summary in summaries for package in summary["packages"])
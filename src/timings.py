@@ -0,0 +1,163 @@
+"""File containing the stage timings of the packages, kept across runs to estimate their cost,
+report the progress of a run with an ETA, and start the longest packages first."""
+
+from pathlib import Path
+from typing import Any, Callable, Dict, Final, Iterable, Optional, TypeVar
+
+import contextlib
+import datetime
+import functools
+import json
+import statistics
+import threading
+import time
+
+from src.package import Package, PackageMetadata
+from src.writers import json_dump
+
+TIMINGS_DOT_JSON: Final = Path("bazelize.timings.json")
+# the stage after which a package is done
+LAST_STAGE: Final = "package"
+DEFAULT_COST: Final = 1.0
+
+T = TypeVar("T")
+
+
+def _get_key(name: str, arch: str) -> str:
+    return f"{name}:{arch}"
+
+
+class TimingDatabase:
+    """The last measured seconds of the stages of each package, and the sizes of the archives
+    they produced. Packages are keyed by name and arch rather than by version, so that a new
+    version is estimated from the previous ones."""
+
+    def __init__(self, file: Path):
+        self.file = file
+        self.packages: Dict[str, Dict[str, Any]] = (
+            json.loads(file.read_text())["packages"] if file.exists() else {}
+        )
+        self._lock = threading.Lock()
+        # measured packages are estimated from their history, the others cost the median
+        costs = [
+            sum(entry["seconds"].values())
+            for entry in self.packages.values()
+            if entry["seconds"]
+        ]
+        self._default_cost = statistics.median(costs) if costs else DEFAULT_COST
+
+    def record(
+        self, package: Package, stage: str, seconds: float, size: Optional[int] = None
+    ):
+        with self._lock:
+            entry = self.packages.setdefault(
+                _get_key(package.name, package.arch), {"seconds": {}, "sizes": {}}
+            )
+            entry["version"] = package.version
+            entry["seconds"][stage] = round(seconds, 3)
+            if size is not None:
+                entry["sizes"][stage] = size
+
+    def get_cost(self, metadata: PackageMetadata) -> float:
+        "Returns the estimated seconds of all the stages of metadata, as of the previous runs"
+        entry = self.packages.get(_get_key(metadata.name, metadata.arch))
+        if not entry or not entry["seconds"]:
+            return self._default_cost
+
+        return sum(entry["seconds"].values())
+
+    def save(self):
+        with self._lock:
+            json_dump(self.file, {"packages": self.packages})
+
+
+def merge_timings(modules_paths: Iterable[Path], modules_path: Path):
+    "Combines the timings of the shards of a run into the ones of modules_path"
+    database = TimingDatabase(modules_path / TIMINGS_DOT_JSON)
+    for shard_path in modules_paths:
+        database.packages.update(TimingDatabase(shard_path / TIMINGS_DOT_JSON).packages)
+    database.save()
+
+
+class Progress:
+    """Reports every package as it is done, with the ETA of the run. The work done is weighed
+    by the estimated cost of the packages, so that one large package left still shows as a
+    large part of the run."""
+
+    def __init__(self, costs: Dict[PackageMetadata, float]):
+        self._costs = costs
+        self._total_cost = sum(costs.values())
+        self._done = 0
+        self._done_cost = 0.0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def package_done(self, package: Package):
+        metadata = PackageMetadata(
+            name=package.name, arch=package.arch, version=package.version
+        )
+        with self._lock:
+            self._done += 1
+            self._done_cost += self._costs.get(metadata, 0.0)
+            elapsed = time.monotonic() - self._start
+            remaining_cost = max(self._total_cost - self._done_cost, 0.0)
+            eta = elapsed * remaining_cost / self._done_cost if self._done_cost else 0.0
+            print(
+                f"[{self._done}/{len(self._costs)}] {package.pinned_name} is done, "
+                f"{100 * self._done_cost / (self._total_cost or 1.0):.0f}% of the estimated work, "
+                f"ETA: {datetime.timedelta(seconds=round(eta))}"
+            )
+
+
+_DATABASE: Optional[TimingDatabase] = None
+_PROGRESS: Optional[Progress] = None
+
+
+@contextlib.contextmanager
+def tracking(database: TimingDatabase, metadatas: Iterable[PackageMetadata]):
+    """Records the stage timings of the packages into database within the enclosed run, and
+    reports the progress of metadatas. database is saved at the end, even if the run failed."""
+    global _DATABASE, _PROGRESS
+    _DATABASE = database
+    _PROGRESS = Progress(
+        {metadata: database.get_cost(metadata) for metadata in metadatas}
+    )
+    try:
+        yield
+    finally:
+        _DATABASE = _PROGRESS = None
+        database.save()
+
+
+def timed_stage(stage: str) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Times the calls of a stage function, whose first argument is the package. A returned
+    path is recorded as the archive produced by the stage.
+    Outside of tracking, this costs a single global lookup per call."""
+
+    def decorator(function: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs) -> T:
+            database = _DATABASE
+            if database is None:
+                return function(*args, **kwargs)
+
+            package = args[0] if args else kwargs["package"]
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            database.record(
+                package,
+                stage,
+                time.perf_counter() - start,
+                result.stat().st_size
+                if isinstance(result, Path) and result.exists()
+                else None,
+            )
+            progress = _PROGRESS
+            if stage == LAST_STAGE and progress:
+                progress.package_done(package)
+
+            return result
+
+        return wrapper
+
+    return decorator
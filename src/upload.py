@@ -0,0 +1,172 @@
+"""File containing an uploader pushing module archives to an HTTP endpoint."""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Dict, Final, List, Optional, Tuple, Union
+
+import hashlib
+import http.client
+import queue
+import threading
+import urllib.parse
+
+CHECKSUM_HEADER: Final = "X-Checksum-Sha256"
+DEFAULT_MAX_CONNECTIONS: Final = 4
+DEFAULT_TIMEOUT: Final = 300
+HASH_CHUNK_SIZE: Final = 1 << 20
+RESPONSE_CHUNK_SIZE: Final = 1 << 20
+
+
+class HttpConnectionPool:
+    """Pool of kept-alive connections to the host of an http(s) url."""
+
+    def __init__(self, url: str, timeout: float = DEFAULT_TIMEOUT):
+        self.url = urllib.parse.urlsplit(url)
+        if self.url.scheme not in {"http", "https"} or not self.url.netloc:
+            raise ValueError(f"Url: {url} is not allowed. Url must be an http(s) url")
+
+        self._timeout = timeout
+        self._connections: "queue.SimpleQueue[http.client.HTTPConnection]" = (
+            queue.SimpleQueue()
+        )
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        if self.url.scheme == "https":
+            return http.client.HTTPSConnection(self.url.netloc, timeout=self._timeout)
+        return http.client.HTTPConnection(self.url.netloc, timeout=self._timeout)
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: Optional[Union[bytes, BinaryIO]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        output: Optional[BinaryIO] = None,
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        """Returns the status, the lower-cased headers and the body of the response.
+        A file body is streamed, its Content-Length must be part of headers. If output is
+        provided, the body of a 200 response is streamed into it in chunks instead, and an
+        empty body is returned."""
+        try:
+            connection = self._connections.get_nowait()
+        except queue.Empty:
+            connection = self._new_connection()
+
+        try:
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                # the server may have closed the kept-alive connection, retry once on a new one
+                connection.close()
+                connection = self._new_connection()
+                if not isinstance(body, bytes) and body is not None:
+                    body.seek(0)
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+            # the response must be fully read before the connection can be reused
+            content = b""
+            if output is not None and response.status == 200:
+                for chunk in iter(lambda: response.read(RESPONSE_CHUNK_SIZE), b""):
+                    output.write(chunk)
+            else:
+                content = response.read()
+        except BaseException:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._connections.put(connection)
+
+        return (
+            response.status,
+            {key.lower(): value for key, value in response.getheaders()},
+            content,
+        )
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class ArchiveUploader:
+    """Uploads module archives in the background with an HTTP PUT.
+    Connections are kept alive and pooled, at most max_connections uploads run concurrently.
+    Archives whose sha256, as reported by a HEAD request, did not change are not uploaded again.
+    """
+
+    def __init__(
+        self,
+        upload_url: str,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        timeout: float = DEFAULT_TIMEOUT,
+    ):
+        if max_connections < 1:
+            raise ValueError("max_connections must be at least 1")
+
+        self._pool = HttpConnectionPool(upload_url, timeout=timeout)
+        self._url = self._pool.url
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_connections, thread_name_prefix="upload"
+        )
+        self._futures: List[Future] = []
+        self._lock = threading.Lock()
+        self.uploaded: List[Path] = []
+        self.skipped: List[Path] = []
+
+    def _get_archive_path(self, archive: Path) -> str:
+        return self._url.path.rstrip("/") + "/" + urllib.parse.quote(archive.name)
+
+    def _upload(self, archive: Path) -> None:
+        "The archive is hashed then streamed in chunks, it is never fully read into memory"
+        sha256 = hashlib.sha256()
+        with archive.open("rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+        checksum = sha256.hexdigest()
+        path = self._get_archive_path(archive)
+
+        status, headers, _ = self._pool.request("HEAD", path)
+        if status == 200 and headers.get(CHECKSUM_HEADER.lower()) == checksum:
+            with self._lock:
+                self.skipped.append(archive)
+            return
+
+        with archive.open("rb") as f:
+            status, _, _ = self._pool.request(
+                "PUT",
+                path,
+                body=f,
+                headers={
+                    CHECKSUM_HEADER: checksum,
+                    "Content-Length": str(archive.stat().st_size),
+                    "Content-Type": "application/gzip",
+                },
+            )
+        if status not in {200, 201, 204}:
+            raise ValueError(
+                f"uploading {archive.name} to {self._url.netloc}{path} failed with status {status}"
+            )
+
+        with self._lock:
+            self.uploaded.append(archive)
+
+    def submit(self, archive: Path) -> Future:
+        """Schedules archive for upload and returns immediately."""
+        future = self._executor.submit(self._upload, archive)
+        self._futures.append(future)
+        return future
+
+    def close(self) -> None:
+        """Waits for all the scheduled uploads, then closes the pooled connections.
+        Raises the first upload error, if any."""
+        self._executor.shutdown(wait=True)
+        self._pool.close()
+
+        for future in self._futures:
+            future.result()
@@ -0,0 +1,162 @@
+"""File containing the verification of the runtime linkage of the generated modules."""
+
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import functools
+import os
+import tarfile
+import tempfile
+
+from src.elf import ElfDynamicInfo, read_elf_dynamic_info
+from src.lockfile import LOCKFILE, read_lockfile
+from src.modularize_package import DEBUG_SUFFIX, LAYER_SUFFIX, MANIFEST_SUFFIX
+
+ORIGIN_TOKENS = ("${ORIGIN}", "$ORIGIN")
+
+
+def _get_locked_archives(modules_path: Path) -> List[Path]:
+    "The archives of the packages locked by the last run, next to their manifests"
+    archives = [
+        modules_path / (entry["manifest"][: -len(MANIFEST_SUFFIX)] + ".tar.gz")
+        for entry in read_lockfile(modules_path / LOCKFILE).values()
+    ]
+    for archive in archives:
+        if not archive.exists():
+            raise ValueError(f"{archive} locked in {LOCKFILE} does not exist")
+
+    return sorted(archives)
+
+
+def _get_module_archives(
+    modules_path: Path, archives: Optional[List[Path]] = None
+) -> List[Path]:
+    """Returns archives if provided, otherwise the ones locked in modules_path. Without a
+    lockfile, all the module archives are used. The debug sidecars are not part of the
+    runfiles, and the layer archives only split the content of the module archives"""
+    if archives:
+        return sorted(archives)
+    if (modules_path / LOCKFILE).exists():
+        return _get_locked_archives(modules_path)
+
+    return [
+        archive
+        for archive in sorted(modules_path.glob("*.tar.gz"))
+        if not archive.name.endswith(
+            (DEBUG_SUFFIX + ".tar.gz", LAYER_SUFFIX + ".tar.gz")
+        )
+    ]
+
+
+def _extract_archive(archive: Path, runfiles_dir: Path) -> List[Path]:
+    "Extracts archive in runfiles_dir, returns the root dirs it lays out"
+    with tarfile.open(archive) as tar:
+        members = tar.getmembers()
+        for member in members:
+            if member.name.startswith("/") or ".." in Path(member.name).parts:
+                raise ValueError(
+                    f"{archive} has the member: {member.name} outside of its module"
+                )
+        tar.extractall(runfiles_dir, members=members)
+
+    return sorted({runfiles_dir / Path(member.name).parts[0] for member in members})
+
+
+def layout_modules(
+    modules_path: Path,
+    runfiles_dir: Path,
+    archives: Optional[List[Path]] = None,
+    executor: Optional[Executor] = None,
+) -> List[Path]:
+    """Extracts the module archives of modules_path next to each other in runfiles_dir, like
+    their repos in the runfiles of a target, on executor if provided. Returns the root dirs of
+    the modules. Only one archive may lay out each root, the versions of a module share it."""
+    module_archives = _get_module_archives(modules_path, archives)
+    extract = functools.partial(_extract_archive, runfiles_dir=runfiles_dir)
+    archive_roots = (executor.map if executor else map)(extract, module_archives)
+
+    roots: Dict[Path, Path] = {}
+    for archive, archive_root_dirs in zip(module_archives, archive_roots):
+        for root in archive_root_dirs:
+            if roots.setdefault(root, archive) != archive:
+                raise ValueError(
+                    f"{roots[root].name} and {archive.name} both lay out {root.name}, "
+                    f"lock the modules to verify in {LOCKFILE} or list their archives"
+                )
+
+    return sorted(roots)
+
+
+def get_search_dirs(elf_info: ElfDynamicInfo, origin: Path) -> List[Path]:
+    """Returns the dirs the dynamic loader searches for the DT_NEEDED libs of an ELF file in
+    origin. Like ld.so, DT_RPATH is ignored when there is a DT_RUNPATH. LD_LIBRARY_PATH and the
+    system dirs are left out, the modules must resolve their libs by themselves. The DT_RPATH
+    of the loading objects, which ld.so also searches for a file without DT_RUNPATH, is not
+    inherited: each ELF file is checked on its own."""
+    dirs: List[Path] = []
+    for rpath in [elf_info.rpath if not elf_info.runpath else "", elf_info.runpath]:
+        for entry in rpath.split(":"):
+            if not entry:
+                continue
+            for token in ORIGIN_TOKENS:
+                entry = entry.replace(token, os.fspath(origin))
+            # .. is left to the file system, which resolves it like the loader does
+            dirs.append(Path(entry))
+
+    return dirs
+
+
+def _get_unresolved_libs(file: Path) -> List[str]:
+    elf_info = read_elf_dynamic_info(file)
+    if not elf_info:
+        return []
+
+    search_dirs = get_search_dirs(elf_info, file.parent)
+    return [
+        needed
+        for needed in elf_info.needed
+        if not (
+            Path(needed).exists()
+            if "/" in needed
+            else any((dir / needed).exists() for dir in search_dirs)
+        )
+    ]
+
+
+def _walk_regular_files(root: Path) -> Iterator[Path]:
+    "Symlinks are skipped, the loader sees their target's $ORIGIN"
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            file = Path(dirpath) / filename
+            if not file.is_symlink():
+                yield file
+
+
+def verify_modules(
+    modules_path: Path,
+    workers: int = 1,
+    runfiles_dir: Optional[Path] = None,
+    archives: Optional[List[Path]] = None,
+) -> Dict[str, List[str]]:
+    """Lays out the modules of modules_path like runfiles, then simulates the search of the
+    dynamic loader for the DT_NEEDED libs of every ELF file. Up to workers archives are
+    extracted, then up to workers ELF files are checked, concurrently.
+    Only archives are laid out if provided, otherwise the modules locked in modules_path.
+    Returns the unresolved libs per ELF file, relative to the runfiles dir."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = runfiles_dir or Path(temp_dir)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            files = [
+                file
+                for module_root in layout_modules(
+                    modules_path, root, archives, executor
+                )
+                for file in _walk_regular_files(module_root)
+            ]
+            unresolved_libs = executor.map(_get_unresolved_libs, files)
+            return {
+                file.relative_to(root).as_posix(): libs
+                for file, libs in sorted(zip(files, unresolved_libs))
+                if libs
+            }
@@ -1,8 +1,9 @@
 from packaging import version as packaging_version
 from pathlib import Path
-from typing import Final, Optional
+from typing import Final, Optional, Tuple
 
 import dataclasses
+import functools
 import logging
 import re
 import subprocess
@@ -139,7 +140,87 @@ def compare_debian_versions(version_1: DebianVersion, version_2: DebianVersion)
     return 0
 
 
+def _split_dpkg_version(version: str) -> Tuple[int, str, str]:
+    "Splits version into its epoch, upstream version and debian revision"
+    epoch, _, rest = version.partition(":") if ":" in version else ("0", "", version)
+    upstream, _, revision = rest.rpartition("-") if "-" in rest else (rest, "", "")
+    try:
+        return int(epoch or "0"), upstream, revision
+    except ValueError:
+        raise ValueError(f"Invalid Debian version string: {version}") from None
+
+
+def _get_dpkg_order(part: str, index: int) -> int:
+    """~ sorts before everything, even the end of the part, then the end of the part and the
+    digits, then the letters, then the other chars"""
+    if index >= len(part) or part[index].isdigit():
+        return 0
+    if part[index] == "~":
+        return -1
+    if part[index].isalpha():
+        return ord(part[index])
+
+    return ord(part[index]) + 256
+
+
+def _compare_dpkg_parts(part_1: str, part_2: str) -> int:
+    "Compares two upstream versions or revisions the way dpkg does"
+    i = j = 0
+    while i < len(part_1) or j < len(part_2):
+        # the non-digit prefixes are compared char by char
+        while (i < len(part_1) and not part_1[i].isdigit()) or (
+            j < len(part_2) and not part_2[j].isdigit()
+        ):
+            order_1 = _get_dpkg_order(part_1, i)
+            order_2 = _get_dpkg_order(part_2, j)
+            if order_1 != order_2:
+                return -1 if order_1 < order_2 else 1
+            i += 1
+            j += 1
+
+        # then the digit prefixes are compared numerically
+        digits_start_1, digits_start_2 = i, j
+        while i < len(part_1) and part_1[i].isdigit():
+            i += 1
+        while j < len(part_2) and part_2[j].isdigit():
+            j += 1
+        number_1 = int(part_1[digits_start_1:i] or "0")
+        number_2 = int(part_2[digits_start_2:j] or "0")
+        if number_1 != number_2:
+            return -1 if number_1 < number_2 else 1
+
+    return 0
+
+
+def compare_dpkg_versions(version_1: str, version_2: str) -> int:
+    """Compares two debian versions exactly like dpkg --compare-versions: the epochs
+    numerically, then the upstream versions and the revisions, where ~ sorts first.
+    returns 1 if version1 > version2, -1 if version2 > version1 and 0 if version1 = version2.
+    """
+    epoch_1, upstream_1, revision_1 = _split_dpkg_version(version_1)
+    epoch_2, upstream_2, revision_2 = _split_dpkg_version(version_2)
+    if epoch_1 != epoch_2:
+        return -1 if epoch_1 < epoch_2 else 1
+
+    return _compare_dpkg_parts(upstream_1, upstream_2) or _compare_dpkg_parts(
+        revision_1, revision_2
+    )
+
+
 def get_package_version(name: str, arch: str) -> str:
     "Get package version from apt-cache."
 
     return _get_deb_package_version_from_aptcache(name, arch)
+
+
+@functools.lru_cache(maxsize=None)
+def has_package_version(name: str, arch: str) -> bool:
+    "Purely virtual packages, only provided by others, have no version in apt-cache."
+    return (
+        subprocess.run(
+            ["apt-cache", "show", f"{name}:{arch}"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+        == 0
+    )
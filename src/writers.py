@@ -1,12 +1,22 @@
 from pathlib import Path
-from typing import Any, Dict, Final
+from typing import Any, Dict, Final, Iterable, List, Optional
 
 import json
 import base64
+import dataclasses
+import functools
 import hashlib
-
-from src.package import Package
+import operator
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from src.manifest import MANIFEST_FILE, get_manifest_content
+from src.package import Package, PackageFile, PackageMetadata, RegistryMetadata
 from src.module import get_module_name, get_module_version
+from src.version import compare_version_strings
 
 LINUX_PLATFORM: Final = "@platforms//os:linux"
 X86_64_CPU: Final = "@platforms//cpu:x86_64"
@@ -14,14 +24,239 @@ BUILD_FILE: Final = Path("BUILD")
 MODULE_DOT_BAZEL: Final = Path("MODULE.bazel")
 NAME_DOT_TXT: Final = "name.txt"
 VERSION_DOT_TXT: Final = "version.txt"
+WORKSPACE_FILE: Final = Path("WORKSPACE")
+RPATHS_DOT_JSON: Final = Path("rpaths.json")
+SHARED_LIBRARY_SUFFIX: Final = ".so"
+BAZEL_REGISTRY_DOT_JSON: Final = Path("bazel_registry.json")
+SOURCE_DOT_JSON: Final = Path("source.json")
+METADATA_DOT_JSON: Final = Path("metadata.json")
+REGISTRY_MODULES_DIR: Final = Path("modules")
+ARCHIVES_FILE_HEADER: Final = '''"""This file was generated automatically by the debian dependency bazerlizer.
+"""
+
+http_archive = use_repo_rule("@bazel_tools//tools/build_defs/repo:http.bzl", "http_archive")
+
+'''
+HTTP_ARCHIVE_PATTERN: Final = re.compile(
+    r'^(?:http_archive|layered_archive)\(\n    name = "(?P<name>[^"]*)",\n.*?^\)\n',
+    re.MULTILINE | re.DOTALL,
+)
+LAYERED_ARCHIVE_DOT_BZL: Final = Path("layered_archive.bzl")
+LAYERED_ARCHIVE_BZL_CONTENT: Final = '''"""This file was generated automatically by the debian dependency bazerlizer.
+"""
+
+def _layered_archive_impl(repository_ctx):
+    # the layers share the same prefix, so they are extracted on top of each other. Each of them
+    # is cached by its integrity, so only the layers whose content changed are downloaded.
+    for url, integrity in zip(repository_ctx.attr.urls, repository_ctx.attr.integrities):
+        repository_ctx.download_and_extract(
+            url = url,
+            integrity = integrity,
+            stripPrefix = repository_ctx.attr.strip_prefix,
+        )
+    repository_ctx.symlink(repository_ctx.attr.build_file, "BUILD.bazel")
+
+layered_archive = repository_rule(
+    implementation = _layered_archive_impl,
+    attrs = {
+        "build_file": attr.label(allow_single_file = True, mandatory = True),
+        "integrities": attr.string_list(mandatory = True),
+        "strip_prefix": attr.string(),
+        "urls": attr.string_list(mandatory = True),
+    },
+)
+'''
+LAYERED_ARCHIVE_BUILD_FILE_PATTERN: Final = re.compile(
+    r'^layered_archive\(\n.*?^    build_file = "(?P<package>[^":]*):',
+    re.MULTILINE | re.DOTALL,
+)
+
+
+@dataclasses.dataclass
+class WriteStats:
+    """Counts the files written, and the ones skipped because their content did not change."""
+
+    written: int = 0
+    skipped: int = 0
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    def record(self, written: bool):
+        with self._lock:
+            if written:
+                self.written += 1
+            else:
+                self.skipped += 1
+
+
+WRITE_STATS: Final = WriteStats()
+# the archives file is shared by all the packages, while each package has its own files
+_ARCHIVES_FILE_LOCK: Final = threading.Lock()
+
+
+def _write_if_changed(file: Path, content: str) -> bool:
+    """Writes content to file, unless file already has this exact content, so that its mtime
+    is kept. The content is written to a temporary file first, then renamed over file, so
+    that readers never see a partially written file. Returns whether file was written."""
+    data = content.encode("utf-8")
+    try:
+        if file.read_bytes() == data:
+            WRITE_STATS.record(written=False)
+            return False
+        mode = file.stat().st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+
+    file.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(dir=file.parent, prefix=f".{file.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(temp_file, mode)
+        os.replace(temp_file, file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+        raise
+
+    WRITE_STATS.record(written=True)
+    return True
+
+
+def link_or_copy(source: Path, destination: Path):
+    """Hardlinks source to destination, or copies it if they are on different file systems.
+    Nothing is done if destination already is a hardlink of source."""
+    if destination.exists() and os.path.samefile(source, destination):
+        return
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    if destination.exists() or destination.is_symlink():
+        destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def get_integrity_from_digest(sha256_digest: bytes) -> str:
+    "Returns the subresource integrity string of a sha256 digest"
+    hash_base64 = base64.b64encode(sha256_digest).decode()
+    return f"sha256-{hash_base64}"
 
 
 def _get_integrity_for_file(debian_module_tar: Path):
     with debian_module_tar.open("rb") as f:
         files_content = f.read()
-    hash = hashlib.sha256(files_content).digest()
-    hash_base64 = base64.b64encode(hash).decode()
-    return f"sha256-{hash_base64}"
+    return get_integrity_from_digest(hashlib.sha256(files_content).digest())
+
+
+def get_generated_files(package: Package) -> List[str]:
+    "Returns the files generated by the bazelizer on top of the debian package content"
+    return [
+        str(WORKSPACE_FILE),
+        str(MODULE_DOT_BAZEL),
+        str(RPATHS_DOT_JSON),
+        str(MANIFEST_FILE),
+        f"{package.module_name}_paths.py",
+        f"{package.module_name}_paths.hh",
+    ]
+
+
+def is_shared_library(file: Path) -> bool:
+    "libfoo.so, libfoo.so.1 and libfoo.so.1.2.3 are all shared libraries"
+    return SHARED_LIBRARY_SUFFIX in file.suffixes
+
+
+def _split_package_files(package: Package):
+    "Splits the package files into sorted lists of shared libs, binaries and data files"
+    libs, bins, data = [], [], []
+    for package_file in package.files:
+        if not package_file.is_elf:
+            data.append(package_file.path.as_posix())
+        elif is_shared_library(package_file.path):
+            libs.append(package_file.path.as_posix())
+        else:
+            bins.append(package_file.path.as_posix())
+
+    return sorted(libs), sorted(bins), sorted(data)
+
+
+def _get_list_content(items: Iterable[str], indent: str = "    ") -> str:
+    "Formats items as a multiline starlark list"
+    list_content = "".join(f'{indent}    "{item}",\n' for item in items)
+    if not list_content:
+        return "[]"
+
+    return f"[\n{list_content}{indent}]"
+
+
+def _create_single_filegroup_content(
+    package: Package, name: str, srcs: str, data: List[str]
+):
+    "Creates the content of a single filegroup"
+    file_group_content = f"""filegroup(
+    name = "{name}",
+    srcs = {srcs},"""
+
+    if data:
+        file_group_content += f"\n    data = {_get_list_content(data)},"
+
+    if package.tags:
+        file_group_content += f"\n    tags = [{_get_tags_str(package)}],"
+
+    file_group_content += '\n    visibility = ["//visibility:public"],\n)'
+
+    return file_group_content
+
+
+def _get_tags_str(package: Package) -> str:
+    return ", ".join(sorted(package.tags))
+
+
+def _sorted_metadatas(metadatas: Iterable[PackageMetadata]) -> List[PackageMetadata]:
+    return sorted(metadatas, key=operator.attrgetter("name", "arch", "version"))
+
+
+def _get_package_metadata(package: Package) -> PackageMetadata:
+    return PackageMetadata(
+        name=package.name, arch=package.arch, version=package.version
+    )
+
+
+def _get_deps_module_names(package: Package) -> List[str]:
+    """Returns the sorted module names of the deps, apart from the ones in a cycle with package.
+    They are computed once per package, then turned into the labels of each filegroup."""
+    deps = package.deps - package.cycle_peers - {_get_package_metadata(package)}
+    return sorted(get_module_name(dep.name, dep.arch) for dep in deps)
+
+
+def _get_deps_labels(deps_module_names: List[str], target: str) -> List[str]:
+    return [f"@{module_name}//:{target}" for module_name in deps_module_names]
+
+
+def _create_dep_filegroups_content(
+    package: Package, name: str, srcs: str, deps_module_names: List[str]
+) -> List[str]:
+    """Creates a filegroup pulling in the same target of the deps.
+    Filegroups of packages in a dependency cycle can't reference each other directly, since
+    bazel rejects cyclic targets. Instead, each of them gets a <name>_own filegroup that only
+    references deps outside of the cycle, and <name> adds the <name>_own of the cycle peers."""
+    data = _get_deps_labels(deps_module_names, name)
+    if not package.cycle_peers:
+        return [_create_single_filegroup_content(package, name, srcs, data)]
+
+    own_name = f"{name}_own"
+    peers_labels = [
+        f"@{get_module_name(name=peer.name, arch=peer.arch)}//:{own_name}"
+        for peer in _sorted_metadatas(package.cycle_peers)
+    ]
+    return [
+        _create_single_filegroup_content(package, own_name, srcs, data),
+        _create_single_filegroup_content(
+            package, name, _get_list_content([f":{own_name}"]), peers_labels
+        ),
+    ]
 
 
 def _create_filegroup_content(package: Package):
@@ -29,22 +264,57 @@ def _create_filegroup_content(package: Package):
     if package.arch != "amd64":
         raise ValueError("Only amd64 architecture is supported for now")
 
-    file_group_content = """filegroup(
-    name = "all_files",
-    srcs = glob(["**"]),"""
+    deps_module_names = _get_deps_module_names(package)
+    if not package.explicit_file_lists:
+        return "\n\n".join(
+            _create_dep_filegroups_content(
+                package,
+                name="all_files",
+                srcs='glob(["**"])',
+                deps_module_names=deps_module_names,
+            )
+        )
+
+    libs, bins, data = _split_package_files(package)
+    file_groups = [
+        # shared libs only need the shared libs of the deps at runtime
+        *_create_dep_filegroups_content(
+            package,
+            name="libs",
+            srcs=_get_list_content(libs),
+            deps_module_names=deps_module_names,
+        ),
+        _create_single_filegroup_content(
+            package,
+            name="bins",
+            srcs=_get_list_content(bins),
+            data=[":libs"] + _get_deps_labels(deps_module_names, "libs"),
+        ),
+        _create_single_filegroup_content(
+            package, name="data", srcs=_get_list_content(data), data=[]
+        ),
+        *_create_dep_filegroups_content(
+            package,
+            name="all_files",
+            srcs=_get_list_content(
+                [":libs", ":bins", ":data"] + get_generated_files(package)
+            ),
+            deps_module_names=deps_module_names,
+        ),
+    ]
 
-    if package.deps:
-        file_group_content += "\n    data = [\n"
-        for dep in package.deps:
-            file_group_content += f"""      "@{get_module_name(name=dep.name, arch=dep.arch)}//:all_files",\n"""
-        file_group_content += "    ],"
+    return "\n\n".join(file_groups)
 
-    if package.tags:
-        file_group_content += f"\n    tags = [{', '.join(package.tags)}],"
 
-    file_group_content += '\n    visibility = ["//visibility:public"],\n)'
+def _create_exports_files_content(package: Package):
+    "Creates the exports_files content out of a debian package object"
+    if not package.explicit_file_lists:
+        return 'exports_files(glob(["**"]))'
 
-    return file_group_content
+    libs, bins, data = _split_package_files(package)
+    exported_files = sorted(libs + bins + data + get_generated_files(package))
+
+    return f"exports_files({_get_list_content(exported_files, indent='')})"
 
 
 def _create_build_file_content(package: Package):
@@ -53,14 +323,15 @@ def _create_build_file_content(package: Package):
         raise ValueError("Only amd64 architecture is supported for now")
 
     file_group_content = _create_filegroup_content(package)
-    tags_str = "[]" if not package.tags else f"[{', '.join(package.tags)}]"
+    exports_files_content = _create_exports_files_content(package)
+    tags_str = f"[{_get_tags_str(package)}]"
 
     return f"""load("@rules_cc//cc:defs.bzl", "cc_library")
 load("@rules_python//python:defs.bzl", "py_library")
 
 {file_group_content}
 
-exports_files(glob(["**"]))
+{exports_files_content}
 
 py_library(
     name = "{package.module_name}_paths_py",
@@ -101,12 +372,13 @@ def _create_module_file_content(package: Package):
         """bazel_dep(name = "rules_cc", version = "0.0.9")""",
         """bazel_dep(name = "platforms", version = "0.0.6")""",
     ]
-    for dep in package.deps:
-        module_name = get_module_name(name=dep.name, arch=dep.arch)
-        module_version = get_module_version(dep.version)
-        bazel_dep_list.append(
-            f"""bazel_dep(name = "{module_name}", version = "{module_version}")"""
+    # sorted by module name, which the lines start with
+    bazel_dep_list.extend(
+        sorted(
+            f"""bazel_dep(name = "{get_module_name(dep.name, dep.arch)}", version = "{get_module_version(dep.version)}")"""
+            for dep in package.deps
         )
+    )
 
     bazel_deps = "\n" + "\n".join(bazel_dep_list) + "\n"
 
@@ -119,36 +391,94 @@ def _create_module_file_content(package: Package):
 
 
 def _create_paths_python_file_content(rpaths: Dict[str, str]):
-    rpaths_str = str(rpaths)
-    return f"""def paths():
+    rpaths_str = "".join(
+        f"    {repr(key)}: {repr(value)},\n" for key, value in sorted(rpaths.items())
+    )
+    return f"""import types
+
+# ELF files mapped to their relative location in the runfiles.
+PATHS = types.MappingProxyType({{
+{rpaths_str}}})
+
+
+def find(name):
+    "Returns the relative location of the ELF file name in the runfiles, or None if not found."
+    return PATHS.get(name)
+
+
+def paths():
     "Returns a dict of ELF files mapped to their relative location in the runfiles."
-    return {rpaths_str}
+    return dict(PATHS)
 
 """
 
 
-def _get_cpp_map_from_python_dict(python_dict: Dict[str, str]):
-    s = "{"
-    for item in python_dict.items():
-        s = f'{s}{{"{item[0]}", "{item[1]}"}}, '
-
-    return s[:-2] + "}"
+def _get_cpp_entries_from_python_dict(python_dict: Dict[str, str]):
+    "Returns the content of a constant table of entries sorted by key"
+    return "".join(
+        f'    Entry{{"{key}", "{value}"}},\n'
+        for key, value in sorted(python_dict.items())
+    )
 
 
 def _create_paths_cpp_file_content(rpaths: Dict[str, str], package_name: str):
-    map_str = _get_cpp_map_from_python_dict(rpaths)
+    entries_str = _get_cpp_entries_from_python_dict(rpaths)
     return f"""
 #pragma once
 
+#include <cstddef>
+#include <cstring>
 #include <map>
 #include <string>
+#include <utility>
 
 namespace {package_name}_paths
 {{
+using Entry = std::pair<const char*, const char*>;
+
+/// The number of executables in {package_name}_paths.
+static const std::size_t kPathsSize = {len(rpaths)};
+
+/// The paths of executables in {package_name}_paths, sorted by name.
+/// The trailing null entry keeps the table valid when it is empty.
+static const Entry kPaths[kPathsSize + 1] = {{
+{entries_str}    Entry{{nullptr, nullptr}},
+}};
+
+/// Returns the path of the executable name, or nullptr if not found.
+/// The lookup is a binary search over kPaths and does not allocate.
+inline const char* find(const char* name)
+{{
+    std::size_t first = 0;
+    std::size_t last = kPathsSize;
+    while (first < last)
+    {{
+        const std::size_t middle = first + (last - first) / 2;
+        if (std::strcmp(kPaths[middle].first, name) < 0)
+        {{
+            first = middle + 1;
+        }}
+        else
+        {{
+            last = middle;
+        }}
+    }}
+    if (first < kPathsSize && std::strcmp(kPaths[first].first, name) == 0)
+    {{
+        return kPaths[first].second;
+    }}
+    return nullptr;
+}}
+
 /// Returns the paths of executables in {package_name}_paths.
 inline std::map<std::string, std::string> paths()
 {{
-    return {map_str};
+    std::map<std::string, std::string> result;
+    for (std::size_t i = 0; i < kPathsSize; ++i)
+    {{
+        result.emplace(kPaths[i].first, kPaths[i].second);
+    }}
+    return result;
 }}
 }}
 
@@ -168,10 +498,30 @@ def _create_http_archive_text(
 """
 
 
-def write_module_file(package: Package):
+def _create_layered_archive_text(
+    name: str,
+    build_file: str,
+    integrities: List[str],
+    prefix: str,
+    urls: List[str],
+):
+    return f"""layered_archive(
+    name = "{name}",
+    build_file = "{build_file}",
+    integrities = {_get_list_content(integrities)},
+    strip_prefix = "{prefix}",
+    urls = {_get_list_content(urls)},
+)
+"""
+
+
+def write_module_file(package: Package) -> str:
     "Writes a MODULE.bazel file declaring the package as a module and listing its bazel_deps"
     file = Path(package.package_dir / MODULE_DOT_BAZEL)
-    file.write_text(_create_module_file_content(package))
+    module_file_content = _create_module_file_content(package)
+    _write_if_changed(file, module_file_content)
+
+    return module_file_content
 
 
 def write_build_file(package: Package):
@@ -185,54 +535,139 @@ def write_build_file(package: Package):
     else:
         file = Path(package.package_dir / BUILD_FILE)
 
-    file.parent.mkdir(parents=True, exist_ok=True)
-    file.write_text(_create_build_file_content(package))
+    _write_if_changed(file, _create_build_file_content(package))
 
 
 def write_python_path_file(rpaths: Dict[str, str], file: Path):
     "Writes a python file exposing the paths of ELF files"
     full_rpaths = {key: "../" + value + "/" + key for key, value in rpaths.items()}
-    file.write_text(_create_paths_python_file_content(full_rpaths))
+    _write_if_changed(file, _create_paths_python_file_content(full_rpaths))
 
 
 def write_cpp_path_file(rpaths: Dict[str, str], package_name: str, file: Path):
     "Writes a python file exposing the paths of ELF files"
     full_rpaths = {key: "../" + value + "/" + key for key, value in rpaths.items()}
-    file.write_text(_create_paths_cpp_file_content(full_rpaths, package_name))
+    _write_if_changed(file, _create_paths_cpp_file_content(full_rpaths, package_name))
+
+
+def write_manifest_file(files: Iterable[PackageFile], file: Path):
+    "Writes the manifest listing the path, size, sha256, mode and ELF kind of files"
+    _write_if_changed(file, get_manifest_content(files))
 
 
 def json_dump(json_file: Path, obj: Dict[Any, Any], sort_keys=True):
     "Dumps json content into json file"
-    json_file.write_text(json.dumps(obj, indent=4, sort_keys=sort_keys) + "\n")
+    _write_if_changed(json_file, json.dumps(obj, indent=4, sort_keys=sort_keys) + "\n")
+
+
+def write_json_lines(file: Path, objs: Iterable[Dict[str, Any]]):
+    "Dumps json objects into file, one per line"
+    _write_if_changed(
+        file, "".join(json.dumps(obj, sort_keys=True) + "\n" for obj in objs)
+    )
+
+
+def read_http_archives(file: Path) -> Dict[str, str]:
+    "Returns the http_archive texts of the archives file, by name"
+    if not file.exists():
+        return {}
+
+    return {
+        match.group("name"): match.group(0)
+        for match in HTTP_ARCHIVE_PATTERN.finditer(file.read_text())
+    }
+
 
+def _get_archives_file_header(http_archives: Dict[str, str]) -> str:
+    """The layered_archive rule is only loaded if the archives file uses it, from the package
+    of the detached BUILD files, next to which it is generated."""
+    for http_archive in http_archives.values():
+        match = LAYERED_ARCHIVE_BUILD_FILE_PATTERN.match(http_archive)
+        if match:
+            return (
+                ARCHIVES_FILE_HEADER
+                + f'layered_archive = use_repo_rule("{match.group("package")}:{LAYERED_ARCHIVE_DOT_BZL}", "layered_archive")\n\n'
+            )
+
+    return ARCHIVES_FILE_HEADER
+
+
+def write_http_archives(file: Path, http_archives: Dict[str, str]):
+    "Writes the http_archive texts into the archives file, sorted by name"
+    _write_if_changed(
+        file,
+        _get_archives_file_header(http_archives)
+        + "".join(http_archives[name] + "\n" for name in sorted(http_archives)),
+    )
 
-def write_http_archive(package: Package, debian_module_tar: Path):
-    "Writes a http_archive file for the debian module"
+
+def write_http_archive(
+    package: Package, debian_module_tar: Path, integrity: Optional[str] = None
+):
+    """Adds or replaces the http_archive of the debian module in the archives file.
+    The http_archives are sorted by name, so the file only changes with its content."""
     if not package.detached_mode_metadata:
         return
 
+    name = get_module_name(name=package.name, arch=package.arch)
+    http_archive = _create_http_archive_text(
+        name=name,
+        prefix=package.prefix,
+        url=f"{package.detached_mode_metadata.url_prefix}/{str(debian_module_tar)}",
+        integrity=integrity or _get_integrity_for_file(debian_module_tar),
+        build_file=f"{str(package.detached_mode_metadata.build_file_package)}:{package.module_name}/{package.module_name}.BUILD",
+    )
     file = package.detached_mode_metadata.archives_file
-    file.parent.mkdir(parents=True, exist_ok=True)
-    content = file.read_text() if file.exists() else ""
-    if not content:
-        content = '''"""This file was generated automatically by the debian dependency bazerlizer.
-"""
+    with _ARCHIVES_FILE_LOCK:
+        http_archives = read_http_archives(file)
+        http_archives[name] = http_archive
+        write_http_archives(file, http_archives)
 
-http_archive = use_repo_rule("@bazel_tools//tools/build_defs/repo:http.bzl", "http_archive")
 
-'''
+def write_layered_archive(
+    package: Package, layer_tars: List[Path], integrities: List[str]
+):
+    """Adds or replaces the layered_archive of the debian module in the archives file, which
+    stitches the layer archives of the module back together. The layered_archive rule is
+    generated next to the detached BUILD files."""
+    if not package.detached_mode_metadata:
+        return
 
-    file.write_text(
-        content
-        + _create_http_archive_text(
-            name=get_module_name(name=package.name, arch=package.arch),
-            prefix=package.prefix,
-            url=f"{package.detached_mode_metadata.url_prefix}/{str(debian_module_tar)}",
-            integrity=_get_integrity_for_file(debian_module_tar),
-            build_file=f"{str(package.detached_mode_metadata.build_file_package)}:{package.module_name}/{package.module_name}.BUILD",
-        )
-        + "\n"
+    _write_if_changed(
+        package.detached_mode_metadata.build_files_dir / LAYERED_ARCHIVE_DOT_BZL,
+        LAYERED_ARCHIVE_BZL_CONTENT,
     )
+    name = get_module_name(name=package.name, arch=package.arch)
+    layered_archive = _create_layered_archive_text(
+        name=name,
+        prefix=package.prefix,
+        urls=[
+            f"{package.detached_mode_metadata.url_prefix}/{layer_tar.name}"
+            for layer_tar in layer_tars
+        ],
+        integrities=integrities,
+        build_file=f"{str(package.detached_mode_metadata.build_file_package)}:{package.module_name}/{package.module_name}.BUILD",
+    )
+    file = package.detached_mode_metadata.archives_file
+    with _ARCHIVES_FILE_LOCK:
+        http_archives = read_http_archives(file)
+        http_archives[name] = layered_archive
+        write_http_archives(file, http_archives)
+
+
+def prune_http_archives(archives_file: Path, names: Iterable[str]):
+    "Removes the http_archives that are not in names, left over by previous runs"
+    with _ARCHIVES_FILE_LOCK:
+        http_archives = read_http_archives(archives_file)
+        kept_names = set(names)
+        write_http_archives(
+            archives_file,
+            {
+                name: http_archive
+                for name, http_archive in http_archives.items()
+                if name in kept_names
+            },
+        )
 
 
 def write_name_txt_file(package: Package):
@@ -243,7 +678,7 @@ def write_name_txt_file(package: Package):
         / package.module_name
         / NAME_DOT_TXT
     )
-    file.write_text(f"{package.name}\n")
+    _write_if_changed(file, f"{package.name}\n")
 
 
 def write_version_txt_file(package: Package):
@@ -254,4 +689,66 @@ def write_version_txt_file(package: Package):
         / package.module_name
         / VERSION_DOT_TXT
     )
-    file.write_text(f"{package.version}\n")
+    _write_if_changed(file, f"{package.version}\n")
+
+
+def _merge_registry_versions(metadata_file: Path, version: str) -> List[str]:
+    "Returns the sorted versions listed in metadata_file, merged with version"
+    versions = set([version])
+    if metadata_file.exists():
+        versions.update(json.loads(metadata_file.read_text()).get("versions", []))
+
+    return sorted(versions, key=functools.cmp_to_key(compare_version_strings))
+
+
+def write_registry_version(
+    registry_dir: Path,
+    module_name: str,
+    version: str,
+    module_file_content: str,
+    source: Dict[str, str],
+):
+    "Adds a version of a module to a local bazel registry, and lists it in the module metadata"
+    registry_dir.mkdir(parents=True, exist_ok=True)
+    if not (registry_dir / BAZEL_REGISTRY_DOT_JSON).exists():
+        json_dump(registry_dir / BAZEL_REGISTRY_DOT_JSON, {"mirrors": []})
+
+    module_dir = registry_dir / REGISTRY_MODULES_DIR / module_name
+    version_dir = module_dir / version
+    version_dir.mkdir(parents=True, exist_ok=True)
+
+    _write_if_changed(version_dir / MODULE_DOT_BAZEL, module_file_content)
+    json_dump(version_dir / SOURCE_DOT_JSON, source)
+
+    metadata_file = module_dir / METADATA_DOT_JSON
+    json_dump(
+        metadata_file,
+        {
+            "homepage": "",
+            "maintainers": [],
+            "versions": _merge_registry_versions(metadata_file, version),
+            "yanked_versions": {},
+        },
+    )
+
+
+def write_registry_module(
+    registry_metadata: RegistryMetadata,
+    package: Package,
+    module_file_content: str,
+    integrity: str,
+    debian_module_tar: Path,
+):
+    """Adds the module to a local bazel registry, reusing the already computed MODULE.bazel
+    content and archive integrity."""
+    write_registry_version(
+        registry_dir=registry_metadata.registry_dir,
+        module_name=package.module_name,
+        version=get_module_version(package.version),
+        module_file_content=module_file_content,
+        source={
+            "integrity": integrity,
+            "strip_prefix": package.prefix,
+            "url": f"{registry_metadata.url_prefix}/{debian_module_tar.name}",
+        },
+    )
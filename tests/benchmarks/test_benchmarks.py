@@ -0,0 +1,96 @@
+"""Micro-benchmarks of the pure-python hot paths, run on synthetic data."""
+
+from pathlib import Path
+
+import functools
+import random
+
+import pytest
+import sys
+
+pytest.importorskip("pytest_benchmark")
+
+# deselected from the default test run, see pytest.ini
+pytestmark = pytest.mark.benchmarks
+
+from src.package import Package, PackageMetadata  # noqa: E402
+from src.read_input_files import read_input_files  # noqa: E402
+from src.version import DebianVersion, compare_version_strings  # noqa: E402
+from src.writers import (  # noqa: E402
+    _create_build_file_content,
+    _create_module_file_content,
+    _get_cpp_entries_from_python_dict,
+)
+
+NUM_VERSIONS = 2000
+NUM_INPUT_PACKAGES = 20000
+NUM_DEPS = 500
+NUM_PATHS = 5000
+
+
+def _get_versions(count: int):
+    # seeded to keep the benchmarked data identical across runs
+    rng = random.Random(0)
+    return [
+        f"{rng.choice(['', '1:', '2:'])}{rng.randint(0, 20)}.{rng.randint(0, 99)}.{rng.randint(0, 9)}"
+        f"{rng.choice(['', '+dfsg', '~rc1', '+really1.2'])}-{rng.randint(1, 9)}ubuntu{rng.randint(0, 3)}"
+        for _ in range(count)
+    ]
+
+
+def _get_package(num_deps: int):
+    return Package(
+        name="test-package",
+        version="1.0.0",
+        arch="amd64",
+        module_name="test_package_amd64",
+        deps={
+            PackageMetadata(name=f"dep-{i}", arch="amd64", version=f"{i}.0")
+            for i in range(num_deps)
+        },
+        tags={'"manual"', '"no-remote"'},
+    )
+
+
+def test_debian_version_parsing(benchmark):
+    versions = _get_versions(NUM_VERSIONS)
+    benchmark(lambda: [DebianVersion(version) for version in versions])
+
+
+def test_compare_version_strings(benchmark):
+    versions = _get_versions(NUM_VERSIONS)
+    benchmark(sorted, versions, key=functools.cmp_to_key(compare_version_strings))
+
+
+def test_read_input_files(benchmark, tmp_path):
+    versions = _get_versions(NUM_INPUT_PACKAGES)
+    input_file = tmp_path / "deb_packages.in"
+    input_file.write_text(
+        "# synthetic input file\n"
+        + "\n".join(
+            # a few packages are listed several times with different versions
+            f"package-{i % (NUM_INPUT_PACKAGES // 2)}:amd64={version}"
+            for i, version in enumerate(versions)
+        )
+        + "\n"
+    )
+    benchmark(read_input_files, input_files=[Path(input_file)])
+
+
+def test_create_build_file_content(benchmark):
+    package = _get_package(NUM_DEPS)
+    benchmark(_create_build_file_content, package)
+
+
+def test_create_module_file_content(benchmark):
+    package = _get_package(NUM_DEPS)
+    benchmark(_create_module_file_content, package)
+
+
+def test_get_cpp_entries_from_python_dict(benchmark):
+    paths = {f"file_{i}": f"../module/usr/lib/file_{i}" for i in range(NUM_PATHS)}
+    benchmark(_get_cpp_entries_from_python_dict, paths)
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
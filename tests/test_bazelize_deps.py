@@ -1,8 +1,36 @@
+from pathlib import Path
+from typing import Dict, Optional
+
+import functools
+import hashlib
+import json
+import threading
+
 import pytest
 import sys
-from pathlib import Path
-from src.bazelize_deps import _add_deps_to_stack
-from src.package import Package, PackageMetadata
+
+from src import bazelize_deps as bazelize_deps_module
+from src.bazelize_deps import _add_deps_to_stack, _get_shard_cost, bazelize_deps
+from src.package import (
+    DetachedModeMetadata,
+    Package,
+    PackageMetadata,
+    RegistryMetadata,
+    ShardMetadata,
+)
+from src.lockfile import LOCKFILE
+from src.package_factory import init_deb_package
+from src.shard import merge_shards, wait_for_modules
+from src.timings import TIMINGS_DOT_JSON, TimingDatabase
+from src.writers import (
+    _create_module_file_content,
+    get_integrity_from_digest,
+    write_build_file,
+    write_http_archive,
+    write_name_txt_file,
+    write_registry_module,
+    write_version_txt_file,
+)
 
 
 def test_add_deps_to_stack():
@@ -41,5 +69,268 @@ def test_add_deps_to_stack():
     assert result is False  # No deps were added
 
 
+def test_shards_run_locally_against_a_shared_dir(mocker, tmp_path):
+    libc, libz, bash = (
+        PackageMetadata(name=name, arch="amd64", version="1.0")
+        for name in ["libc6", "libz", "bash"]
+    )
+    resolved_graph = {libc: set(), libz: {libc}, bash: {libz, libc}}
+    mocker.patch.object(
+        bazelize_deps_module, "resolve_versions", return_value=resolved_graph
+    )
+
+    def create_deb_package(metadata, deps, **_):
+        return Package(
+            name=metadata.name,
+            arch=metadata.arch,
+            version=metadata.version,
+            pinned_name=f"{metadata.name}:amd64=1.0",
+            deps=set(deps),
+            rpaths={f"lib{metadata.name}.so": f"{metadata.name}/lib"},
+        )
+
+    def modularize_package(package, modules, modules_path, **_):
+        # the deps of other shards must be known before patching
+        assert all(dep in modules for dep in package.deps)
+        modules_path.mkdir(parents=True, exist_ok=True)
+        archive = modules_path / f"{package.name}.tar.gz"
+        rpaths = {}
+        for dep in package.deps:
+            rpaths.update(modules[dep].rpaths)
+        archive.write_text(json.dumps(rpaths, sort_keys=True))
+        return archive
+
+    mocker.patch.object(
+        bazelize_deps_module, "create_deb_package", side_effect=create_deb_package
+    )
+    mocker.patch.object(
+        bazelize_deps_module, "modularize_package", side_effect=modularize_package
+    )
+    mocker.patch.object(bazelize_deps_module, "_print_summary")
+    # libc6 alone weighs as much as two shards
+    installed_sizes = {"libc6": 1000}
+    mocker.patch.object(
+        bazelize_deps_module,
+        "get_installed_size",
+        side_effect=lambda metadata, _: installed_sizes.get(metadata.name, 1),
+    )
+    mocker.patch.object(
+        bazelize_deps_module,
+        "wait_for_modules",
+        side_effect=functools.partial(wait_for_modules, poll_interval=0.01),
+    )
+
+    shard_dir = tmp_path / "shared"
+    shards = [
+        threading.Thread(
+            target=bazelize_deps,
+            kwargs=dict(
+                input_package_metadatas={bash},
+                modules_path=tmp_path / f"shard_{index}",
+                shard_metadata=ShardMetadata(index=index, count=3, shard_dir=shard_dir),
+            ),
+        )
+        for index in (3, 2, 1)
+    ]
+    for shard in shards:
+        shard.start()
+    for shard in shards:
+        shard.join()
+
+    packages = merge_shards(
+        [tmp_path / f"shard_{index}" for index in (1, 2, 3)], tmp_path / "modules"
+    )
+    assert packages == ["bash:amd64=1.0", "libc6:amd64=1.0", "libz:amd64=1.0"]
+    assert [
+        sorted(path.name for path in (tmp_path / f"shard_{index}").glob("*.tar.gz"))
+        for index in (1, 2, 3)
+    ] == [[], ["libc6.tar.gz"], ["bash.tar.gz", "libz.tar.gz"]]
+    assert json.loads((tmp_path / "modules" / "bash.tar.gz").read_text()) == {
+        "liblibc6.so": "libc6/lib",
+        "liblibz.so": "libz/lib",
+    }
+
+
+def _read_tree(directory: Path, replacements: Dict[str, str]) -> Dict[str, str]:
+    contents = {}
+    for file in sorted(directory.rglob("*")):
+        if file.is_file():
+            content = file.read_text()
+            for old, new in replacements.items():
+                content = content.replace(old, new)
+            contents[file.relative_to(directory).as_posix()] = content
+    return contents
+
+
+def test_merged_shards_match_a_single_run(mocker, tmp_path):
+    libc, libz, bash = (
+        PackageMetadata(name=name, arch="amd64", version="1.0")
+        for name in ["libc6", "libz", "bash"]
+    )
+    resolved_graph = {libc: set(), libz: {libc}, bash: {libz, libc}}
+    mocker.patch.object(
+        bazelize_deps_module, "resolve_versions", return_value=resolved_graph
+    )
+
+    def create_deb_package(metadata, deps, detached_mode_metadata, **_):
+        package = init_deb_package(
+            metadata, detached_mode_metadata=detached_mode_metadata
+        )
+        package.deps = set(deps)
+        package.rpaths = {f"lib{metadata.name}.so": f"{metadata.name}/lib"}
+        return package
+
+    def modularize_package(package, modules, modules_path, registry_metadata, **_):
+        # writes the detached files and the registry module like package_module does
+        modules_path.mkdir(parents=True, exist_ok=True)
+        archive = modules_path / f"{package.prefix_version}.tar.gz"
+        archive.write_text(package.name)
+        integrity = get_integrity_from_digest(hashlib.sha256(b"").digest())
+        write_build_file(package)
+        write_name_txt_file(package)
+        write_version_txt_file(package)
+        write_http_archive(package, Path(archive.name), integrity)
+        write_registry_module(
+            registry_metadata=registry_metadata,
+            package=package,
+            module_file_content=_create_module_file_content(package),
+            integrity=integrity,
+            debian_module_tar=archive,
+        )
+        return archive
+
+    mocker.patch.object(
+        bazelize_deps_module, "create_deb_package", side_effect=create_deb_package
+    )
+    mocker.patch.object(
+        bazelize_deps_module, "modularize_package", side_effect=modularize_package
+    )
+    mocker.patch.object(bazelize_deps_module, "_print_summary")
+    mocker.patch.object(bazelize_deps_module, "get_installed_size", return_value=1)
+    mocker.patch.object(
+        bazelize_deps_module,
+        "wait_for_modules",
+        side_effect=functools.partial(wait_for_modules, poll_interval=0.01),
+    )
+
+    def run(name: str, shard_metadata: Optional[ShardMetadata] = None):
+        run_path = tmp_path / name
+        bazelize_deps(
+            input_package_metadatas={bash},
+            modules_path=run_path / "modules",
+            detached_mode_metadata=DetachedModeMetadata(
+                url_prefix="https://example.com",
+                build_file_package="@//build_files",
+                archives_file=run_path / "archives.MODULE.bazel",
+                build_files_dir=run_path / "build_files",
+            ),
+            registry_metadata=RegistryMetadata(
+                registry_dir=run_path / "registry",
+                url_prefix=(run_path / "modules").resolve().as_uri(),
+            ),
+            shard_metadata=shard_metadata,
+        )
+
+    run("single")
+    shards = [
+        threading.Thread(
+            target=run,
+            args=(
+                f"shard_{index}",
+                ShardMetadata(index=index, count=2, shard_dir=tmp_path / "shared"),
+            ),
+        )
+        for index in (2, 1)
+    ]
+    for shard in shards:
+        shard.start()
+    for shard in shards:
+        shard.join()
+
+    merged_path = tmp_path / "merged"
+    packages = merge_shards(
+        [tmp_path / f"shard_{index}" / "modules" for index in (1, 2)],
+        merged_path / "modules",
+        archives_file=merged_path / "archives.MODULE.bazel",
+        build_files_dir=merged_path / "build_files",
+        registry_dir=merged_path / "registry",
+    )
+    assert packages == ["bash:amd64=1.0", "libc6:amd64=1.0", "libz:amd64=1.0"]
+    # both shards did some of the work
+    assert all(
+        list((tmp_path / f"shard_{index}" / "modules").glob("*.tar.gz"))
+        for index in (1, 2)
+    )
+
+    single_path = tmp_path / "single"
+    replacements = {str(merged_path.resolve()): str(single_path.resolve())}
+    for name in ["build_files", "registry"]:
+        assert _read_tree(merged_path / name, replacements) == _read_tree(
+            single_path / name, {}
+        )
+    assert (merged_path / "archives.MODULE.bazel").read_text() == (
+        single_path / "archives.MODULE.bazel"
+    ).read_text()
+    assert (merged_path / "modules" / LOCKFILE).read_text() == (
+        single_path / "modules" / LOCKFILE
+    ).read_text()
+
+
+def test_shard_cost(mocker, tmp_path):
+    libc = PackageMetadata(name="libc6", arch="amd64", version="1.0")
+    shard_metadata = ShardMetadata(index=1, count=2, shard_dir=tmp_path)
+    mocker.patch.object(bazelize_deps_module, "get_installed_size", return_value=0)
+    # without any timings nor Installed-Size, every package weighs the same
+    assert _get_shard_cost(shard_metadata)(libc) == 1.0
+
+    database = TimingDatabase(tmp_path / TIMINGS_DOT_JSON)
+    database.record(init_deb_package(libc), "download", 4.0)
+    database.save()
+    assert _get_shard_cost(shard_metadata)(libc) == 4.0
+
+
+def test_minimal_rpaths_only_index_the_transitive_deps(mocker, tmp_path):
+    libx, liby, app = (
+        PackageMetadata(name=name, arch="amd64", version="1.0")
+        for name in ["libx", "liby", "zapp"]
+    )
+    # libx is modularized before zapp, but zapp does not depend on it
+    resolved_graph = {libx: set(), liby: set(), app: {liby}}
+    mocker.patch.object(
+        bazelize_deps_module, "resolve_versions", return_value=resolved_graph
+    )
+    mocker.patch.object(
+        bazelize_deps_module,
+        "create_deb_package",
+        side_effect=lambda metadata, deps, **_: Package(
+            name=metadata.name,
+            arch=metadata.arch,
+            version=metadata.version,
+            pinned_name=f"{metadata.name}:amd64=1.0",
+            deps=set(deps),
+            rpaths={f"{metadata.name}.so": f"{metadata.name}/lib"},
+        ),
+    )
+    soname_indexes = {}
+
+    def modularize_package(package, soname_index, modules_path, **_):
+        soname_indexes[package.name] = soname_index
+        return modules_path / f"{package.name}.tar.gz"
+
+    mocker.patch.object(
+        bazelize_deps_module, "modularize_package", side_effect=modularize_package
+    )
+    mocker.patch.object(bazelize_deps_module, "_print_summary")
+
+    bazelize_deps(
+        input_package_metadatas={libx, app},
+        modules_path=tmp_path,
+        minimal_rpaths=True,
+    )
+
+    assert list(soname_indexes) == ["libx", "liby", "zapp"]
+    assert soname_indexes["zapp"] == {"liby.so": "liby/lib"}
+
+
 if __name__ == "__main__":
     sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,133 @@
+import gzip
+import hashlib
+
+import pytest
+import sys
+
+from src.deb_source import read_local_deb_source
+from src.package import PackageMetadata
+from src.package_factory import _get_package_deps
+
+
+def _write_mirror(directory, archives, compress=False, checksum="SHA256"):
+    stanzas = []
+    for name, version, content, depends in archives:
+        filename = f"pool/{name}_{version}_amd64.deb"
+        (directory / "pool").mkdir(exist_ok=True)
+        (directory / filename).write_bytes(content)
+        stanza = f"""Package: {name}
+Version: {version}
+Architecture: amd64
+Filename: {filename}
+Description: test package
+ with a continuation line"""
+        if checksum:
+            algorithm = {"SHA256": "sha256", "SHA1": "sha1", "MD5sum": "md5"}[checksum]
+            stanza += f"\n{checksum}: {hashlib.new(algorithm, content).hexdigest()}"
+        if depends:
+            stanza += f"\nDepends: {depends}"
+        stanzas.append(stanza)
+
+    index = "\n\n".join(stanzas) + "\n"
+    if compress:
+        (directory / "Packages.gz").write_bytes(gzip.compress(index.encode()))
+    else:
+        (directory / "Packages").write_text(index)
+
+
+def test_local_deb_source(tmp_path):
+    _write_mirror(
+        tmp_path,
+        [
+            ("libfoo", "1.2-1", b"foo 1.2", ""),
+            ("libfoo", "1.10-1", b"foo 1.10", ""),
+            ("bar", "2.0", b"bar", "libfoo (>= 1.0), libbaz (= 3.0)"),
+        ],
+        compress=True,
+    )
+    deb_source = read_local_deb_source(tmp_path)
+
+    assert deb_source.get_package_version("libfoo", "amd64") == "1.10-1"
+    archive = deb_source.get_archive(
+        PackageMetadata(name="libfoo", arch="amd64", version="1.2-1")
+    )
+    assert archive.read_bytes() == b"foo 1.2"
+
+    depends = deb_source.get_entry(
+        PackageMetadata(name="bar", arch="amd64", version="2.0")
+    ).depends
+    assert _get_package_deps(depends, "amd64", deb_source) == {
+        PackageMetadata(name="libfoo", arch="amd64", version="1.10-1"),
+        PackageMetadata(name="libbaz", arch="amd64", version="3.0"),
+    }
+
+
+def test_virtual_only_deps(tmp_path):
+    _write_mirror(
+        tmp_path,
+        [
+            ("perl-base", "5.36.0-7", b"perl", ""),
+            ("perl", "5.36.0-7", b"perl", "perlapi-5.36.0, perl-base"),
+        ],
+    )
+    deb_source = read_local_deb_source(tmp_path)
+
+    depends = deb_source.get_entry(
+        PackageMetadata(name="perl", arch="amd64", version="5.36.0-7")
+    ).depends
+    assert _get_package_deps(depends, "amd64", deb_source) == {
+        PackageMetadata(name="perl-base", arch="amd64", version="5.36.0-7"),
+    }
+
+
+def test_sha256_mismatch(tmp_path):
+    _write_mirror(tmp_path, [("libfoo", "1.0", b"foo", "")])
+    (tmp_path / "pool" / "libfoo_1.0_amd64.deb").write_bytes(b"tampered")
+    deb_source = read_local_deb_source(tmp_path)
+
+    with pytest.raises(ValueError, match="SHA256 mismatch"):
+        deb_source.get_archive(
+            PackageMetadata(name="libfoo", arch="amd64", version="1.0")
+        )
+
+
+def test_checksum_fallback(tmp_path):
+    _write_mirror(tmp_path, [("libfoo", "1.0", b"foo", "")], checksum="MD5sum")
+    (tmp_path / "pool" / "libfoo_1.0_amd64.deb").write_bytes(b"tampered")
+    deb_source = read_local_deb_source(tmp_path)
+    metadata = PackageMetadata(name="libfoo", arch="amd64", version="1.0")
+
+    with pytest.raises(ValueError, match="MD5sum mismatch"):
+        deb_source.get_archive(metadata)
+
+    _write_mirror(tmp_path, [("libfoo", "1.0", b"foo", "")], checksum="")
+    with pytest.raises(ValueError, match="has no checksum in the Packages index"):
+        read_local_deb_source(tmp_path).get_archive(metadata)
+
+
+def test_newest_version(tmp_path):
+    _write_mirror(
+        tmp_path,
+        [
+            ("libc6", "2.36-9+deb12u10", b"libc6 u10", ""),
+            ("libc6", "2.36-9+deb12u4", b"libc6 u4", ""),
+            ("foo", "1:1.0-1", b"foo epoch", ""),
+            ("foo", "2.0-1", b"foo", ""),
+        ],
+    )
+    deb_source = read_local_deb_source(tmp_path)
+
+    assert deb_source.get_package_version("libc6", "amd64") == "2.36-9+deb12u10"
+    assert deb_source.get_package_version("foo", "amd64") == "1:1.0-1"
+
+
+def test_missing_package(tmp_path):
+    _write_mirror(tmp_path, [("libfoo", "1.0", b"foo", "")])
+    deb_source = read_local_deb_source(tmp_path)
+
+    with pytest.raises(ValueError, match="could not be found"):
+        deb_source.get_package_version("libbar", "amd64")
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,31 @@
+from pathlib import Path
+
+import pytest
+import sys
+
+from src.elf import parse_elf_dynamic_info, read_elf_dynamic_info
+
+
+def test_non_elf_content():
+    assert parse_elf_dynamic_info(b"#!/bin/sh\necho hello\n") is None
+    assert parse_elf_dynamic_info(b"") is None
+
+
+def test_truncated_elf_file(tmp_path):
+    file = tmp_path / "truncated.so"
+    file.write_bytes(b"\x7fELF\x02\x01\x01" + b"\0" * 9)
+    assert read_elf_dynamic_info(file) is None
+
+
+def test_dynamically_linked_executable():
+    executable = Path(sys.executable).resolve()
+    elf_info = read_elf_dynamic_info(executable)
+    if elf_info is None or not elf_info.needed:
+        pytest.skip("python interpreter is not a dynamically linked ELF file")
+
+    assert elf_info.has_interpreter
+    assert all(needed for needed in elf_info.needed)
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
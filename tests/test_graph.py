@@ -0,0 +1,54 @@
+import pytest
+import sys
+
+from src.graph import get_strongly_connected_components, get_transitive_deps
+
+
+def test_acyclic_graph():
+    graph = {"a": ["b", "c"], "b": ["c"], "c": []}
+    assert get_strongly_connected_components(graph) == [["c"], ["b"], ["a"]]
+
+
+def test_cyclic_graph():
+    # libc6 <-> libcrypt1 and perl-base <-> perl-modules like cycles
+    graph = {
+        "perl": ["perl-base", "perl-modules"],
+        "perl-base": ["perl-modules", "libc6"],
+        "perl-modules": ["perl-base"],
+        "libc6": ["libcrypt1", "libgcc-s1"],
+        "libcrypt1": ["libc6"],
+        "libgcc-s1": ["libc6"],
+    }
+    assert get_strongly_connected_components(graph) == [
+        ["libc6", "libcrypt1", "libgcc-s1"],
+        ["perl-base", "perl-modules"],
+        ["perl"],
+    ]
+
+
+def test_long_cycle_does_not_recurse():
+    graph = {i: [(i + 1) % 100000] for i in range(100000)}
+    components = get_strongly_connected_components(graph, sort_key=lambda node: node)
+    assert len(components) == 1
+    assert len(components[0]) == 100000
+
+
+def test_edges_outside_of_graph_are_ignored():
+    assert get_strongly_connected_components({"a": ["tzdata"]}) == [["a"]]
+
+
+def test_get_transitive_deps():
+    # b <-> c is a cycle, both depend on d
+    graph = {"a": ["b"], "b": ["c", "d"], "c": ["b"], "d": [], "e": ["d"]}
+    components = get_strongly_connected_components(graph)
+    assert components == [["d"], ["b", "c"], ["a"], ["e"]]
+    assert get_transitive_deps(components, graph) == [
+        [],
+        ["d"],
+        ["d", "b", "c"],
+        ["d"],
+    ]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,73 @@
+from pathlib import Path
+
+import os
+
+import pytest
+import sys
+
+from src.groups import parse_input_file, write_group_views
+from src.package import Package, PackageMetadata
+
+
+def test_parse_input_file():
+    assert parse_input_file("deb_packages.in") == ("", Path("deb_packages.in"))
+    assert parse_input_file("product_a=inputs/a.in") == (
+        "product_a",
+        Path("inputs/a.in"),
+    )
+    assert parse_input_file("inputs/version=1.in") == ("", Path("inputs/version=1.in"))
+
+
+def test_write_group_views(tmp_path):
+    modules_path = tmp_path / "modules"
+    modules_path.mkdir()
+    processed_packages = {}
+    for name in ["libc6", "bash", "python3"]:
+        metadata = PackageMetadata(name=name, arch="amd64", version="1.0")
+        processed_packages[metadata] = Package(
+            name=name,
+            arch="amd64",
+            version="1.0",
+            prefix_version=f"{name}_amd64~1.0",
+        )
+        (modules_path / f"{name}_amd64~1.0.tar.gz").write_text(name)
+    (modules_path / "libc6_amd64~1.0.debug.tar.gz").write_text("libc6 debug")
+    libc, bash, python = processed_packages
+
+    archives_file = tmp_path / "archives.MODULE.bazel"
+    archives_file.write_text(
+        "".join(
+            f'http_archive(\n    name = "{name}_amd64",\n)\n\n'
+            for name in ["bash", "libc6", "python3"]
+        )
+    )
+    stale_archive = modules_path / "groups" / "shell" / "zsh_amd64~1.0.tar.gz"
+    stale_archive.parent.mkdir(parents=True)
+    stale_archive.write_text("zsh")
+
+    write_group_views(
+        group_closures={"shell": {bash, libc}, "scripting": {python, libc}},
+        processed_packages=processed_packages,
+        modules_path=modules_path,
+        archives_file=archives_file,
+    )
+
+    shell_view = modules_path / "groups" / "shell"
+    assert sorted(path.name for path in shell_view.iterdir()) == [
+        "bash_amd64~1.0.tar.gz",
+        "libc6_amd64~1.0.debug.tar.gz",
+        "libc6_amd64~1.0.tar.gz",
+    ]
+    # the shared archives are not copied
+    assert os.path.samefile(
+        shell_view / "libc6_amd64~1.0.tar.gz",
+        modules_path / "groups" / "scripting" / "libc6_amd64~1.0.tar.gz",
+    )
+    scripting_archives = (tmp_path / "scripting_archives.MODULE.bazel").read_text()
+    assert 'name = "python3_amd64"' in scripting_archives
+    assert 'name = "libc6_amd64"' in scripting_archives
+    assert 'name = "bash_amd64"' not in scripting_archives
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
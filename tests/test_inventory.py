@@ -0,0 +1,146 @@
+from pathlib import Path
+
+import pytest
+import sys
+
+from click.testing import CliRunner
+
+from main import cli
+from src.inventory import (
+    INVENTORY_FILE,
+    Inventory,
+    collect_garbage,
+    get_referenced_packages,
+    read_inventory,
+)
+from src.lockfile import LOCKFILE, write_lockfile
+from src.package import PackageMetadata
+from src.package_factory import init_deb_package
+
+
+def _write_module(
+    modules_path: Path, version: str, inventory: Inventory, name: str = "libz"
+):
+    package = init_deb_package(
+        metadata=PackageMetadata(name=name, arch="amd64", version=version)
+    )
+    modules_path.mkdir(parents=True, exist_ok=True)
+    (modules_path / f"{package.prefix_version}.tar.gz").write_bytes(b"archive")
+    (modules_path / f"{package.prefix_version}.manifest.tsv").write_text("manifest")
+    inventory.record(package)
+    return package
+
+
+def test_inventory(tmp_path):
+    first_run = Inventory(tmp_path, run_id="1")
+    _write_module(tmp_path, "1.0", first_run)
+    first_run.close()
+    second_run = Inventory(tmp_path, run_id="2")
+    _write_module(tmp_path, "1.0", second_run)
+    _write_module(tmp_path, "1.1", second_run)
+    assert second_run.recorded == 4
+
+    # the entries of the previous run are only overridden once the index is compacted
+    assert len((tmp_path / INVENTORY_FILE).read_text().splitlines()) == 6
+    second_run.close()
+    assert len((tmp_path / INVENTORY_FILE).read_text().splitlines()) == 4
+    assert read_inventory(tmp_path)["libz_amd64~1.0.tar.gz"] == {
+        "file": "libz_amd64~1.0.tar.gz",
+        "module": "libz_amd64",
+        "pinned_name": "libz:amd64=1.0",
+        "version": "1.0",
+        "size": 7,
+        "last_run": "2",
+    }
+
+
+def test_collect_garbage(tmp_path):
+    inventory = Inventory(tmp_path, run_id="1")
+    for version in ["1.0", "1.1"]:
+        _write_module(tmp_path, version, inventory)
+    inventory.close()
+    (tmp_path / "not_indexed.tar.gz").write_bytes(b"archive")
+    referenced = get_referenced_packages(
+        [], [PackageMetadata(name="libz", arch="amd64", version="1.1")]
+    )
+
+    garbage = collect_garbage(tmp_path, referenced, dry_run=True)
+    assert [entry["file"] for entry in garbage] == [
+        "libz_amd64~1.0.manifest.tsv",
+        "libz_amd64~1.0.tar.gz",
+    ]
+    assert (tmp_path / "libz_amd64~1.0.tar.gz").exists()
+
+    assert collect_garbage(tmp_path, referenced) == garbage
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "bazelize.inventory.jsonl",
+        "libz_amd64~1.1.manifest.tsv",
+        "libz_amd64~1.1.tar.gz",
+        "not_indexed.tar.gz",
+    ]
+    assert sorted(read_inventory(tmp_path)) == [
+        "libz_amd64~1.1.manifest.tsv",
+        "libz_amd64~1.1.tar.gz",
+    ]
+
+
+def test_gc_command(tmp_path):
+    inventory = Inventory(tmp_path, run_id="1")
+    old_package = _write_module(tmp_path, "1.0", inventory)
+    package = _write_module(tmp_path, "1.1", inventory)
+    inventory.close()
+    runner = CliRunner()
+
+    result = runner.invoke(cli, ["gc", "-m", str(tmp_path)])
+    assert result.exit_code != 0
+    assert "At least one --lockfile or --input_file is required" in str(
+        result.exception
+    )
+
+    write_lockfile(tmp_path / LOCKFILE, [package])
+    result = runner.invoke(cli, ["gc", "-m", str(tmp_path), "--dry_run"])
+    assert result.exit_code == 0
+    assert "2 artifacts would be removed, freeing 15 bytes" in result.output
+    assert (tmp_path / f"{old_package.prefix_version}.tar.gz").exists()
+
+    result = runner.invoke(cli, ["gc", "-m", str(tmp_path)])
+    assert result.exit_code == 0
+    assert "2 artifacts were removed" in result.output
+    assert not (tmp_path / f"{old_package.prefix_version}.tar.gz").exists()
+    assert (tmp_path / f"{package.prefix_version}.tar.gz").exists()
+
+
+def test_gc_command_keeps_the_deps_of_input_files(tmp_path):
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    (mirror / "Packages").write_text(
+        "\n\n".join(
+            f"Package: {name}\nVersion: 1.0\nArchitecture: amd64\n"
+            f"Filename: pool/{name}_1.0_amd64.deb\nDepends: {depends}\n"
+            for name, depends in [
+                ("app", "libdep (>= 1.0), perlapi-5.36.0"),
+                ("libdep", ""),
+            ]
+        )
+    )
+    input_file = tmp_path / "deb_packages.in"
+    input_file.write_text("app:amd64\n")
+    modules_path = tmp_path / "modules"
+    inventory = Inventory(modules_path, run_id="1")
+    for name in ["app", "libdep", "libold"]:
+        _write_module(modules_path, "1.0", inventory, name=name)
+    inventory.close()
+
+    result = CliRunner().invoke(
+        cli,
+        ["gc", "-m", str(modules_path), "-i", str(input_file), "-ds", str(mirror)],
+    )
+    assert result.exit_code == 0, result.output
+    assert sorted(path.name for path in modules_path.glob("*.tar.gz")) == [
+        "app_amd64~1.0.tar.gz",
+        "libdep_amd64~1.0.tar.gz",
+    ]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
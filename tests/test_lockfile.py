@@ -0,0 +1,92 @@
+from pathlib import Path
+
+import pytest
+import sys
+
+from src.lockfile import LOCKFILE, read_lockfile, refresh_build_files, write_lockfile
+from src.manifest import ELF_KIND_NON_ELF, ELF_KIND_SHARED_LIB
+from src.modularize_package import MANIFEST_SUFFIX
+from src.package import DetachedModeMetadata, PackageFile, PackageMetadata
+from src.package_factory import init_deb_package
+from src.writers import write_build_file, write_manifest_file
+
+
+def _detached_mode_metadata(tmp_path: Path) -> DetachedModeMetadata:
+    return DetachedModeMetadata(
+        url_prefix="https://example.com",
+        build_file_package="@//build_files",
+        archives_file=tmp_path / "archives.MODULE.bazel",
+        build_files_dir=tmp_path / "build_files",
+    )
+
+
+def test_refresh_build_files(tmp_path):
+    modules_path = tmp_path / "modules"
+    detached_mode_metadata = _detached_mode_metadata(tmp_path)
+    libz = PackageMetadata(name="libz", arch="amd64", version="1.0")
+    libc = PackageMetadata(name="libc6", arch="amd64", version="2.36")
+
+    def create_package(tags):
+        package = init_deb_package(
+            metadata=libz,
+            tags=tags,
+            detached_mode_metadata=detached_mode_metadata,
+            explicit_file_lists=True,
+        )
+        package.deps = {libc}
+        package.files = {
+            PackageFile(
+                path=Path("usr/lib/libz.so.1"),
+                is_elf=True,
+                size=1,
+                elf_kind=ELF_KIND_SHARED_LIB,
+            ),
+            PackageFile(
+                path=Path("usr/share/doc/libz/copyright"),
+                is_elf=False,
+                size=2,
+                elf_kind=ELF_KIND_NON_ELF,
+            ),
+        }
+        return package
+
+    package = create_package(tags=["manual"])
+    write_build_file(package)
+    write_manifest_file(
+        package.files, modules_path / (package.prefix_version + MANIFEST_SUFFIX)
+    )
+    write_lockfile(modules_path / LOCKFILE, [package])
+    assert list(read_lockfile(modules_path / LOCKFILE)) == ["libz:amd64=1.0"]
+    detached_mode_metadata.archives_file.write_text("integrity entries")
+
+    build_file = tmp_path / "build_files" / "libz_amd64" / "libz_amd64.BUILD"
+    build_file.unlink()
+    refreshed_packages = refresh_build_files(
+        modules_path=modules_path,
+        detached_mode_metadata=detached_mode_metadata,
+        tags=["no-remote"],
+        explicit_file_lists=True,
+    )
+
+    assert [package.pinned_name for package in refreshed_packages] == ["libz:amd64=1.0"]
+    content = build_file.read_text()
+    assert '"no-remote"' in content and '"manual"' not in content
+    # the refreshed BUILD file is the one a full run with the new tags would write
+    write_build_file(create_package(tags=["no-remote"]))
+    assert build_file.read_text() == content
+    assert (tmp_path / "build_files" / "libz_amd64" / "version.txt").read_text() == (
+        "1.0\n"
+    )
+    assert detached_mode_metadata.archives_file.read_text() == "integrity entries"
+
+
+def test_refresh_build_files_without_lockfile(tmp_path):
+    with pytest.raises(ValueError, match="does not exist"):
+        refresh_build_files(
+            modules_path=tmp_path,
+            detached_mode_metadata=_detached_mode_metadata(tmp_path),
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
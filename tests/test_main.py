@@ -3,7 +3,7 @@ import sys
 
 from click.testing import CliRunner
 
-from main import main
+from main import cli, main
 
 
 def test_main():
@@ -14,14 +14,38 @@ def test_main():
     assert "-i" in result.output
     assert "-m" in result.output
 
-    result = runner.invoke(main)
+    result = runner.invoke(main, ["-m", "modules"])
     assert result.exit_code != 0
-    assert "Error: Missing option '--input_file' / '-i'" in result.output
+    assert "At least one --input_file is required" in str(result.exception)
+
+    # refreshing the BUILD files only reads the lockfile
+    result = runner.invoke(
+        main,
+        ["-i", "./tests/ci_inputs/deb_packages.in", "-m", "modules", "-rb"],
+    )
+    assert result.exit_code != 0
+    assert "--input_file can't be set" in str(result.exception)
 
     result = runner.invoke(main, ["-i", "./tests/ci_inputs/deb_packages.in"])
     assert result.exit_code != 0
     assert "Error: Missing option '--modules_path' / '-m'" in result.output
 
 
+def test_cli():
+    "The bazelize command is the default one, next to the merge and verify commands"
+    runner = CliRunner()
+    result = runner.invoke(cli, ["-i", "./tests/ci_inputs/deb_packages.in"])
+    assert result.exit_code != 0
+    assert "Error: Missing option '--modules_path' / '-m'" in result.output
+
+    result = runner.invoke(cli, ["merge", "-m", "modules"])
+    assert result.exit_code != 0
+    assert "Missing argument 'SHARD_MODULES_PATHS...'" in result.output
+
+    result = runner.invoke(cli, ["verify", "-m", "does_not_exist"])
+    assert result.exit_code != 0
+    assert "does not exist" in result.output
+
+
 if __name__ == "__main__":
     sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,75 @@
+from pathlib import Path
+
+import hashlib
+import shutil
+import subprocess
+
+import pytest
+import sys
+
+from src.manifest import (
+    ELF_KIND_EXEC,
+    ELF_KIND_NON_ELF,
+    ELF_KIND_SHARED_LIB,
+    MANIFEST_HEADER,
+    get_manifest_content,
+    read_manifest,
+    scan_file,
+)
+
+
+def test_scan_non_elf_file(tmp_path):
+    file = tmp_path / "hello.sh"
+    file.write_bytes(b"#!/bin/sh\necho hello\n")
+    file.chmod(0o755)
+
+    package_file = scan_file(file, Path("usr/bin/hello.sh"))
+    assert package_file.path == Path("usr/bin/hello.sh")
+    assert not package_file.is_elf
+    assert package_file.size == len(b"#!/bin/sh\necho hello\n")
+    assert package_file.sha256 == hashlib.sha256(b"#!/bin/sh\necho hello\n").hexdigest()
+    assert package_file.mode == 0o755
+    assert package_file.elf_kind == ELF_KIND_NON_ELF
+
+
+def test_scan_elf_files(tmp_path):
+    if not shutil.which("gcc"):
+        pytest.skip("gcc is needed to build ELF files")
+
+    source = tmp_path / "foo.c"
+    source.write_text("int foo(void) { return 42; }\nint main(void) { return 0; }\n")
+    lib = tmp_path / "libfoo.so"
+    executable = tmp_path / "foo"
+    subprocess.run(["gcc", "-shared", "-fPIC", "-o", lib, source], check=True)
+    subprocess.run(["gcc", "-o", executable, source], check=True)
+
+    assert scan_file(lib, Path("libfoo.so")).elf_kind == ELF_KIND_SHARED_LIB
+    package_file = scan_file(executable, Path("foo"))
+    assert package_file.elf_kind == ELF_KIND_EXEC
+    assert package_file.sha256 == hashlib.sha256(executable.read_bytes()).hexdigest()
+    # ELF files are hashed once patched, only their headers are read before
+    package_file = scan_file(lib, Path("libfoo.so"), hash_elf_file=False)
+    assert package_file.sha256 == ""
+    assert package_file.size == lib.stat().st_size
+    assert package_file.elf_kind == ELF_KIND_SHARED_LIB
+
+
+def test_manifest_round_trip(tmp_path):
+    files = []
+    for name, content in [("b.txt", b"b"), ("a.txt", b"a\n")]:
+        (tmp_path / name).write_bytes(content)
+        (tmp_path / name).chmod(0o644)
+        files.append(scan_file(tmp_path / name, Path("usr/share") / name))
+
+    content = get_manifest_content(files)
+    sha256 = hashlib.sha256(b"a\n").hexdigest()
+    assert content.startswith(MANIFEST_HEADER)
+    assert content.splitlines()[1] == f"usr/share/a.txt\t2\t{sha256}\t0644\tnon_elf"
+
+    manifest_file = tmp_path / "manifest.tsv"
+    manifest_file.write_text(content)
+    assert read_manifest(manifest_file) == sorted(files, key=lambda file: file.path)
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
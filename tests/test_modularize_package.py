@@ -1,8 +1,33 @@
+import io
+import os
+import shutil
+import subprocess
 import sys
+import tarfile
+from pathlib import Path
 
 import pytest
 
-from src.modularize_package import modularize_package
+from src.module import Module
+from src.modularize_package import (
+    SOURCE_DATE_EPOCH,
+    modularize_package,
+    _HashingWriter,
+    _get_rpath_prefix,
+    _get_soname_index,
+    _strip_elf_files,
+    _write_debug_sidecar,
+    _write_layers,
+    _write_reproducible_tar,
+)
+from src.package import (
+    DetachedModeMetadata,
+    Package,
+    PackageFile,
+    PackageMetadata,
+    StripMetadata,
+)
+from src.writers import _get_integrity_for_file, get_integrity_from_digest
 
 
 def test_modularize_package():
@@ -10,5 +35,202 @@ def test_modularize_package():
     assert modularize_package
 
 
+def test_get_rpath_prefix():
+    assert _get_rpath_prefix(Path("ip")) == "$ORIGIN/../"
+    assert _get_rpath_prefix(Path("usr/bin/ip")) == "$ORIGIN/../../../"
+
+
+def test_get_soname_index():
+    dep = PackageMetadata(name="dep", arch="amd64", version="1.0")
+    other = PackageMetadata(name="other", arch="amd64", version="1.0")
+    modules = {
+        dep: Module(
+            name="dep", arch="amd64", version="1.0", rpaths={"libdep.so.1": "dep/lib"}
+        ),
+        other: Module(
+            name="other",
+            arch="amd64",
+            version="1.0",
+            rpaths={"libdep.so.1": "other/lib", "libother.so": "other/lib"},
+        ),
+    }
+    package = Package(
+        name="test-package",
+        arch="amd64",
+        deps={dep},
+        rpaths={"libown.so": "own/lib"},
+    )
+    index = _get_soname_index(
+        package, modules, soname_index={"libdep.so.1": "other/lib"}
+    )
+
+    # direct deps take precedence over the rest of the graph
+    assert index["libdep.so.1"] == "dep/lib"
+    assert index["libown.so"] == "own/lib"
+
+
+def test_hashing_writer(tmp_path):
+    (tmp_path / "content").mkdir()
+    (tmp_path / "content" / "file.txt").write_text("content")
+    archive = tmp_path / "archive.tar.gz"
+    with archive.open("wb") as f:
+        hashing_writer = _HashingWriter(f)
+        with tarfile.open(fileobj=hashing_writer, mode="w:gz") as tar:
+            tar.add(tmp_path / "content", arcname="content")
+
+    assert get_integrity_from_digest(
+        hashing_writer.sha256.digest()
+    ) == _get_integrity_for_file(archive)
+
+
+def _create_module_dir(directory: Path, mtime: int):
+    (directory / "usr" / "lib").mkdir(parents=True)
+    (directory / "usr" / "bin").mkdir(parents=True)
+    (directory / "usr" / "lib" / "libfoo.so.1").write_text("lib")
+    (directory / "usr" / "lib" / "libfoo.so").symlink_to("libfoo.so.1")
+    (directory / "usr" / "bin" / "foo").write_text("bin")
+    (directory / "usr" / "bin" / "foo").chmod(0o700)
+    for path in directory.rglob("*"):
+        if not path.is_symlink():
+            os.utime(path, (mtime, mtime))
+
+
+def test_write_reproducible_tar(tmp_path):
+    archives = []
+    for i, mtime in enumerate([1000000, 2000000]):
+        directory = tmp_path / str(i) / "foo_amd64"
+        _create_module_dir(directory, mtime)
+        archive = io.BytesIO()
+        _write_reproducible_tar(archive, directory, "foo_amd64")
+        archives.append(archive.getvalue())
+
+    assert archives[0] == archives[1]
+    with tarfile.open(fileobj=io.BytesIO(archives[0])) as tar:
+        members = tar.getmembers()
+    assert [member.name for member in members] == [
+        "foo_amd64",
+        "foo_amd64/usr",
+        "foo_amd64/usr/bin",
+        "foo_amd64/usr/bin/foo",
+        "foo_amd64/usr/lib",
+        "foo_amd64/usr/lib/libfoo.so",
+        "foo_amd64/usr/lib/libfoo.so.1",
+    ]
+    assert {member.mtime for member in members} == {SOURCE_DATE_EPOCH}
+    assert {(member.uid, member.gid, member.uname) for member in members} == {
+        (0, 0, "")
+    }
+    modes = {member.name: member.mode for member in members}
+    assert modes["foo_amd64/usr/bin/foo"] == 0o755
+    assert modes["foo_amd64/usr/lib/libfoo.so.1"] == 0o644
+
+
+@pytest.mark.parametrize("mode", ["debug", "all"])
+def test_strip_elf_files_with_debug_sidecar(tmp_path, mode):
+    if not all(shutil.which(tool) for tool in ["gcc", "strip", "objcopy"]):
+        pytest.skip("gcc, strip and objcopy are needed to test stripping")
+
+    package = Package()
+    package.prefix = "foo_amd64"
+    package.prefix_version = "foo_amd64~1.0"
+    package.package_dir = tmp_path / package.prefix
+    (package.package_dir / "usr" / "lib").mkdir(parents=True)
+    source = tmp_path / "foo.c"
+    source.write_text("int foo(void) { return 42; }\n")
+    lib = package.package_dir / "usr" / "lib" / "libfoo.so.1"
+    subprocess.run(
+        ["gcc", "-g", "-shared", "-fPIC", "-o", lib, source],
+        check=True,
+    )
+    (package.package_dir / "usr" / "lib" / "libfoo.so").symlink_to("libfoo.so.1")
+    package.elf_files = {Path("usr/lib/libfoo.so"), Path("usr/lib/libfoo.so.1")}
+    unstripped_size = lib.stat().st_size
+
+    _strip_elf_files(
+        package, StripMetadata(mode=mode, debug_sidecar=True), elf_workers=2
+    )
+    sections = subprocess.run(
+        ["readelf", "-S", lib], check=True, capture_output=True, encoding="utf-8"
+    ).stdout
+    assert ".debug_info" not in sections
+    assert ".gnu_debuglink" in sections
+    assert (".symtab" in sections) == (mode == "debug")
+    assert lib.stat().st_size < unstripped_size
+
+    debug_tar = _write_debug_sidecar(package, tmp_path / "modules")
+    assert debug_tar == tmp_path / "modules" / "foo_amd64~1.0.debug.tar.gz"
+    with tarfile.open(debug_tar) as tar:
+        assert "foo_amd64/usr/lib/libfoo.so.1.debug" in tar.getnames()
+    assert _write_debug_sidecar(package, tmp_path / "modules") is None
+
+
+def test_write_layers(tmp_path, monkeypatch):
+    detached_mode_metadata = DetachedModeMetadata(
+        url_prefix="https://example.com",
+        build_file_package="@//build_files",
+        archives_file=tmp_path / "archives.MODULE.bazel",
+        build_files_dir=tmp_path / "build_files",
+        layered_archives=True,
+    )
+    layer_tars = {}
+    for version in ["1.0", "1.1"]:
+        # like the packages, extracted into the working directory
+        (tmp_path / version).mkdir()
+        monkeypatch.chdir(tmp_path / version)
+        package = Package(
+            name="foo",
+            arch="amd64",
+            version=version,
+            module_name="foo_amd64",
+            prefix="foo_amd64",
+            prefix_version=f"foo_amd64~{version}",
+            package_dir=tmp_path / version / "foo_amd64",
+            detached_mode_metadata=detached_mode_metadata,
+            files={
+                PackageFile(path=Path("usr/lib/libfoo.so.1"), is_elf=True),
+                PackageFile(path=Path("usr/lib/libfoo.so"), is_elf=True),
+                PackageFile(path=Path("usr/bin/foo"), is_elf=True),
+            },
+        )
+        _create_module_dir(package.package_dir, mtime=1000000)
+        (package.package_dir / "usr" / "share" / "doc").mkdir(parents=True)
+        (package.package_dir / "MODULE.bazel").write_text(f'version = "{version}"\n')
+        layer_tars[version] = _write_layers(package, tmp_path / "modules")
+
+    assert [layer_tar.name for layer_tar in layer_tars["1.0"]] == [
+        "foo_amd64~1.0.module.layer.tar.gz",
+        "foo_amd64~1.0.data.layer.tar.gz",
+        "foo_amd64~1.0.libs.layer.tar.gz",
+        "foo_amd64~1.0.bins.layer.tar.gz",
+    ]
+    with tarfile.open(layer_tars["1.0"][2]) as tar:
+        assert tar.getnames() == [
+            "foo_amd64",
+            "foo_amd64/usr",
+            "foo_amd64/usr/lib",
+            "foo_amd64/usr/lib/libfoo.so",
+            "foo_amd64/usr/lib/libfoo.so.1",
+        ]
+    with tarfile.open(layer_tars["1.0"][1]) as tar:
+        assert "foo_amd64/usr/share/doc" in tar.getnames()
+
+    # only the layer of the generated module files changed with the version
+    for old_tar, new_tar in zip(layer_tars["1.0"], layer_tars["1.1"]):
+        assert (old_tar.read_bytes() == new_tar.read_bytes()) == (
+            ".module." not in old_tar.name
+        )
+
+    archives_file_content = detached_mode_metadata.archives_file.read_text()
+    assert archives_file_content.count("layered_archive(\n") == 1
+    assert (
+        'layered_archive = use_repo_rule("@//build_files:layered_archive.bzl", "layered_archive")'
+        in archives_file_content
+    )
+    assert '"https://example.com/foo_amd64~1.1.bins.layer.tar.gz",' in (
+        archives_file_content
+    )
+    assert (tmp_path / "build_files" / "layered_archive.bzl").exists()
+
+
 if __name__ == "__main__":
     sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,187 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import http.client
+import io
+import tarfile
+import threading
+
+import pytest
+import sys
+
+from src.manifest import get_manifest_content
+from src.module_cache import (
+    HttpModuleCache,
+    LocalDirectoryModuleCache,
+    ModuleCache,
+    fetch_cached_packages,
+    get_fingerprints,
+    get_module_cache,
+)
+from src.package import DetachedModeMetadata, PackageFile, PackageMetadata
+from src.package_factory import init_deb_package
+from src import upload as upload_module
+
+
+class _StorageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        content = self.server.storage.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_PUT(self):
+        content = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            self.server.storage[self.path] = content
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StorageHandler)
+    server.storage = {}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _metadata(name: str, version: str = "1.0") -> PackageMetadata:
+    return PackageMetadata(name=name, arch="amd64", version=version)
+
+
+def test_get_fingerprints():
+    a, b, c, d = (_metadata(name) for name in "abcd")
+    # b <-> c is a cycle, depending on d
+    resolved_graph = {a: {b}, b: {c, d}, c: {b}, d: set()}
+    components = [[d], [b, c], [a]]
+    fingerprints = get_fingerprints(components, resolved_graph)
+
+    assert len(set(fingerprints.values())) == 4
+    assert fingerprints == get_fingerprints(components, resolved_graph)
+    tagged_fingerprints = get_fingerprints(components, resolved_graph, tags=["manual"])
+    assert tagged_fingerprints[d] != fingerprints[d]
+
+    # a new version of d changes the fingerprints of everything depending on it
+    new_d = _metadata("d", "2.0")
+    new_fingerprints = get_fingerprints(
+        [[new_d], [b, c], [a]], {a: {b}, b: {c, new_d}, c: {b}, new_d: set()}
+    )
+    for metadata in [a, b, c]:
+        assert new_fingerprints[metadata] != fingerprints[metadata]
+
+
+def test_get_module_cache(tmp_path):
+    assert isinstance(get_module_cache("http://127.0.0.1/cache"), HttpModuleCache)
+    cache = get_module_cache(str(tmp_path))
+    assert isinstance(cache, LocalDirectoryModuleCache)
+    assert cache.directory == tmp_path
+    # backends must fetch and store files
+    with pytest.raises(TypeError):
+        ModuleCache()
+
+
+def _package_module(modules_path: Path, detached_mode_metadata: DetachedModeMetadata):
+    "Writes the archive and the manifest of a module, like package_module does"
+    package = init_deb_package(
+        metadata=_metadata("libz"),
+        detached_mode_metadata=detached_mode_metadata,
+        explicit_file_lists=True,
+    )
+    package.deps = {_metadata("libc6")}
+    package.rpaths = {"libz.so.1": f"{package.prefix}/usr/lib"}
+    package.elf_files = {Path("usr/lib/libz.so.1")}
+    package.files = {
+        PackageFile(path=Path("usr/lib/libz.so.1"), is_elf=True, elf_kind="shared_lib")
+    }
+    modules_path.mkdir(parents=True)
+    module_file_content = b'module(name = "libz_amd64")\n'
+    with tarfile.open(modules_path / f"{package.prefix_version}.tar.gz", "w:gz") as tar:
+        member = tarfile.TarInfo(f"{package.prefix}/MODULE.bazel")
+        member.size = len(module_file_content)
+        tar.addfile(member, io.BytesIO(module_file_content))
+    (modules_path / f"{package.prefix_version}.manifest.tsv").write_text(
+        get_manifest_content(package.files)
+    )
+    return package
+
+
+@pytest.mark.parametrize("backend", ["http", "local"])
+def test_module_cache_round_trip(tmp_path, server, backend):
+    detached_mode_metadata = DetachedModeMetadata(
+        url_prefix="https://example.com",
+        build_file_package="@//build_files",
+        archives_file=tmp_path / "archives.MODULE.bazel",
+        build_files_dir=tmp_path / "build_files",
+    )
+    module_cache = get_module_cache(
+        f"http://127.0.0.1:{server.server_port}/cache"
+        if backend == "http"
+        else str(tmp_path / "cache")
+    )
+    package = _package_module(tmp_path / "built", detached_mode_metadata)
+    libz = _metadata("libz")
+    fetch = lambda modules_path: fetch_cached_packages(  # noqa: E731
+        module_cache=module_cache,
+        components=[[libz]],
+        resolved_graph={libz: {_metadata("libc6")}},
+        fingerprints={libz: "f00d"},
+        modules_path=modules_path,
+        detached_mode_metadata=detached_mode_metadata,
+        explicit_file_lists=True,
+    )
+
+    assert fetch(tmp_path / "miss") == {}
+    module_cache.store_module("f00d", package, tmp_path / "built")
+    cached_packages = fetch(tmp_path / "hit")
+    module_cache.close()
+
+    assert module_cache.stored == module_cache.hits == ["libz:amd64=1.0"]
+    cached_package = cached_packages[libz]
+    assert cached_package.rpaths == package.rpaths
+    assert cached_package.files == package.files
+    assert cached_package.deps == package.deps
+    assert (tmp_path / "hit" / "libz_amd64~1.0.tar.gz").read_bytes() == (
+        tmp_path / "built" / "libz_amd64~1.0.tar.gz"
+    ).read_bytes()
+    # the outputs living outside of the archive are written like for a packaged module
+    assert (tmp_path / "build_files" / "libz_amd64" / "libz_amd64.BUILD").exists()
+    assert 'name = "libz_amd64"' in detached_mode_metadata.archives_file.read_text()
+
+
+def test_http_module_cache_streams_fetched_files(tmp_path, server, mocker):
+    module_cache = HttpModuleCache(f"http://127.0.0.1:{server.server_port}/cache")
+    content = bytes(range(256)) * 1000
+    server.storage["/cache/f0/f00d/archive.tar.gz"] = content
+    mocker.patch.object(upload_module, "RESPONSE_CHUNK_SIZE", 1 << 16)
+    read = mocker.spy(http.client.HTTPResponse, "read")
+
+    assert module_cache._fetch_file("f00d", "archive.tar.gz", tmp_path / "archive")
+    # the body is read chunk by chunk, never as a whole
+    assert {call.args[1:] for call in read.call_args_list} == {(1 << 16,)}
+    assert not module_cache._fetch_file("f00d", "missing", tmp_path / "missing")
+    module_cache.close()
+
+    assert (tmp_path / "archive").read_bytes() == content
+    # no temporary file is left behind
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["archive"]
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,50 @@
+import hashlib
+import threading
+from pathlib import Path
+
+import pytest
+import sys
+
+from src import package_factory
+from src.manifest import ELF_KIND_NON_ELF
+from src.package_factory import _scan_package_files
+
+
+def test_scan_package_files(mocker, tmp_path):
+    for name in ["a.so.1.2", "b", "c.so.1.2"]:
+        (tmp_path / name).write_text(name)
+    (tmp_path / "a.so.1").symlink_to(tmp_path / "a.so.1.2")
+
+    checked_files = []
+    lock = threading.Lock()
+
+    def is_patchable_elf_file(file):
+        with lock:
+            checked_files.append(file)
+        return ".so" in file.name
+
+    mocker.patch.object(
+        package_factory, "_is_patchable_elf_file", side_effect=is_patchable_elf_file
+    )
+    file_paths = [Path(name) for name in ["a.so.1", "b", "c.so.1.2", "a.so.1.2"]]
+
+    package_files = _scan_package_files(tmp_path, file_paths, elf_workers=4)
+    assert [package_file.path for package_file in package_files] == file_paths
+    assert [package_file.is_elf for package_file in package_files] == [
+        True,
+        False,
+        True,
+        True,
+    ]
+    # the symlink gets the manifest entry of its target
+    assert package_files[0].sha256 == hashlib.sha256(b"a.so.1.2").hexdigest()
+    assert package_files[0].size == len("a.so.1.2")
+    assert package_files[1].elf_kind == ELF_KIND_NON_ELF
+    # the symlink and its target are only checked once
+    assert sorted(checked_files) == sorted(
+        [tmp_path / "a.so.1.2", tmp_path / "b", tmp_path / "c.so.1.2"]
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,173 @@
+from pathlib import Path
+
+import threading
+import time
+
+import pytest
+import sys
+
+from src import pipeline
+from src.package import Package, PackageMetadata
+from src.pipeline import StageLimits, bazelize_pipelined, parse_stage_limits
+
+
+def _metadata(name: str) -> PackageMetadata:
+    return PackageMetadata(name=name, arch="amd64", version="1.0")
+
+
+def _init_deb_package(metadata, **_):
+    package = Package()
+    package.name = metadata.name
+    package.arch = metadata.arch
+    package.version = metadata.version
+    return package
+
+
+@pytest.fixture
+def stages(mocker):
+    "Mocks the stages, records the order of the patches and checks the modules they see"
+    patched = []
+    lock = threading.Lock()
+
+    def extract_deb_package(package, archive_path, deb_source, elf_workers, deps):
+        # the slowest archives are the ones of the deps
+        time.sleep(0.01 if package.name == "c" else 0)
+        package.deps = set(deps)
+        package.rpaths = {f"lib{package.name}.so": f"{package.name}/lib"}
+        return package
+
+    def patch_package(package, modules, soname_index, elf_workers, strip_metadata):
+        for dep in package.deps:
+            assert dep in modules
+        with lock:
+            patched.append((package.name, soname_index))
+
+    mocker.patch.object(pipeline, "init_deb_package", side_effect=_init_deb_package)
+    mocker.patch.object(
+        pipeline,
+        "download_deb_package",
+        side_effect=lambda package, _: Path(f"{package.name}.deb"),
+    )
+    mocker.patch.object(
+        pipeline, "extract_deb_package", side_effect=extract_deb_package
+    )
+    mocker.patch.object(pipeline, "patch_package", side_effect=patch_package)
+    mocker.patch.object(
+        pipeline,
+        "package_module",
+        side_effect=lambda package, modules_path, _: modules_path / package.name,
+    )
+    return patched
+
+
+def test_parse_stage_limits():
+    assert parse_stage_limits("") == StageLimits()
+    assert parse_stage_limits("download=8, patch=3,queue_size=2") == StageLimits(
+        download=8, patch=3, queue_size=2
+    )
+    with pytest.raises(ValueError):
+        parse_stage_limits("unpack=2")
+    with pytest.raises(ValueError):
+        parse_stage_limits("download=0")
+
+
+def test_bazelize_pipelined_patches_in_topological_order(stages):
+    a, b, c, d = (_metadata(name) for name in "abcd")
+    # b <-> c is a cycle, both depend on d
+    resolved_graph = {a: {b}, b: {c, d}, c: {b}, d: set()}
+    components = [[d], [b, c], [a]]
+
+    processed_packages = bazelize_pipelined(
+        components=components,
+        resolved_graph=resolved_graph,
+        modules_path=Path("modules"),
+        minimal_rpaths=True,
+        stage_limits=StageLimits(download=3, extract=3, patch=2, queue_size=1),
+    )
+
+    assert set(processed_packages) == {a, b, c, d}
+    assert processed_packages[b].cycle_peers == {c}
+    assert processed_packages[a].cycle_peers == set()
+    patch_order = [name for name, _ in stages]
+    assert patch_order[0] == "d"
+    assert set(patch_order[1:3]) == {"b", "c"}
+    assert patch_order[3] == "a"
+    # only the transitive deps provide sonames, regardless of the timing
+    assert dict(stages)["a"] == {
+        "libb.so": "b/lib",
+        "libc.so": "c/lib",
+        "libd.so": "d/lib",
+    }
+    assert dict(stages)["d"] == {}
+
+
+def test_bazelize_pipelined_uploads_packaged_modules(stages, mocker):
+    uploader = mocker.Mock()
+    bazelize_pipelined(
+        components=[[_metadata("b")], [_metadata("a")]],
+        resolved_graph={_metadata("a"): {_metadata("b")}, _metadata("b"): set()},
+        modules_path=Path("modules"),
+        uploader=uploader,
+        stage_limits=StageLimits(),
+    )
+
+    assert sorted(call.args[0] for call in uploader.submit.call_args_list) == [
+        Path("modules/a"),
+        Path("modules/b"),
+    ]
+    assert [name for name, _ in stages] == ["b", "a"]
+
+
+def test_bazelize_pipelined_starts_longest_packages_first(stages, mocker):
+    x, y, z = (_metadata(name) for name in "xyz")
+    costs = {x: 10.0, y: 1.0, z: 1.0}
+    downloaded = []
+    download_deb_package = pipeline.download_deb_package
+
+    def download(package, deb_source):
+        downloaded.append(package.name)
+        return download_deb_package(package, deb_source)
+
+    mocker.patch.object(pipeline, "download_deb_package", side_effect=download)
+    patch_package = pipeline.patch_package
+
+    def patch(package, **kwargs):
+        # x and y are both extracted, and wait for z to be patched
+        time.sleep(0.05 if package.name == "z" else 0)
+        patch_package(package, **kwargs)
+
+    mocker.patch.object(pipeline, "patch_package", side_effect=patch)
+    bazelize_pipelined(
+        # y comes first in the topological order, but x costs more
+        components=[[z], [y], [x]],
+        resolved_graph={x: {z}, y: {z}, z: set()},
+        modules_path=Path("modules"),
+        stage_limits=StageLimits(download=1, patch=1),
+        get_cost=costs.__getitem__,
+    )
+
+    assert downloaded == ["z", "x", "y"]
+    assert [name for name, _ in stages] == ["z", "x", "y"]
+
+
+def test_bazelize_pipelined_raises_stage_errors(stages, mocker):
+    mocker.patch.object(
+        pipeline, "download_deb_package", side_effect=ValueError("no archive")
+    )
+    with pytest.raises(ValueError, match="no archive"):
+        bazelize_pipelined(
+            components=[[_metadata("a")]],
+            resolved_graph={_metadata("a"): set()},
+            modules_path=Path("modules"),
+        )
+
+
+def test_bazelize_pipelined_empty_graph(stages):
+    assert (
+        bazelize_pipelined(components=[], resolved_graph={}, modules_path=Path("m"))
+        == {}
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
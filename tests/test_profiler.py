@@ -0,0 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pstats
+import time
+
+import pytest
+import sys
+
+from src import profiler
+from src.package import Package
+from src.profiler import (
+    COLLAPSED_STACKS_FILE,
+    PACKAGES_DIR,
+    PSTATS_FILE,
+    RUN_LABEL,
+    profiled_per_package,
+    profiling,
+)
+
+
+@profiled_per_package
+def _busy_stage(package: Package, seconds: float) -> str:
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+    return package.pinned_name
+
+
+def _package(name: str) -> Package:
+    return Package(
+        name=name, arch="amd64", version="1.0", pinned_name=f"{name}:amd64=1.0"
+    )
+
+
+def test_profiled_per_package_without_profiler():
+    assert profiler._PROFILER is None
+    assert _busy_stage(_package("zlib"), 0) == "zlib:amd64=1.0"
+
+
+def test_profiling(tmp_path):
+    with profiling(tmp_path):
+        _busy_stage(_package("zlib"), 0.05)
+        # the stages of the pipeline run in worker threads
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            assert (
+                executor.submit(
+                    _busy_stage, package=_package("bash"), seconds=0.05
+                ).result()
+                == "bash:amd64=1.0"
+            )
+    assert profiler._PROFILER is None
+
+    # since python 3.12, the stages in worker threads are only sampled
+    assert "zlib_amd64_1.0.pstats" in {
+        path.name for path in (tmp_path / PACKAGES_DIR).iterdir()
+    }
+    stats = pstats.Stats(str(tmp_path / PACKAGES_DIR / "zlib_amd64_1.0.pstats"))
+    assert any(name == "_busy_stage" for _, _, name in stats.stats)
+    pstats.Stats(str(tmp_path / PSTATS_FILE))
+
+    stacks = (tmp_path / COLLAPSED_STACKS_FILE).read_text().splitlines()
+    labels = {stack.split(";")[0] for stack in stacks}
+    assert {"zlib:amd64=1.0", "bash:amd64=1.0"} <= labels
+    assert all(label == RUN_LABEL or label.endswith("=1.0") for label in labels)
+    assert all(int(stack.rsplit(" ", 1)[1]) > 0 for stack in stacks)
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
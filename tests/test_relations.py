@@ -0,0 +1,78 @@
+import pytest
+import sys
+
+from src.package import PackageRelation
+from src.relations import get_package_relations, get_relation_arch, parse_relations
+
+
+def test_parse_relations():
+    assert parse_relations(
+        "libc6 (>= 2.34), debconf (>= 0.5) | debconf-2.0, perl:any,"
+        " libfoo:i386 (<< 2:1.0~rc1) [amd64 i386] <!nocheck>"
+    ) == (
+        (PackageRelation(name="libc6", operator=">=", version="2.34"),),
+        (
+            PackageRelation(name="debconf", operator=">=", version="0.5"),
+            PackageRelation(name="debconf-2.0", operator="", version=""),
+        ),
+        (PackageRelation(name="perl", operator="", version="", arch="any"),),
+        (
+            PackageRelation(
+                name="libfoo",
+                operator="<<",
+                version="2:1.0~rc1",
+                arch="i386",
+                arch_restrictions=("amd64", "i386"),
+            ),
+        ),
+    )
+    assert parse_relations("") == ()
+    with pytest.raises(ValueError, match="not a valid relation"):
+        parse_relations("libfoo (>= 1.0")
+
+
+def test_parse_relations_is_memoized():
+    field = "libbar (= 1.0), libbaz"
+    assert parse_relations(field) is parse_relations(field)
+
+
+def test_get_package_relations():
+    relations = get_package_relations(
+        "awk | mawk (>= 1.3), gawk | mawk, tzdata, libc6:any,"
+        " libamd64 [amd64], libi386 [i386], libnoti386 [!i386]",
+        "amd64",
+    )
+    # the versioned alternative is preferred, otherwise the first one is chosen
+    assert [relation.name for relation in relations] == [
+        "mawk",
+        "gawk",
+        "libc6",
+        "libamd64",
+        "libnoti386",
+    ]
+
+
+def test_get_package_relations_skips_virtual_packages():
+    real_packages = {("dbus-user-session", "amd64"), ("perl-base", "amd64")}
+    relations = get_package_relations(
+        "perlapi-5.36.0, default-dbus-session-bus | dbus-user-session, perl-base",
+        "amd64",
+        is_real_package=lambda name, arch: (name, arch) in real_packages,
+    )
+    # a real alternative is preferred over a virtual one, purely virtual deps are left out
+    assert [relation.name for relation in relations] == [
+        "dbus-user-session",
+        "perl-base",
+    ]
+
+
+def test_get_relation_arch():
+    for qualifier in ["", "any", "native"]:
+        relation = PackageRelation(name="a", operator="", version="", arch=qualifier)
+        assert get_relation_arch(relation, "amd64") == "amd64"
+    relation = PackageRelation(name="a", operator="", version="", arch="i386")
+    assert get_relation_arch(relation, "amd64") == "i386"
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,191 @@
+import pytest
+import sys
+
+from src.package import PackageMetadata, PackageRelation
+from src.resolver import get_closure, resolve_versions, satisfies
+
+CANDIDATES = {"libfoo": "1.4", "libbar": "2.0", "libbaz": "3.0"}
+
+DEPENDS = {
+    PackageMetadata(
+        name="app", arch="amd64", version="1.0"
+    ): "libfoo (>= 1.0), libbar (= 2.0)",
+    PackageMetadata(name="tool", arch="amd64", version="1.0"): "libfoo (= 1.2)",
+    PackageMetadata(name="libfoo", arch="amd64", version="1.4"): "libbaz (>= 3.0)",
+    PackageMetadata(name="libfoo", arch="amd64", version="1.2"): "libold (= 0.1)",
+    PackageMetadata(name="libbar", arch="amd64", version="2.0"): "libfoo (<< 1.3)",
+}
+
+
+def _get_requested_version(relation: PackageRelation, arch: str) -> str:
+    return relation.version if relation.operator == "=" else CANDIDATES[relation.name]
+
+
+def test_satisfies():
+    assert satisfies("1.2", PackageRelation(name="a", operator=">=", version="1.0"))
+    assert not satisfies("1.2", PackageRelation(name="a", operator="<<", version="1.2"))
+    assert satisfies("1.2-1", PackageRelation(name="a", operator="=", version="1.2-1"))
+    assert not satisfies(
+        "1.2-2", PackageRelation(name="a", operator="=", version="1.2-1")
+    )
+    assert not satisfies(
+        "2.36-9", PackageRelation(name="a", operator=">=", version="2.36-10")
+    )
+    assert satisfies("1.0", PackageRelation(name="a", operator="=", version="0:1.0"))
+
+
+@pytest.mark.parametrize(
+    "lower, higher",
+    [
+        ("2.36-9", "2.36-10"),
+        ("1.0-1ubuntu2", "1.0-1ubuntu10"),
+        ("1.0~rc1", "1.0"),
+        ("1.0~~", "1.0~"),
+        ("1.0+b1", "1.0.1"),
+    ],
+)
+def test_highest_dpkg_version_is_selected(lower, higher):
+    resolved_graph = resolve_versions(
+        input_package_metadatas=[
+            PackageMetadata(name="libc6", arch="amd64", version=lower),
+            PackageMetadata(name="libc6", arch="amd64", version=higher),
+        ],
+        get_deps_str=lambda metadata: "",
+        get_requested_version=_get_requested_version,
+    )
+
+    assert set(resolved_graph) == {
+        PackageMetadata(name="libc6", arch="amd64", version=higher)
+    }
+
+
+def test_one_version_per_compatibility_level():
+    resolved_graph = resolve_versions(
+        input_package_metadatas=[
+            PackageMetadata(name="app", arch="amd64", version="1.0"),
+            PackageMetadata(name="tool", arch="amd64", version="1.0"),
+        ],
+        get_deps_str=lambda metadata: DEPENDS.get(metadata, ""),
+        get_requested_version=_get_requested_version,
+    )
+
+    libfoo_1_2 = PackageMetadata(name="libfoo", arch="amd64", version="1.2")
+    # libfoo 1.4 is the highest requested version, but it violates libbar's upper bound
+    assert libfoo_1_2 in resolved_graph
+    assert (
+        PackageMetadata(name="libfoo", arch="amd64", version="1.4")
+        not in resolved_graph
+    )
+    # deps of unselected versions are not part of the graph
+    assert (
+        PackageMetadata(name="libbaz", arch="amd64", version="3.0")
+        not in resolved_graph
+    )
+    assert resolved_graph[PackageMetadata(name="app", arch="amd64", version="1.0")] == {
+        libfoo_1_2,
+        PackageMetadata(name="libbar", arch="amd64", version="2.0"),
+    }
+
+
+def test_conflicting_constraints_are_rejected():
+    depends = {
+        PackageMetadata(name="app", arch="amd64", version="1.0"): "libfoo (>= 1.3)",
+        PackageMetadata(name="tool", arch="amd64", version="1.0"): "libfoo (= 1.2)",
+    }
+
+    with pytest.raises(
+        ValueError,
+        match=r"libfoo:amd64 \(1.4, 1.2\) satisfies the constraints: "
+        r"libfoo \(= 1.2\), libfoo \(>= 1.3\)",
+    ):
+        resolve_versions(
+            input_package_metadatas=[
+                PackageMetadata(name="app", arch="amd64", version="1.0"),
+                PackageMetadata(name="tool", arch="amd64", version="1.0"),
+            ],
+            get_deps_str=lambda metadata: depends.get(metadata, ""),
+            get_requested_version=_get_requested_version,
+        )
+
+
+def test_highest_requested_version_is_selected():
+    depends = {
+        PackageMetadata(name="tool", arch="amd64", version="1.0"): "libfoo (>= 1.0)",
+        PackageMetadata(name="libfoo", arch="amd64", version="1.4"): "libbaz (>= 3.0)",
+    }
+    resolved_graph = resolve_versions(
+        input_package_metadatas=[
+            PackageMetadata(name="tool", arch="amd64", version="1.0"),
+            PackageMetadata(name="libfoo", arch="amd64", version="1.2"),
+        ],
+        get_deps_str=lambda metadata: depends.get(metadata, ""),
+        get_requested_version=_get_requested_version,
+    )
+
+    assert set(resolved_graph) == {
+        PackageMetadata(name="tool", arch="amd64", version="1.0"),
+        PackageMetadata(name="libfoo", arch="amd64", version="1.4"),
+        PackageMetadata(name="libbaz", arch="amd64", version="3.0"),
+    }
+
+
+def test_unversioned_and_qualified_deps():
+    depends = {
+        PackageMetadata(
+            name="tool", arch="amd64", version="1.0"
+        ): "libbar, libbaz:any | libfoo (>= 1.0)",
+    }
+    resolved_graph = resolve_versions(
+        input_package_metadatas=[
+            PackageMetadata(name="tool", arch="amd64", version="1.0")
+        ],
+        get_deps_str=lambda metadata: depends.get(metadata, ""),
+        get_requested_version=_get_requested_version,
+    )
+
+    assert resolved_graph[
+        PackageMetadata(name="tool", arch="amd64", version="1.0")
+    ] == {
+        PackageMetadata(name="libbar", arch="amd64", version="2.0"),
+        PackageMetadata(name="libfoo", arch="amd64", version="1.4"),
+    }
+    assert satisfies("0.1", PackageRelation(name="a", operator="", version=""))
+
+
+def test_get_closure():
+    app, libfoo, libfoo_old, libbar = (
+        PackageMetadata(name=name, arch="amd64", version=version)
+        for name, version in [
+            ("app", "1.0"),
+            ("libfoo", "1.4"),
+            ("libfoo", "1.2"),
+            ("libbar", "2.0"),
+        ]
+    )
+    resolved_graph = {app: {libfoo}, libfoo: set(), libbar: {libfoo}}
+
+    assert get_closure(resolved_graph, [app]) == {app, libfoo}
+    # inputs are mapped to the version selected for them
+    assert get_closure(resolved_graph, [libfoo_old]) == {libfoo}
+    assert get_closure(resolved_graph, [app, libbar]) == {app, libfoo, libbar}
+
+
+def test_virtual_only_deps_are_left_out():
+    resolved_graph = resolve_versions(
+        input_package_metadatas=[
+            PackageMetadata(name="app", arch="amd64", version="1.0")
+        ],
+        get_deps_str=lambda metadata: (
+            "perlapi-5.36.0, libfoo" if metadata.name == "app" else ""
+        ),
+        get_requested_version=_get_requested_version,
+        is_real_package=lambda name, arch: name in CANDIDATES,
+    )
+
+    assert resolved_graph[PackageMetadata(name="app", arch="amd64", version="1.0")] == {
+        PackageMetadata(name="libfoo", arch="amd64", version="1.4")
+    }
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,133 @@
+import json
+import threading
+
+import pytest
+import sys
+
+from src.module import Module
+from src.package import Package, PackageMetadata, ShardMetadata
+from src.shard import (
+    SHARD_SUMMARY_DOT_JSON,
+    export_modules,
+    get_shard_components,
+    merge_shards,
+    parse_shard,
+    wait_for_modules,
+    write_shard_summary,
+)
+
+
+def _metadata(name: str) -> PackageMetadata:
+    return PackageMetadata(name=name, arch="amd64", version="1.0")
+
+
+def test_parse_shard(tmp_path):
+    assert parse_shard("2/3", tmp_path) == ShardMetadata(
+        index=2, count=3, shard_dir=tmp_path
+    )
+    for spec in ["0/3", "4/3", "3", "a/b", "-1/3"]:
+        with pytest.raises(ValueError):
+            parse_shard(spec, tmp_path)
+
+
+def test_get_shard_components():
+    components = [[_metadata(str(i))] for i in range(6)]
+    components.insert(3, [_metadata("a"), _metadata("b")])
+    shards = get_shard_components(components, 3)
+
+    # contiguous in topological order, and every component is in exactly one shard
+    assert [component for shard in shards for component in shard] == components
+    assert [sum(len(component) for component in shard) for shard in shards] == [
+        3,
+        2,
+        3,
+    ]
+
+    costs = {"0": 10.0}
+    shards = get_shard_components(
+        components, 2, get_cost=lambda metadata: costs.get(metadata.name, 1.0)
+    )
+    assert shards[0] == [[_metadata("0")]]
+
+    assert get_shard_components([], 2) == [[], []]
+    assert get_shard_components(components[:1], 3) == [[], [components[0]], []]
+
+
+def test_shards_exchange_modules(tmp_path):
+    shards = [ShardMetadata(index=i, count=2, shard_dir=tmp_path) for i in (1, 2)]
+    libc = Module(name="libc6", arch="amd64", version="2.36", rpaths={"libc.so.6": "a"})
+    libc_metadata = PackageMetadata(name="libc6", arch="amd64", version="2.36")
+
+    upstream_modules = {}
+
+    def wait():
+        upstream_modules.update(
+            wait_for_modules(shards[1], {libc_metadata}, timeout=10, poll_interval=0.01)
+        )
+
+    waiting_shard = threading.Thread(target=wait)
+    waiting_shard.start()
+    export_modules(shards[0], [libc])
+    waiting_shard.join()
+
+    assert upstream_modules == {libc_metadata: libc}
+    # a shard does not read its own exports
+    with pytest.raises(ValueError, match="libc6:amd64=2.36"):
+        wait_for_modules(shards[0], {libc_metadata}, timeout=0)
+
+
+def _package(name: str) -> Package:
+    return Package(
+        name=name,
+        arch="amd64",
+        version="1.0",
+        pinned_name=f"{name}:amd64=1.0",
+    )
+
+
+def test_merge_shards(tmp_path):
+    archives = {}
+    shard_paths = []
+    for index, name in [(1, "zlib"), (2, "bash")]:
+        shard_path = tmp_path / f"shard_{index}"
+        shard_path.mkdir()
+        (shard_path / f"{name}_amd64~1.0.tar.gz").write_text(name)
+        archives_file = shard_path / "archives.MODULE.bazel"
+        archives_file.write_text(
+            f'http_archive(\n    name = "{name}_amd64",\n    url = "{name}",\n)\n'
+        )
+        write_shard_summary(
+            modules_path=shard_path,
+            shard_metadata=ShardMetadata(index=index, count=2, shard_dir=tmp_path),
+            packages=[_package(name)],
+            archives_file=archives_file,
+        )
+        shard_paths.append(shard_path)
+        archives[name] = archives_file
+
+    summary = json.loads((shard_paths[0] / SHARD_SUMMARY_DOT_JSON).read_text())
+    assert summary["packages"] == ["zlib:amd64=1.0"]
+    assert list(summary["http_archives"]) == ["zlib_amd64"]
+
+    with pytest.raises(ValueError, match="exactly once"):
+        merge_shards(shard_paths[:1], tmp_path / "merged")
+
+    merged_archives_file = tmp_path / "archives.MODULE.bazel"
+    packages = merge_shards(shard_paths, tmp_path / "merged", merged_archives_file)
+    assert packages == ["bash:amd64=1.0", "zlib:amd64=1.0"]
+    assert sorted(path.name for path in (tmp_path / "merged").iterdir()) == [
+        "bash_amd64~1.0.tar.gz",
+        "bazelize.inventory.jsonl",
+        "bazelize.lock.json",
+        "bazelize.timings.json",
+        "zlib_amd64~1.0.tar.gz",
+    ]
+    content = merged_archives_file.read_text()
+    assert content.index('name = "bash_amd64"') < content.index('name = "zlib_amd64"')
+
+    # merging again replaces the previously merged archives
+    assert merge_shards(shard_paths, tmp_path / "merged") == packages
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
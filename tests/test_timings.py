@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import pytest
+import sys
+
+from src.package import PackageMetadata
+from src.package_factory import init_deb_package
+from src.timings import TIMINGS_DOT_JSON, TimingDatabase, timed_stage, tracking
+
+
+def _metadata(name: str, version: str = "1.0") -> PackageMetadata:
+    return PackageMetadata(name=name, arch="amd64", version=version)
+
+
+def test_timing_database(tmp_path):
+    database = TimingDatabase(tmp_path / TIMINGS_DOT_JSON)
+    database.record(init_deb_package(_metadata("liba")), "download", 1.0, size=10)
+    database.record(init_deb_package(_metadata("liba")), "patch", 2.0)
+    database.record(init_deb_package(_metadata("libb")), "download", 6.0)
+    database.record(init_deb_package(_metadata("libc")), "download", 7.0)
+    database.save()
+
+    database = TimingDatabase(tmp_path / TIMINGS_DOT_JSON)
+    assert database.packages["liba:amd64"] == {
+        "seconds": {"download": 1.0, "patch": 2.0},
+        "sizes": {"download": 10},
+        "version": "1.0",
+    }
+    # a new version is estimated from the previous ones
+    assert database.get_cost(_metadata("liba", version="2.0")) == 3.0
+    # unknown packages cost the median of the known ones
+    assert database.get_cost(_metadata("libd")) == 6.0
+
+
+def test_timing_database_empty(tmp_path):
+    assert (
+        TimingDatabase(tmp_path / TIMINGS_DOT_JSON).get_cost(_metadata("liba")) == 1.0
+    )
+
+
+def test_timed_stage(tmp_path, capsys):
+    @timed_stage("package")
+    def package_module(package, modules_path: Path) -> Path:
+        archive = modules_path / f"{package.name}.tar.gz"
+        archive.write_bytes(b"archive")
+        return archive
+
+    package = init_deb_package(_metadata("liba"))
+    database = TimingDatabase(tmp_path / TIMINGS_DOT_JSON)
+    # outside of tracking, nothing is recorded
+    package_module(package, tmp_path)
+    assert database.packages == {}
+
+    with tracking(database, [_metadata("liba"), _metadata("libb")]):
+        package_module(package, modules_path=tmp_path)
+
+    assert "[1/2] liba:amd64=1.0 is done, 50% of the estimated work" in (
+        capsys.readouterr().out
+    )
+    assert TimingDatabase(tmp_path / TIMINGS_DOT_JSON).packages["liba:amd64"][
+        "sizes"
+    ] == {"package": 7}
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,104 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import hashlib
+import threading
+
+import pytest
+import sys
+
+from src.upload import ArchiveUploader, CHECKSUM_HEADER, HASH_CHUNK_SIZE
+
+
+class _StorageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        content = self.server.storage.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header(CHECKSUM_HEADER, hashlib.sha256(content).hexdigest())
+        self.end_headers()
+
+    def do_PUT(self):
+        content = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            self.server.storage[self.path] = content
+            self.server.puts += 1
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StorageHandler)
+    server.storage = {}
+    server.puts = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_upload_archives(server, tmp_path):
+    url = f"http://127.0.0.1:{server.server_port}/modules"
+    archives = []
+    for i in range(5):
+        archive = tmp_path / f"module_{i}.tar.gz"
+        archive.write_bytes(f"content {i}".encode())
+        archives.append(archive)
+
+    uploader = ArchiveUploader(upload_url=url, max_connections=2)
+    for archive in archives:
+        uploader.submit(archive)
+    uploader.close()
+
+    assert len(uploader.uploaded) == 5
+    assert server.storage["/modules/module_3.tar.gz"] == b"content 3"
+
+    # unchanged archives are not uploaded again
+    archives[0].write_bytes(b"new content")
+    uploader = ArchiveUploader(upload_url=url, max_connections=2)
+    for archive in archives:
+        uploader.submit(archive)
+    uploader.close()
+
+    assert uploader.uploaded == [archives[0]]
+    assert len(uploader.skipped) == 4
+    assert server.puts == 6
+
+
+def test_upload_large_archive(server, tmp_path):
+    url = f"http://127.0.0.1:{server.server_port}/modules"
+    archive = tmp_path / "module.tar.gz"
+    # spans several hash chunks
+    content = bytes(range(256)) * (3 * HASH_CHUNK_SIZE // 256 + 1)
+    archive.write_bytes(content)
+
+    for _ in range(2):
+        uploader = ArchiveUploader(upload_url=url)
+        uploader.submit(archive)
+        uploader.close()
+
+    assert server.storage["/modules/module.tar.gz"] == content
+    assert uploader.skipped == [archive]
+    assert server.puts == 1
+
+
+def test_invalid_upload_url():
+    with pytest.raises(ValueError, match="must be an http"):
+        ArchiveUploader(upload_url="ftp://example.com/modules")
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import shutil
+import subprocess
+import tarfile
+
+import pytest
+import sys
+
+from src.elf import ET_DYN, ElfDynamicInfo
+from src.lockfile import LOCKFILE, write_lockfile
+from src.package import PackageMetadata
+from src.package_factory import init_deb_package
+from src.verify import get_search_dirs, layout_modules, verify_modules
+
+
+def test_get_search_dirs():
+    origin = Path("/runfiles/foo_amd64/usr/lib")
+    rpath_only = ElfDynamicInfo(
+        elf_type=ET_DYN,
+        has_interpreter=False,
+        rpath="$ORIGIN:${ORIGIN}/../../../bar_amd64/usr/lib::/opt/lib",
+    )
+    assert get_search_dirs(rpath_only, origin) == [
+        origin,
+        Path("/runfiles/foo_amd64/usr/lib/../../../bar_amd64/usr/lib"),
+        Path("/opt/lib"),
+    ]
+
+    # DT_RPATH is ignored when there is a DT_RUNPATH
+    both = ElfDynamicInfo(
+        elf_type=ET_DYN, has_interpreter=False, rpath="/rpath", runpath="/runpath"
+    )
+    assert get_search_dirs(both, origin) == [Path("/runpath")]
+
+
+def _write_module(modules_path: Path, prefix: str, module_dir: Path):
+    with tarfile.open(modules_path / f"{prefix}~1.0.tar.gz", "w:gz") as tar:
+        tar.add(module_dir, arcname=prefix)
+
+
+def _build_lib(lib: Path, source: Path, *args: str):
+    "Builds a shared lib without libc, so that its only DT_NEEDED libs are the given ones"
+    lib.parent.mkdir(parents=True, exist_ok=True)
+    subprocess.run(
+        ["gcc", "-shared", "-fPIC", "-nostdlib", "-Wl,--disable-new-dtags"]
+        + ["-o", lib, source]
+        + list(args),
+        check=True,
+    )
+
+
+def test_verify_modules(tmp_path):
+    if not shutil.which("gcc"):
+        pytest.skip("gcc is needed to build ELF files")
+
+    build_dir = tmp_path / "build"
+    modules_path = tmp_path / "modules"
+    modules_path.mkdir()
+    foo_source = tmp_path / "foo.c"
+    foo_source.write_text("int foo(void) { return 42; }\n")
+    bar_source = tmp_path / "bar.c"
+    bar_source.write_text("int foo(void);\nint bar(void) { return foo(); }\n")
+
+    foo_lib = build_dir / "foo_amd64" / "usr" / "lib" / "libfoo.so"
+    _build_lib(foo_lib, foo_source, "-Wl,-soname,libfoo.so")
+    (foo_lib.parent / "libfoo.so.1").symlink_to("libfoo.so")
+    _write_module(modules_path, "foo_amd64", build_dir / "foo_amd64")
+    (modules_path / "foo_amd64~1.0.debug.tar.gz").write_bytes(b"not a module")
+
+    link_args = ["-L", str(foo_lib.parent), "-lfoo"]
+    bar_lib_dir = build_dir / "bar_amd64" / "usr" / "lib"
+    _build_lib(
+        bar_lib_dir / "libbar.so",
+        bar_source,
+        "-Wl,-rpath,$ORIGIN/../../../foo_amd64/usr/lib",
+        *link_args,
+    )
+    _build_lib(
+        bar_lib_dir / "libbar_broken.so",
+        bar_source,
+        "-Wl,-rpath,$ORIGIN/../../../baz_amd64/usr/lib",
+        *link_args,
+    )
+    _write_module(modules_path, "bar_amd64", build_dir / "bar_amd64")
+
+    runfiles_dir = tmp_path / "runfiles"
+    assert layout_modules(modules_path, runfiles_dir) == [
+        runfiles_dir / "bar_amd64",
+        runfiles_dir / "foo_amd64",
+    ]
+    assert verify_modules(modules_path, workers=2) == {
+        "bar_amd64/usr/lib/libbar_broken.so": ["libfoo.so"]
+    }
+
+
+def _write_versions(modules_path: Path):
+    "Writes two versions of a module, both laid out in the same root"
+    packages = []
+    for version in ["1.0", "1.1"]:
+        package = init_deb_package(
+            metadata=PackageMetadata(name="foo", arch="amd64", version=version)
+        )
+        module_dir = modules_path / "build" / version / "foo_amd64"
+        module_dir.mkdir(parents=True)
+        (module_dir / "version.txt").write_text(version)
+        with tarfile.open(
+            modules_path / f"{package.prefix_version}.tar.gz", "w:gz"
+        ) as tar:
+            tar.add(module_dir, arcname="foo_amd64")
+        packages.append(package)
+
+    return packages
+
+
+def test_layout_modules_rejects_versions_sharing_a_root(tmp_path):
+    _write_versions(tmp_path)
+
+    with pytest.raises(ValueError, match="both lay out foo_amd64"):
+        layout_modules(tmp_path, tmp_path / "runfiles")
+
+
+def test_layout_modules_only_lays_out_locked_modules(tmp_path):
+    _, package = _write_versions(tmp_path)
+    write_lockfile(tmp_path / LOCKFILE, [package])
+    runfiles_dir = tmp_path / "runfiles"
+
+    assert layout_modules(tmp_path, runfiles_dir) == [runfiles_dir / "foo_amd64"]
+    assert (runfiles_dir / "foo_amd64" / "version.txt").read_text() == "1.1"
+
+    # explicit archives take precedence over the lockfile
+    archive = tmp_path / "foo_amd64~1.0.tar.gz"
+    layout_modules(tmp_path, tmp_path / "runfiles_1.0", [archive])
+    assert (tmp_path / "runfiles_1.0" / "foo_amd64" / "version.txt").read_text() == (
+        "1.0"
+    )
+
+
+def test_layout_modules_extracts_the_archives_on_the_executor(tmp_path, mocker):
+    for name in ["bar_amd64", "foo_amd64"]:
+        file = tmp_path / "build" / name / "name.txt"
+        file.parent.mkdir(parents=True)
+        file.write_text(name)
+        with tarfile.open(tmp_path / f"{name}~1.0.tar.gz", "w:gz") as tar:
+            tar.add(file.parent, arcname=name)
+    runfiles_dir = tmp_path / "runfiles"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        map_spy = mocker.spy(executor, "map")
+        roots = layout_modules(tmp_path, runfiles_dir, executor=executor)
+
+    map_spy.assert_called_once()
+    assert roots == [runfiles_dir / "bar_amd64", runfiles_dir / "foo_amd64"]
+    for root in roots:
+        assert (root / "name.txt").read_text() == root.name
+
+
+def test_layout_modules_rejects_escaping_members(tmp_path):
+    file = tmp_path / "evil"
+    file.write_text("evil")
+    with tarfile.open(tmp_path / "evil_amd64~1.0.tar.gz", "w:gz") as tar:
+        tar.add(file, arcname="../evil")
+
+    with pytest.raises(ValueError, match="outside of its module"):
+        layout_modules(tmp_path, tmp_path / "runfiles")
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__] + sys.argv[1:]))
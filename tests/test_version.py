@@ -1,7 +1,7 @@
 import pytest
 import sys
 
-from src.version import _extract_attribute
+from src.version import _extract_attribute, compare_dpkg_versions
 
 
 def test_extract_attribute_positive():
@@ -29,5 +29,28 @@ def test_extract_attribute_not_must_exist():
     ), "Expected an empty string when attribute does not exist and must_exist is set to False"
 
 
+@pytest.mark.parametrize(
+    "lower, higher",
+    [
+        ("2.36-9", "2.36-10"),
+        ("1ubuntu2", "1ubuntu10"),
+        ("1.0~rc1", "1.0"),
+        ("1.0~~", "1.0~"),
+        ("1.0-1", "1.0a-1"),
+        ("1.0a", "1.0+"),
+        ("9:1.0", "10:0.1"),
+        ("2.36-9ubuntu1", "2.36-9ubuntu1.1"),
+    ],
+)
+def test_compare_dpkg_versions(lower, higher):
+    assert compare_dpkg_versions(lower, higher) == -1
+    assert compare_dpkg_versions(higher, lower) == 1
+
+
+def test_compare_dpkg_versions_equal():
+    assert compare_dpkg_versions("0:1.0-0", "1.0") == 0
+    assert compare_dpkg_versions("1.01", "1.1") == 0
+
+
 if __name__ == "__main__":
     sys.exit(pytest.main([__file__] + sys.argv[1:]))
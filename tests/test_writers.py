@@ -1,8 +1,29 @@
 import pytest
 import sys
 from pathlib import Path
-from src.writers import _create_filegroup_content
-from src.package import Package
+from src.writers import (
+    _create_filegroup_content,
+    _create_build_file_content,
+    _create_paths_cpp_file_content,
+    _create_paths_python_file_content,
+    _create_module_file_content,
+    _write_if_changed,
+    WRITE_STATS,
+    prune_http_archives,
+    read_http_archives,
+    write_http_archive,
+    write_layered_archive,
+    write_registry_module,
+)
+from src.package import (
+    DetachedModeMetadata,
+    Package,
+    PackageFile,
+    PackageMetadata,
+    RegistryMetadata,
+)
+
+import json
 
 
 def test_filegroup_content_creation():
@@ -51,5 +72,246 @@ def test_filegroup_content_creation():
         _create_filegroup_content(package_arm)
 
 
+def test_explicit_file_lists_build_file_content():
+    package = Package(
+        name="test-package",
+        version="1.0.0",
+        arch="amd64",
+        module_name="test_package_amd64",
+        deps={PackageMetadata(name="dep", arch="amd64", version="1.0")},
+        files={
+            PackageFile(path=Path("usr/lib/libtest.so.1"), is_elf=True),
+            PackageFile(path=Path("usr/bin/test"), is_elf=True),
+            PackageFile(path=Path("usr/share/doc/copyright"), is_elf=False),
+        },
+        explicit_file_lists=True,
+    )
+    content = _create_build_file_content(package)
+
+    assert "glob(" not in content
+    for name in ["libs", "bins", "data", "all_files"]:
+        assert f'name = "{name}"' in content
+    assert '"usr/lib/libtest.so.1"' in content
+    assert '"@dep_amd64//:libs"' in content
+    assert '"@dep_amd64//:all_files"' in content
+    assert content.index('"usr/bin/test"') < content.index('"usr/share/doc/copyright"')
+
+
+def test_cycle_peers_filegroup_content():
+    libgcc = PackageMetadata(name="libgcc-s1", arch="amd64", version="12.2")
+    libcrypt = PackageMetadata(name="libcrypt1", arch="amd64", version="4.4")
+    package = Package(
+        name="libc6",
+        version="2.36",
+        arch="amd64",
+        module_name="libc6_amd64",
+        deps={libgcc, libcrypt},
+        cycle_peers={libcrypt},
+    )
+    content = _create_filegroup_content(package)
+
+    assert 'name = "all_files_own"' in content
+    assert '"@libgcc_s1_amd64//:all_files"' in content
+    assert '"@libcrypt1_amd64//:all_files_own"' in content
+    # the cycle peer's all_files would make a cyclic target
+    assert '"@libcrypt1_amd64//:all_files"' not in content
+
+
+def test_paths_python_file_content():
+    namespace = {}
+    exec(
+        _create_paths_python_file_content({"ip": "../a/ip", "bridge": "../a/bridge"}),
+        namespace,
+    )
+
+    assert namespace["find"]("ip") == "../a/ip"
+    assert namespace["find"]("ss") is None
+    assert namespace["paths"]() == {"ip": "../a/ip", "bridge": "../a/bridge"}
+    assert list(namespace["PATHS"]) == ["bridge", "ip"]
+
+
+def test_paths_cpp_file_content():
+    content = _create_paths_cpp_file_content(
+        {"ip": "../a/ip", "bridge": "../a/bridge"}, "iproute2"
+    )
+
+    assert "static const std::size_t kPathsSize = 2;" in content
+    assert "static const Entry kPaths[kPathsSize + 1]" in content
+    assert content.index('"bridge"') < content.index('"ip"')
+    assert "inline const char* find(const char* name)" in content
+    assert "inline std::map<std::string, std::string> paths()" in content
+
+
+def test_write_registry_module(tmp_path):
+    registry_metadata = RegistryMetadata(
+        registry_dir=tmp_path, url_prefix="https://example.com/modules"
+    )
+    for version in ["1.10", "1:1.2+dfsg"]:
+        package = Package(
+            name="test-package",
+            version=version,
+            arch="amd64",
+            module_name="test_package_amd64",
+            prefix="_main~_repo_rules~test_package_amd64",
+        )
+        write_registry_module(
+            registry_metadata=registry_metadata,
+            package=package,
+            module_file_content=f"module(version = {version})",
+            integrity="sha256-abc",
+            debian_module_tar=Path(f"test_package_amd64~{version}.tar.gz"),
+        )
+
+    module_dir = tmp_path / "modules" / "test_package_amd64"
+    assert (module_dir / "1.2" / "MODULE.bazel").read_text() == (
+        "module(version = 1:1.2+dfsg)"
+    )
+    source = json.loads((module_dir / "1.2" / "source.json").read_text())
+    assert source == {
+        "integrity": "sha256-abc",
+        "strip_prefix": "_main~_repo_rules~test_package_amd64",
+        "url": "https://example.com/modules/test_package_amd64~1:1.2+dfsg.tar.gz",
+    }
+    metadata = json.loads((module_dir / "metadata.json").read_text())
+    assert metadata["versions"] == ["1.2", "1.10"]
+    assert (tmp_path / "bazel_registry.json").exists()
+
+
+def test_write_if_changed(tmp_path):
+    file = tmp_path / "dir" / "BUILD"
+    written, skipped = WRITE_STATS.written, WRITE_STATS.skipped
+
+    assert _write_if_changed(file, "content\n")
+    mtime = file.stat().st_mtime_ns
+    assert not _write_if_changed(file, "content\n")
+    assert file.stat().st_mtime_ns == mtime
+    assert _write_if_changed(file, "new content\n")
+    assert file.read_text() == "new content\n"
+    # no temporary file is left behind
+    assert [path.name for path in file.parent.iterdir()] == ["BUILD"]
+    assert (WRITE_STATS.written - written, WRITE_STATS.skipped - skipped) == (2, 1)
+
+
+def test_generated_content_is_sorted():
+    deps = {
+        PackageMetadata(name=name, arch="amd64", version="1.0")
+        for name in ["libz", "liba", "libm"]
+    }
+    package = Package(
+        name="test-package",
+        version="1.0.0",
+        arch="amd64",
+        module_name="test_package_amd64",
+        deps=deps,
+        tags={'"b"', '"a"', '"c"'},
+    )
+    build_file_content = _create_build_file_content(package)
+    assert 'tags = ["a", "b", "c"],' in build_file_content
+    assert (
+        build_file_content.index("@liba_amd64//:all_files")
+        < build_file_content.index("@libm_amd64//:all_files")
+        < build_file_content.index("@libz_amd64//:all_files")
+    )
+    module_file_content = _create_module_file_content(package)
+    assert (
+        module_file_content.index('"liba_amd64"')
+        < module_file_content.index('"libm_amd64"')
+        < module_file_content.index('"libz_amd64"')
+    )
+
+
+def test_write_http_archive(tmp_path):
+    archives_file = tmp_path / "archives.MODULE.bazel"
+    detached_mode_metadata = DetachedModeMetadata(
+        url_prefix="https://example.com",
+        build_file_package="@//build_files",
+        archives_file=archives_file,
+        build_files_dir=tmp_path,
+    )
+    for name, integrity in [("zlib", "sha256-a"), ("bash", "sha256-b")]:
+        package = Package(
+            name=name,
+            version="1.0",
+            arch="amd64",
+            module_name=f"{name}_amd64",
+            prefix=f"{name}_amd64",
+            detached_mode_metadata=detached_mode_metadata,
+        )
+        write_http_archive(package, Path(f"{name}_amd64~1.0.tar.gz"), integrity)
+
+    content = archives_file.read_text()
+    assert content.index('name = "bash_amd64"') < content.index('name = "zlib_amd64"')
+
+    # a new integrity replaces the previous http_archive instead of appending one
+    write_http_archive(package, Path("bash_amd64~1.0.tar.gz"), "sha256-c")
+    content = archives_file.read_text()
+    assert content.count('name = "bash_amd64"') == 1
+    assert 'integrity = "sha256-c"' in content
+
+    prune_http_archives(archives_file, ["bash_amd64"])
+    content = archives_file.read_text()
+    assert 'name = "zlib_amd64"' not in content
+    assert 'name = "bash_amd64"' in content
+    assert content.startswith('"""This file was generated automatically')
+
+
+def test_write_layered_archive(tmp_path):
+    archives_file = tmp_path / "archives.MODULE.bazel"
+    detached_mode_metadata = DetachedModeMetadata(
+        url_prefix="https://example.com",
+        build_file_package="@//build_files",
+        archives_file=archives_file,
+        build_files_dir=tmp_path / "build_files",
+        layered_archives=True,
+    )
+    packages = [
+        Package(
+            name=name,
+            version="1.0",
+            arch="amd64",
+            module_name=f"{name}_amd64",
+            prefix=f"{name}_amd64",
+            detached_mode_metadata=detached_mode_metadata,
+        )
+        for name in ["zlib", "bash"]
+    ]
+    write_http_archive(packages[0], Path("zlib_amd64~1.0.tar.gz"), "sha256-a")
+    write_layered_archive(
+        packages[1],
+        [
+            Path("bash_amd64~1.0.module.layer.tar.gz"),
+            Path("bash_amd64~1.0.bins.layer.tar.gz"),
+        ],
+        ["sha256-b", "sha256-c"],
+    )
+
+    http_archives = read_http_archives(archives_file)
+    assert set(http_archives) == {"bash_amd64", "zlib_amd64"}
+    assert (
+        http_archives["bash_amd64"]
+        == """layered_archive(
+    name = "bash_amd64",
+    build_file = "@//build_files:bash_amd64/bash_amd64.BUILD",
+    integrities = [
+        "sha256-b",
+        "sha256-c",
+    ],
+    strip_prefix = "bash_amd64",
+    urls = [
+        "https://example.com/bash_amd64~1.0.module.layer.tar.gz",
+        "https://example.com/bash_amd64~1.0.bins.layer.tar.gz",
+    ],
+)
+"""
+    )
+    load = 'layered_archive = use_repo_rule("@//build_files:layered_archive.bzl", "layered_archive")'
+    assert load in archives_file.read_text()
+    assert (tmp_path / "build_files" / "layered_archive.bzl").exists()
+
+    # the rule is only loaded while a layered_archive is left
+    prune_http_archives(archives_file, ["zlib_amd64"])
+    assert load not in archives_file.read_text()
+
+
 if __name__ == "__main__":
     sys.exit(pytest.main([__file__] + sys.argv[1:]))